@@ -0,0 +1,80 @@
+'''
+Throughput benchmark for :py:class:`floopcli.util.log.Log`
+
+Compares the batched receiver with the per-record writer it replaced
+(one RotatingFileHandler.emit, i.e. one write and one rollover check,
+per record) by pushing records through the queue and waiting until the
+last one is on disk. Reports records per second.
+
+Usage:
+    python bench/log_bench.py [record-count ...]
+'''
+from __future__ import print_function
+import logging
+import multiprocessing
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from logging.handlers import RotatingFileHandler
+from os.path import join
+
+from floopcli.util.log import Log
+
+_FORMAT = '%(asctime)s %(levelname)s %(message)s'
+
+def make_records(count): # type: (int) -> list
+    return [logging.LogRecord('floop', logging.INFO, __file__, 1,
+        'core{} (target) - build: Step {}/40 : RUN make -j4'.format(
+            idx % 200, idx % 40), None, None) for idx in range(count)]
+
+def per_record(path, records): # type: (str, list) -> float
+    '''
+    The receiver before batching: one emit per queued record
+    '''
+    handler = RotatingFileHandler(path, 'a', 5000000000, 0)
+    handler.setFormatter(logging.Formatter(_FORMAT))
+    queue = multiprocessing.Queue(-1)
+    def receive():
+        while True:
+            record = queue.get()
+            if record is None:
+                break
+            handler.emit(record)
+    thread = threading.Thread(target=receive)
+    thread.start()
+    start = time.time()
+    for record in records:
+        queue.put_nowait(record)
+    queue.put(None)
+    thread.join()
+    elapsed = time.time() - start
+    handler.close()
+    return elapsed
+
+def batched(path, records, index): # type: (str, list, bool) -> float
+    log = Log(path, 'a', 5000000000, 0, index=index)
+    log.setFormatter(logging.Formatter(_FORMAT))
+    start = time.time()
+    for record in records:
+        log.emit(record)
+    log.flush(timeout=600)
+    elapsed = time.time() - start
+    log.close()
+    return elapsed
+
+if __name__ == '__main__':
+    counts = [int(s) for s in sys.argv[1:]] or [10000, 100000, 500000]
+    print('{:>10} {:>16} {:>14}'.format('records', 'writer', 'records/s'))
+    for count in counts:
+        for name, run in [('per-record', per_record),
+                ('batched', lambda p, r: batched(p, r, False)),
+                ('batched+index', lambda p, r: batched(p, r, True))]:
+            path = tempfile.mkdtemp(prefix='floop-bench-')
+            try:
+                elapsed = run(join(path, 'floop.log'), make_records(count))
+            finally:
+                shutil.rmtree(path)
+            print('{:>10} {:>16} {:>14.0f}'.format(count, name, count / elapsed))
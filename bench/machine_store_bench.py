@@ -0,0 +1,58 @@
+'''
+Benchmark for :py:class:`floopcli.iot.machine.MachineStore` lookups
+
+Builds synthetic docker-machine stores of increasing size and measures
+the cost of the first (cold) and repeated (cached) lookup of a machine.
+Per-call latency should not depend on the number of machines in the store.
+
+Usage:
+    python bench/machine_store_bench.py [store-size ...]
+'''
+from __future__ import print_function
+import json
+import shutil
+import sys
+import tempfile
+import time
+
+from os import makedirs
+from os.path import join
+
+from floopcli.iot.machine import MachineStore
+
+def make_store(size): # type: (int) -> str
+    path = tempfile.mkdtemp(prefix='floop-bench-')
+    for idx in range(size):
+        machine_dir = join(path, 'machines', 'core{}'.format(idx))
+        makedirs(machine_dir)
+        with open(join(machine_dir, 'config.json'), 'w') as c:
+            json.dump({'DriverName' : 'generic', 'Driver' : {
+                'IPAddress' : '10.0.{}.{}'.format(idx // 256, idx % 256),
+                'SSHPort' : 22,
+                'SSHUser' : 'floop',
+                'SSHKeyPath' : join(machine_dir, 'id_rsa')}}, c)
+    return path
+
+def measure(size, calls=10000): # type: (int, int) -> tuple
+    path = make_store(size)
+    try:
+        machines = MachineStore(path)
+        names = ['core{}'.format(idx) for idx in range(size)]
+        start = time.time()
+        for name in names:
+            machines.resolve(name)
+        cold = (time.time() - start) / size
+        start = time.time()
+        for idx in range(calls):
+            machines.resolve(names[idx % size])
+        cached = (time.time() - start) / calls
+        return cold, cached
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    sizes = [int(s) for s in sys.argv[1:]] or [10, 100, 500, 2000]
+    print('{:>10} {:>16} {:>16}'.format('machines', 'cold (us/call)', 'cached (us/call)'))
+    for size in sizes:
+        cold, cached = measure(size)
+        print('{:>10} {:>16.1f} {:>16.2f}'.format(size, cold * 1e6, cached * 1e6))
@@ -0,0 +1,42 @@
+'''
+Microbenchmark for :py:func:`floopcli.util.syscall.syscall` output capture
+
+Each measurement runs in a fresh interpreter so that peak RSS
+(ru_maxrss) belongs to that measurement alone.
+
+Usage:
+    python bench/syscall_bench.py [size-in-MB ...]
+'''
+from __future__ import print_function
+import resource
+import subprocess
+import sys
+import time
+
+_CHILD = '''
+import resource, sys, time
+from floopcli.util.syscall import syscall, RingBufferSink
+mb, capture = int(sys.argv[1]), sys.argv[2] == 'capture'
+line = 'x' * 99
+producer = [sys.executable, '-c',
+    'import sys\\nl = "{}\\\\n" * 1024\\nfor _ in range({}): sys.stdout.write(l)'.format(
+        line, mb * 10)]
+sink = RingBufferSink(maxsize=64 * 1024)
+start = time.time()
+syscall(producer, check=True, sink=sink, capture=capture)
+elapsed = time.time() - start
+print('{:.3f} {}'.format(elapsed,
+    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+'''
+
+def measure(mb, mode): # type: (int, str) -> str
+    out = subprocess.check_output([sys.executable, '-c', _CHILD, str(mb), mode])
+    return out.decode('utf-8').split()
+
+if __name__ == '__main__':
+    sizes = [int(s) for s in sys.argv[1:]] or [50, 100, 200, 400]
+    print('{:>8} {:>10} {:>10} {:>14}'.format('MB', 'mode', 'seconds', 'peak RSS (KB)'))
+    for mb in sizes:
+        for mode in ['sink', 'capture']:
+            elapsed, rss = measure(mb, mode)
+            print('{:>8} {:>10} {:>10} {:>14}'.format(mb, mode, elapsed, rss))
@@ -1,26 +1,45 @@
 from __future__ import print_function
 import argparse
+import errno
 import json
 import logging
 
 from functools import partial
-from multiprocessing import Pool
-from os import makedirs, remove 
+from multiprocessing.pool import ThreadPool
+from os import devnull, dup2, makedirs, open as os_open, remove, O_WRONLY
 from os.path import isfile, dirname, expanduser, abspath
 from pkg_resources import require, DistributionNotFound
 from platform import system
 from shutil import copyfile
 from socket import gethostname
-from sys import argv, exit, modules, _getframe
+from sys import argv, exit, modules, stdout, _getframe
 from time import time
-from typing import TypeVar
+from typing import Dict, Iterator, List, Optional, Set, TypeVar
 
 from floopcli.config import Config, \
         ConfigFileDoesNotExist, \
         MalformedConfigException, \
         UnmetHostDependencyException, \
         RedundantCoreConfigException
-from floopcli.iot.core import build, create, destroy, ps, push, run, _test, \
+from floopcli.iot.buildcache import use_build_cache
+from floopcli.iot.image import use_builder, remove_images, BUILDERS, \
+        GroupBuildPlan
+from floopcli.iot.layers import remove_layer_diffs
+from floopcli.iot.relay import activate, stop_agent, RelayPlan
+from floopcli.iot.retry import retry_policy, with_retries, CircuitBreaker
+from floopcli.iot.result import collect, format_result, summary, \
+        unless_cancelled, CoreResult
+from floopcli.iot.session import close_sessions, use_idle_timeout
+from floopcli.iot.stage import use_stage_limits, STAGES
+from floopcli.util.cache import BuildCache
+from floopcli.util.manifest import forget_manifest, remove_deltas
+from floopcli.util.logindex import parse_time, LogFilter, LEVELS
+from floopcli.util.logshard import read, shard_path, shards
+from floopcli.util.tail import tail
+from floopcli.util.syscall import cancel_syscalls, reset_syscalls, \
+        syscalls_cancelled
+from floopcli.util.watch import Watcher, affects_image, image_inputs
+from floopcli.iot.core import build, cancel, create, destroy, ps, push, restart, run, _test, \
         CoreSourceNotFound, \
         CoreBuildException, \
         CoreCreateException, \
@@ -44,6 +63,7 @@ Supported commands:
     build       Push and build code from host on target(s)
     run         Push, build, and run code from host on target(s)
     test        Push, build, and test code from host on target(s)
+    watch       Run code on target(s), then update them whenever code changes
     ps          Show all running tests and runs on target(s)
     logs        Show logs with time stamps
     destroy     Destroy cores, uninstall environment from target(s)  
@@ -69,6 +89,111 @@ def quiet(): # type: () -> None
         if handler.name == 'console': #type: ignore
             log.removeHandler(handler)
 
+FAIL_FAST = ['cancel', 'cleanup']
+'''
+What happens to the other cores when one fails with --fail-fast: their
+processes on the host are killed, and with cleanup their remote builds
+and scripts as well
+'''
+
+def _fleet_arguments(parser): # type: (argparse.ArgumentParser) -> None
+    '''
+    Add arguments shared by all commands that act on cores
+
+    Args:
+        parser (:py:class:`argparse.ArgumentParser`):
+            command parser to extend
+    '''
+    parser.add_argument('-j', '--jobs',
+            help='Maximum number of cores to work on at the same time (default: all cores)',
+            type=int)
+    parser.add_argument('--fail-fast',
+            help='Stop all cores as soon as one core fails; with "cleanup", also stop the builds and scripts they left running on the cores',
+            nargs='?', const='cancel', choices=FAIL_FAST)
+    parser.add_argument('--retries',
+            help='Attempts per core when a core cannot be reached, including the first (default: depends on the command)',
+            type=int)
+    parser.add_argument('--no-circuit-breaker',
+            help='Try every core, even cores that failed to connect repeatedly in the last minutes',
+            action='store_true')
+
+def _push_arguments(parser): # type: (argparse.ArgumentParser) -> None
+    '''
+    Add arguments shared by all commands that push code to cores
+
+    Args:
+        parser (:py:class:`argparse.ArgumentParser`):
+            command parser to extend
+    '''
+    parser.add_argument('--relay',
+            help='Relay pushes core-to-core: the host sends to RELAY cores per group, each core forwards to RELAY more (needs ssh-agent)',
+            type=int, metavar='RELAY')
+
+def _build_arguments(parser): # type: (argparse.ArgumentParser) -> None
+    '''
+    Add arguments shared by all commands that build images
+
+    Args:
+        parser (:py:class:`argparse.ArgumentParser`):
+            command parser to extend
+    '''
+    parser.add_argument('--build-on',
+            help='Build on every core, once per architecture on the host with docker buildx, or once per group and architecture on its strongest core (default: core)',
+            choices=BUILDERS, default='core')
+    parser.add_argument('--build-cache',
+            help='Build with BuildKit on cores and share the build cache between cores of the same architecture through the host',
+            action='store_true')
+    parser.add_argument('--build-cache-size',
+            help='Largest size of the shared build cache on the host in MB (default: 2048)',
+            type=int, default=2048)
+
+def _stage_arguments(parser, stages): # type: (argparse.ArgumentParser, List[str]) -> None
+    '''
+    Add a concurrency limit for each stage a command goes through
+
+    Args:
+        parser (:py:class:`argparse.ArgumentParser`):
+            command parser to extend
+        stages ([str]):
+            stages of the command, see :py:data:`floopcli.iot.stage.STAGES`
+    '''
+    helps = {
+        'push': 'Maximum number of cores receiving files from the host at the same time (default: no limit)',
+        'build': 'Maximum number of cores building images at the same time (default: no limit)',
+        'run': 'Maximum number of cores running containers at the same time (default: no limit)',
+        }
+    for name in stages:
+        parser.add_argument('--{}-jobs'.format(name), help=helps[name], type=int)
+
+def _stage_limits(args): # type: (argparse.Namespace) -> Dict[str, int]
+    '''
+    Returns:
+        dict:
+            stage name to concurrency limit requested by command line arguments
+    '''
+    return dict((name, getattr(args, '{}_jobs'.format(name)))
+            for name in STAGES if getattr(args, '{}_jobs'.format(name), None))
+
+def _build_cache(args): # type: (argparse.Namespace) -> Optional[BuildCache]
+    '''
+    Returns:
+        :py:class:`floopcli.util.cache.BuildCache`:
+            shared build cache requested by command line arguments, or None
+    '''
+    if not args.build_cache:
+        return None
+    return BuildCache(args.build_cache_size * 1048576)
+
+def _circuit_breaker(args): # type: (argparse.Namespace) -> Optional[CircuitBreaker]
+    '''
+    Returns:
+        :py:class:`floopcli.iot.retry.CircuitBreaker`:
+            circuit breaker requested by command line arguments, or None
+    '''
+    if args.no_circuit_breaker:
+        return None
+    return CircuitBreaker()
+
 FloopCLIType = TypeVar('FloopCLIType', bound='FloopCLI')
 '''Generic FloopCLI type'''
 
@@ -255,23 +380,164 @@ class FloopCLI(object):
                     message)
             getattr(logger, level)(message)
 
-    def _parallel(self, func): # type: ignore 
+    def _parallel(self, func, jobs=None, relay=None, close=True, # type: ignore
+            build_on=None, build_cache=None, stages=None, report=True,
+            check=True, fail_fast=None, retries=None, breaker=None):
         '''
-        Convenient wrapper for interruptable multiprocessing pool on cores
+        Convenient wrapper for interruptable fan-out of a function over cores
+
+        Core functions spend their time waiting on docker-machine, ssh,
+        and rsync subprocesses, so they run in threads of this process
+        instead of forked workers. The pool is sized by the number of
+        cores, not the number of host CPUs.
+
+        A failing core does not stop the others. Results are collected
+        as cores finish (see :py:class:`floopcli.iot.result.CoreResult`),
+        printed one line per core, and summarized in a table at the end.
 
         Args:
             func (function):
                 function or partial function to be called in parallel on cores
+            jobs (int):
+                maximum number of cores to work on at the same time;
+                defaults to all cores, and is overridden (with a warning)
+                when both relay and group builds are used
+            relay (int):
+                if set, push through a :py:class:`floopcli.iot.relay.RelayPlan`
+                with this fan-out
+            close (bool):
+                if True, close SSH connections to cores afterwards
+            build_on (str):
+                where to build images, one of :py:data:`floopcli.iot.image.BUILDERS`
+            build_cache (:py:class:`floopcli.util.cache.BuildCache`):
+                if set, share BuildKit caches between cores through this cache
+            stages (dict):
+                stage name to maximum number of cores in that stage at
+                the same time, see :py:class:`floopcli.iot.stage.Stage`
+            fail_fast (str):
+                if set, one of :py:data:`FAIL_FAST`: after the first
+                failure, kill all running system calls and skip cores
+                that have not started; with cleanup, also run
+                :py:func:`floopcli.iot.core.cancel` on cancelled cores
+            retries (int):
+                attempts per core when the core cannot be reached; defaults
+                to the :py:class:`floopcli.iot.retry.RetryPolicy` of func
+            breaker (:py:class:`floopcli.iot.retry.CircuitBreaker`):
+                if set, skip cores that keep failing to connect
+            report (bool):
+                if True, print results as cores finish and a summary table
+            check (bool):
+                if True, raise the exception of the first failed core
+                after all cores finished
+        Returns:
+            [:py:class:`floopcli.iot.result.CoreResult`]:
+                results in completion order
+        Raises:
+            :py:class:`Exception`:
+                exception of the first failed core, if check is True
+        '''
+        requested = jobs
+        if not jobs or jobs < 1:
+            jobs = len(self.cores)
+        cores = self.cores
+        chunksize = None
+        plans = []
+        if relay:
+            plans.append(RelayPlan(self.cores, relay))
+            activate(plans[-1])
+        build_plan = None
+        if build_on == 'group':
+            build_plan = GroupBuildPlan(self.cores)
+            plans.append(build_plan)
+        use_builder(build_on, build_plan)
+        use_build_cache(build_cache)
+        use_stage_limits(stages)
+        func = partial(with_retries, func, retry_policy(func, retries), breaker)
+        func = partial(unless_cancelled, func)
+        for plan in plans:
+            func = partial(plan.run, func)
+        if len(plans) == 1:
+            # start parents before children and hand out one core at a time
+            # so that no worker waits on a parent that is still queued
+            cores = plans[0].order()
+            chunksize = 1
+        elif plans:
+            # the orders of two plans can conflict, so keep every core in flight
+            if requested and requested < len(cores):
+                self.__log('warning', 'Ignoring --jobs {} with --relay and '
+                        '--build-on group: working on all {} cores at once'.format(
+                            requested, len(cores)))
+            jobs = len(cores)
+        pool = ThreadPool(max(1, min(jobs, len(cores))))
+        results = [] # type: List[CoreResult]
+        try:
+            finished = pool.imap_unordered(partial(collect, func), cores,
+                    chunksize or 1)
+            while len(results) < len(cores):
+                # handle interrupt with python 2 hack (python 2: bug 8296)
+                # don't block, timeout for the largest 64 bit signed integer (python 3)
+                result = finished.next(9223372036)
+                results.append(result)
+                if result.ok:
+                    self.__log('info', format_result(result))
+                else:
+                    self.__log('error', '{}: {}'.format(
+                        format_result(result), result.message))
+                if report:
+                    print(format_result(result))
+                if fail_fast and result.status in ['failed', 'timeout'] and \
+                        not syscalls_cancelled():
+                    killed = cancel_syscalls()
+                    self.__log('error', 'Fail fast after {}: killed {} process(es)'.format(
+                        result.core, killed))
+        except KeyboardInterrupt:
+            # do not wait for the slowest core to notice
+            cancel_syscalls()
+            raise
+        finally:
+            pool.close()
+            pool.join()
+            if syscalls_cancelled():
+                reset_syscalls()
+                if fail_fast == 'cleanup':
+                    self._cleanup([result.core for result in results
+                        if result.status == 'cancelled'])
+            activate(None)
+            stop_agent()
+            use_builder(None)
+            use_build_cache(None)
+            use_stage_limits(None)
+            if close:
+                close_sessions()
+            remove_deltas()
+            remove_images()
+            remove_layer_diffs()
+        if report and results:
+            print(summary(results))
+        # report the failure that caused a cancellation, not a cancelled core
+        failed = sorted([result for result in results if not result.ok],
+                key=lambda result: result.status == 'cancelled')
+        if check and failed:
+            raise failed[0].exception # type: ignore
+        return results
+
+    def _cleanup(self, names): # type: (FloopCLIType, List[str]) -> None
         '''
-        pool = Pool()
+        Stop remote work left behind on cancelled cores, all at once
+
+        Args:
+            names ([str]):
+                names of cancelled cores
+        '''
+        cores = [core for core in self.cores if core.core in names]
+        if not cores:
+            return
+        pool = ThreadPool(len(cores))
         try:
-            # handle interrupt with python 2 hack (python 2: bug 8296)
-            # don't block, timeout for the largest 64 bit signed integer (python 3)
-            pool.map_async(func, self.cores).get(9223372036)
-        except (KeyboardInterrupt, Exception) as e:
+            pool.map_async(cancel, cores).get(9223372036)
+        finally:
             pool.close()
             pool.join()
-            raise e
 
     def config(self): # type: (FloopCLIType) -> None
         '''
@@ -321,13 +587,16 @@ class FloopCLI(object):
                 action='store_true')
         parser.add_argument('-t', '--timeout',
                 help='Time to wait during creation before raising error')
+        _fleet_arguments(parser)
         args = parser.parse_args(argv[self.command_index:])
         if not args.verbose:
             quiet()
         timeout = 120
         if args.timeout:
             timeout = int(args.timeout)
-        self._parallel(partial(create, timeout=timeout))
+        self._parallel(partial(create, timeout=timeout), jobs=args.jobs,
+                fail_fast=args.fail_fast, retries=args.retries,
+                breaker=_circuit_breaker(args))
 
     def ps(self): # type: (FloopCLIType) -> None
         '''
@@ -339,16 +608,27 @@ class FloopCLI(object):
         parser.add_argument('-v', '--verbose',
                 help='Print system commands and results to stdout',
                 action='store_true')
+        _fleet_arguments(parser)
         args = parser.parse_args(argv[self.command_index:])
         if not args.verbose:
             quiet()
-        self._parallel(ps)
+        self._parallel(ps, jobs=args.jobs, fail_fast=args.fail_fast,
+                retries=args.retries, breaker=_circuit_breaker(args))
      
     def logs(self): # type: (FloopCLIType) -> None
         '''
         Print target logs to the host console
+
+        Streams the log instead of loading it, so output starts right
+        away and can be piped, e.g. floop logs -f | grep core0. Like
+        tail -f, following starts at the last lines of the log. Filters
+        by core, level, function, or time look records up in the log
+        index instead of reading the whole log. With per-core log shards
+        (shards in log.yaml), the log file and all shards are merged by
+        time; --core only reads the shard of that core. Closed log
+        segments (segments in log.yaml) are read before the live log,
+        decompressing them on the fly.
         '''
-        # TODO: add -f option (bonus if it's pipe-able)
         parser = argparse.ArgumentParser(
                 description='Logs from initialized core(s)')
         parser.add_argument('-v', '--verbose',
@@ -356,16 +636,57 @@ class FloopCLI(object):
                 action='store_true')
         parser.add_argument('-m', '--match',
                 help='Print lines that contain the match term')
+        parser.add_argument('-f', '--follow',
+                help='Keep printing new lines as they are logged, across log rotation; stop with Ctrl-C',
+                action='store_true')
+        parser.add_argument('-n', '--lines',
+                help='With --follow, start with this many of the last lines of the log instead of all of it (default: 10)',
+                type=int, default=10)
+        parser.add_argument('--core',
+                help='Print lines about this core (or the host name for host lines)')
+        parser.add_argument('--level',
+                help='Print lines at this level or more severe',
+                type=str.upper, choices=LEVELS)
+        parser.add_argument('--function',
+                help='Print lines logged by this function, e.g. push or build')
+        parser.add_argument('--since',
+                help='Print lines logged since this local time (2018-01-31 13:45:00, 2018-01-31) or this long ago (30s, 10m, 2h, 1d)',
+                type=parse_time)
+        parser.add_argument('--until',
+                help='Print lines logged until this time, same formats as --since',
+                type=parse_time)
         args = parser.parse_args(argv[self.command_index:])
         if not args.verbose:
             quiet()
-        with open('floop.log') as log:
-            for line in log.readlines():
+        match = LogFilter(args.core, args.level, args.function, args.since,
+                args.until)
+        if args.follow:
+            # shards cannot be merged while they grow; follow one at most
+            path = 'floop.log'
+            if args.core in shards(path):
+                path = shard_path(path, args.core)
+            lines = (line for line in tail(path, follow=True,
+                last=max(0, args.lines)) if match.matches(line)) # type: Iterator[str]
+        else:
+            lines = read('floop.log', match)
+        try:
+            for line in lines:
                 if args.match is not None:
-                    if args.match in line:
-                        print(line, end="")
-                elif not line == '\n':
-                    print(line, end="")
+                    if args.match not in line:
+                        continue
+                elif line == '\n':
+                    continue
+                print(line, end='')
+                if args.follow:
+                    stdout.flush()
+        except KeyboardInterrupt:
+            pass
+        except IOError as e:
+            # the reader of a pipe went away, e.g. floop logs | head
+            if e.errno != errno.EPIPE:
+                raise
+            # keep the interpreter from failing to flush stdout on exit
+            dup2(os_open(devnull, O_WRONLY), stdout.fileno())
 
     def push(self): # type: (FloopCLIType) -> None
         '''
@@ -373,18 +694,23 @@ class FloopCLI(object):
 
         Automatically synchronizes code between host and targets.
         If you delete a file in the host source, then that file will
-        be deleted on all targets.
+        be deleted on all targets. Files matched by a .floopignore in
+        the host source (same syntax as .gitignore) are not pushed.
         '''
-        # TODO: add .floopignore ?
         parser = argparse.ArgumentParser(
                 description='Push code from host to core(s)')
         parser.add_argument('-v', '--verbose',
                 help='Print system commands and results to stdout',
                 action='store_true')
+        _push_arguments(parser)
+        _fleet_arguments(parser)
+        _stage_arguments(parser, ['push'])
         args = parser.parse_args(argv[self.command_index:])
         if not args.verbose:
             quiet()
-        self._parallel(push)
+        self._parallel(push, jobs=args.jobs, relay=args.relay,
+                stages=_stage_limits(args), fail_fast=args.fail_fast,
+                retries=args.retries, breaker=_circuit_breaker(args))
 
     def build(self): # type: (FloopCLIType) -> None
         '''
@@ -400,10 +726,17 @@ class FloopCLI(object):
         parser.add_argument('-v', '--verbose',
                 help='Print system commands and results to stdout',
                 action='store_true')
+        _push_arguments(parser)
+        _build_arguments(parser)
+        _fleet_arguments(parser)
+        _stage_arguments(parser, ['push', 'build'])
         args = parser.parse_args(argv[self.command_index:])
         if not args.verbose:
             quiet()
-        self._parallel(build)
+        self._parallel(build, jobs=args.jobs, relay=args.relay,
+                build_on=args.build_on, build_cache=_build_cache(args),
+                stages=_stage_limits(args), fail_fast=args.fail_fast,
+                retries=args.retries, breaker=_circuit_breaker(args))
 
     def run(self): # type: (FloopCLIType) -> None
         '''
@@ -419,10 +752,17 @@ class FloopCLI(object):
         parser.add_argument('-v', '--verbose',
                 help='Print system commands and results to stdout',
                 action='store_true')
+        _push_arguments(parser)
+        _build_arguments(parser)
+        _fleet_arguments(parser)
+        _stage_arguments(parser, STAGES)
         args = parser.parse_args(argv[self.command_index:])
         if not args.verbose:
             quiet()
-        self._parallel(run)
+        self._parallel(run, jobs=args.jobs, relay=args.relay,
+                build_on=args.build_on, build_cache=_build_cache(args),
+                stages=_stage_limits(args), fail_fast=args.fail_fast,
+                retries=args.retries, breaker=_circuit_breaker(args))
                 
     def test(self): # type: (FloopCLIType) -> None
         '''
@@ -437,10 +777,98 @@ class FloopCLI(object):
         parser.add_argument('-v', '--verbose',
                 help='Print system commands and results to stdout',
                 action='store_true')
+        _push_arguments(parser)
+        _build_arguments(parser)
+        _fleet_arguments(parser)
+        _stage_arguments(parser, STAGES)
         args = parser.parse_args(argv[self.command_index:])
         if not args.verbose:
             quiet()
-        self._parallel(_test)
+        self._parallel(_test, jobs=args.jobs, relay=args.relay,
+                build_on=args.build_on, build_cache=_build_cache(args),
+                stages=_stage_limits(args), fail_fast=args.fail_fast,
+                retries=args.retries, breaker=_circuit_breaker(args))
+
+    def watch(self): # type: (FloopCLIType) -> None
+        '''
+        Run code on all targets, then update them whenever code changes
+
+        Watches host_source for changes (inotify, or polling where inotify
+        is not available). Changes to the Dockerfile or to files it COPYs
+        or ADDs are pushed, built, and run; any other change is pushed and
+        the running container is restarted. Containers run in the
+        background. Connections to cores stay open between updates, however
+        long, and are closed when watching stops. Stop with Ctrl-C.
+        '''
+        parser = argparse.ArgumentParser(
+                description='Run code on core(s) and update on every change')
+        parser.add_argument('-v', '--verbose',
+                help='Print system commands and results to stdout',
+                action='store_true')
+        parser.add_argument('--debounce',
+                help='Seconds without changes before updating (default: 0.2)',
+                type=float, default=0.2)
+        _build_arguments(parser)
+        _fleet_arguments(parser)
+        _stage_arguments(parser, STAGES)
+        args = parser.parse_args(argv[self.command_index:])
+        if not args.verbose:
+            quiet()
+        deploy = partial(run, detach=True)
+        refresh = partial(restart)
+        actions = dict((core.core, deploy) for core in self.cores)
+        failed = set() # type: Set[str]
+        def update(core): # type: ignore
+            action = actions.get(core.core)
+            if action is not None:
+                action(core)
+        cache = _build_cache(args)
+        breaker = _circuit_breaker(args)
+        watcher = Watcher([core.host_source for core in self.cores],
+                args.debounce)
+        # edits can be minutes apart; keep connections until watching stops
+        use_idle_timeout(None)
+        try:
+            while True:
+                start = time()
+                results = self._parallel(update, jobs=args.jobs, close=False,
+                        build_on=args.build_on, build_cache=cache,
+                        stages=_stage_limits(args), report=False, check=False,
+                        fail_fast=args.fail_fast, retries=args.retries,
+                        breaker=breaker)
+                failed = set(result.core for result in results if not result.ok)
+                if failed:
+                    print(summary([result for result in results
+                        if result.core in actions]))
+                    print('Error| Update failed, waiting for changes: {}'.format(
+                        ', '.join(sorted(failed))))
+                else:
+                    print('Updated {} core(s) in {:.2f}s'.format(
+                        len(actions), time() - start))
+                changed = watcher.wait()
+                retry, failed = failed, set()
+                actions = {}
+                for core in self.cores:
+                    if changed is None:
+                        paths = None
+                    else:
+                        paths = [rel for source, rel in changed
+                                if source == core.host_source]
+                        if not paths and core.core not in retry:
+                            continue
+                    forget_manifest(core.host_source)
+                    inputs = image_inputs(core.host_source, core.build_file)
+                    if paths is None or core.core in retry or \
+                            any(affects_image(rel, inputs) for rel in paths):
+                        actions[core.core] = deploy
+                    else:
+                        actions[core.core] = refresh
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+            close_sessions()
+            use_idle_timeout()
 
     def destroy(self): # type: (FloopCLIType) -> None
         '''
@@ -453,7 +881,9 @@ class FloopCLI(object):
         parser.add_argument('-v', '--verbose',
                 help='Print system commands and results to stdout',
                 action='store_true')
+        _fleet_arguments(parser)
         args = parser.parse_args(argv[self.command_index:])
         if not args.verbose:
             quiet()
-        self._parallel(destroy)
+        self._parallel(destroy, jobs=args.jobs, fail_fast=args.fail_fast,
+                retries=args.retries, breaker=_circuit_breaker(args))
@@ -6,7 +6,7 @@ from os import rename
 from os.path import isdir, isfile
 from distutils.spawn import find_executable as which # should be py2/py3 compatible
 from typing import Any, Dict, List, TypeVar
-from floopcli.iot.core import Core 
+from floopcli.iot.core import Core, TIMEOUTS
 
 # default config to write when using floop config 
 _FLOOP_CONFIG_DEFAULT_CONFIGURATION = {
@@ -38,6 +38,26 @@ _FLOOP_CONFIG_DEFAULT_CONFIGURATION = {
     },
 }
 
+def _merge(core_config, values): # type: (dict, dict) -> None
+    '''
+    Override core config values with more specific ones
+
+    Time budgets ("timeouts") are merged key by key, so a core can change
+    one budget and keep the others of its group
+
+    Args:
+        core_config (dict):
+            core config to update
+        values (dict):
+            config values of a group default or core
+    '''
+    for key, val in values.items():
+        if key == 'timeouts' and isinstance(val, dict):
+            timeouts = dict(core_config.get('timeouts') or {})
+            timeouts.update(val)
+            val = timeouts
+        core_config[key] = val
+
 def _flatten(config): # type: (dict) -> List[dict]
     '''
     Flatten floop configuration
@@ -59,10 +79,8 @@ def _flatten(config): # type: (dict) -> List[dict]
                 for core, dval in gval['cores'].items():
                     if core != 'default':
                         core_config = copy(default)
-                        for key, val in group_default.items():
-                            core_config[key] = val
-                        for key, val in dval.items():
-                            core_config[key] = val
+                        _merge(core_config, group_default)
+                        _merge(core_config, dval)
                         core_config['group'] = group
                         core_config['core'] = core
                         assert(core_config['address'])
@@ -186,7 +204,8 @@ class Config(object):
             :py:class:`floopcli.config.UnmetHostDependencyException`:
                 rsync and/or docker-machine binary path does not exist
             :py:class:`floopcli.config.MalformedConfigException`:
-                configuration is missing keys expected by :py:class:`floopcli.iot.core.Core`
+                configuration is missing keys expected by :py:class:`floopcli.iot.core.Core`,
+                or has unknown or invalid time budgets
 
         Returns:
             [:py:class:`floopcli.iot.core.Core`]:
@@ -206,6 +225,20 @@ class Config(object):
                                 key.replace('_bin', ''), str(val))
                         # TODO: test in an environment with unmet dependencies
                         raise UnmetHostDependencyException(err)
+        for core in self.config:
+            timeouts = core.get('timeouts') or {}
+            if not isinstance(timeouts, dict):
+                raise MalformedConfigException(
+                        '{} (core) timeouts must be an object'.format(core['core']))
+            for key, val in timeouts.items():
+                if key not in TIMEOUTS:
+                    raise MalformedConfigException(
+                            '{} (core) has unknown timeout {}'.format(core['core'], key))
+                if val is not None and (isinstance(val, bool) or
+                        not isinstance(val, (int, float)) or val <= 0):
+                    raise MalformedConfigException(
+                            '{} (core) timeout {} must be positive seconds or null'.format(
+                                core['core'], key))
         cores = []
         for core in self.config:
             try:
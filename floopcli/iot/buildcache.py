@@ -0,0 +1,217 @@
+import errno
+import json
+import os
+import tarfile
+import tempfile
+import threading
+
+from io import BytesIO
+from os.path import basename
+from typing import Any, Dict, List, Optional, Set
+
+from floopcli.iot.session import get_session
+from floopcli.util.cache import BuildCache
+from floopcli.util.syscall import quote
+
+CORE_CACHE_DIR = '.floop-buildcache'
+'''BuildKit local cache directory on cores, relative to the SSH user home'''
+
+_BUILDX_BUILDER = 'floop'
+'''Name of the buildx builder floop creates on cores'''
+
+_OCI_LAYOUT = b'{"imageLayoutVersion": "1.0.0"}'
+'''Content of the oci-layout file of a local cache directory'''
+
+_cache = [] # type: List[BuildCache]
+
+def use_build_cache(cache): # type: (Optional[BuildCache]) -> None
+    '''
+    Share BuildKit caches through cache for builds in this process
+
+    Args:
+        cache (:py:class:`floopcli.util.cache.BuildCache`):
+            host cache; None disables the shared cache
+    '''
+    del _cache[:]
+    if cache is not None:
+        _cache.append(cache)
+
+def active_build_cache(): # type: () -> Optional[BuildCache]
+    '''
+    Returns:
+        :py:class:`floopcli.util.cache.BuildCache`:
+            host cache, or None if builds do not share a cache
+    '''
+    if _cache:
+        return _cache[0]
+    return None
+
+def cache_build_command(build_file, tag, context): # type: (str, str, str) -> str
+    '''
+    Command that builds with BuildKit, importing and exporting the local cache
+
+    Creates a docker-container buildx builder on the core the first time,
+    because the default builder cannot export a local cache
+
+    Args:
+        build_file (str):
+            path of the Dockerfile on the core
+        tag (str):
+            image tag on the core
+        context (str):
+            build context directory on the core
+    Returns:
+        str:
+            shell command to run on the core
+    '''
+    return ('{{ docker buildx inspect {builder} >/dev/null 2>&1 || '
+        'docker buildx create --name {builder} --driver docker-container '
+        '>/dev/null; }} && '
+        'docker buildx build --builder {builder} --load -f {build_file} '
+        '-t {tag} --cache-from type=local,src={cache} '
+        '--cache-to type=local,dest={cache}.new,mode=max {context}/ && '
+        'rm -rf {cache} && mv {cache}.new {cache}').format(
+            builder=_BUILDX_BUILDER, build_file=build_file, tag=tag,
+            cache=CORE_CACHE_DIR, context=context)
+
+def _core_blobs(session): # type: (Any) -> Set[str]
+    out = session.run('ls {}/blobs/sha256 2>/dev/null || true'.format(
+        CORE_CACHE_DIR), check=True)
+    return set('sha256:' + name for name in out.split())
+
+def import_cache(core, cache, platform): # type: (Any, BuildCache, str) -> int
+    '''
+    Seed the local cache of a core with the host cache of its platform
+
+    Only blobs the core does not have yet are sent. The tar stream is
+    written straight into ssh, so nothing is staged on the host. The
+    blobs of the index are pinned until the transfer ends, so other
+    cores cannot evict them while they are read.
+
+    Args:
+        core (:py:class:`floopcli.iot.core.Core`):
+            initialized target core object
+        cache (:py:class:`floopcli.util.cache.BuildCache`):
+            host cache
+        platform (str):
+            Docker platform of core
+    Returns:
+        int:
+            number of blob bytes sent
+    Raises:
+        :py:class:`floopcli.util.syscall.SystemCallException`:
+            transfer failed
+        :py:class:`IOError`:
+            reading the host cache failed
+    '''
+    index = cache.index(platform)
+    if index is None:
+        return 0
+    needed = cache.referenced(index)
+    if not needed:
+        return 0
+    with cache.pinned(needed):
+        if not needed <= cache.digests(): # evicted before it was pinned
+            return 0
+        cache.touch(sorted(needed))
+        return _send_blobs(core, cache, index, needed)
+
+def _send_blobs(core, cache, index, needed):
+    # type: (Any, BuildCache, Dict[str, Any], Set[str]) -> int
+    session = get_session(core)
+    missing = sorted(needed - _core_blobs(session))
+    sizes = [os.path.getsize(cache.blob_path(digest)) for digest in missing]
+    read_fd, write_fd = os.pipe()
+    errors = [] # type: List[EnvironmentError]
+    def write(): # type: () -> None
+        try:
+            with os.fdopen(write_fd, 'wb') as f:
+                with tarfile.open(fileobj=f, mode='w|') as archive:
+                    for name, data in [('oci-layout', _OCI_LAYOUT),
+                            ('index.json', json.dumps(index).encode('utf-8'))]:
+                        info = tarfile.TarInfo(name)
+                        info.size = len(data)
+                        archive.addfile(info, BytesIO(data))
+                    for digest in missing:
+                        archive.add(cache.blob_path(digest),
+                            arcname='blobs/sha256/{}'.format(digest.split(':')[1]))
+        except (IOError, OSError) as e:
+            # ssh exited early; its own error is raised instead
+            if e.errno != errno.EPIPE:
+                errors.append(e)
+    writer = threading.Thread(target=write)
+    writer.daemon = True
+    writer.start()
+    try:
+        with os.fdopen(read_fd, 'rb') as f:
+            session.run('mkdir -p {0} && tar -xf - -C {0}'.format(CORE_CACHE_DIR),
+                    check=True, stdin=f)
+    finally:
+        writer.join()
+    if errors:
+        raise errors[0]
+    return sum(sizes)
+
+def export_cache(core, cache, platform): # type: (Any, BuildCache, str) -> int
+    '''
+    Collect the local cache of a core into the host cache of its platform
+
+    Only blobs the host does not have yet are fetched; every blob is
+    checked against its digest. The blobs of the core are pinned until
+    its index is stored, then least recently used blobs are evicted.
+
+    Args:
+        core (:py:class:`floopcli.iot.core.Core`):
+            initialized target core object
+        cache (:py:class:`floopcli.util.cache.BuildCache`):
+            host cache
+        platform (str):
+            Docker platform of core
+    Returns:
+        int:
+            number of blob bytes received
+    Raises:
+        :py:class:`floopcli.util.syscall.SystemCallException`:
+            core has no local cache or transfer failed
+    '''
+    session = get_session(core)
+    blobs = _core_blobs(session)
+    # blobs the host already has are pinned as well, the index needs them
+    with cache.pinned(blobs):
+        received = _fetch_blobs(session, cache, platform,
+                sorted(blobs - cache.digests()))
+    cache.evict()
+    return received
+
+def _fetch_blobs(session, cache, platform, missing):
+    # type: (Any, BuildCache, str, List[str]) -> int
+    fetch = ' '.join(quote('blobs/sha256/{}'.format(digest.split(':')[1]))
+            for digest in missing)
+    fd, path = tempfile.mkstemp(dir=cache.tmp_dir())
+    received = 0
+    index = None
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            session.run('cd {} && tar -cf - index.json {}'.format(
+                CORE_CACHE_DIR, fetch), check=True, output=f)
+        with tarfile.open(path) as archive:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                data = archive.extractfile(member)
+                if member.name == 'index.json':
+                    index = json.loads(data.read().decode('utf-8')) # type: ignore
+                    continue
+                if not member.name.startswith('blobs/sha256/'):
+                    continue
+                blob_fd, blob_path = tempfile.mkstemp(dir=cache.tmp_dir())
+                with os.fdopen(blob_fd, 'wb') as blob:
+                    for chunk in iter(lambda: data.read(1048576), b''): # type: ignore
+                        blob.write(chunk)
+                if cache.add('sha256:' + basename(member.name), blob_path):
+                    received += member.size
+    finally:
+        os.remove(path)
+    if index is not None:
+        cache.set_index(platform, index)
+    return received
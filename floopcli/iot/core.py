@@ -1,13 +1,31 @@
 import logging
 import sys
 import os
-import signal
 
-from os.path import isfile, isdir, expanduser
+from os.path import abspath, basename, dirname, isfile, isdir, expanduser
 from subprocess import check_output
-from typing import TypeVar, List
-
-from floopcli.util.syscall import syscall, SystemCallException
+from uuid import uuid4
+from typing import Any, Dict, List, Optional, Tuple, TypeVar
+
+from floopcli.iot.buildcache import active_build_cache, cache_build_command, \
+        export_cache, import_cache
+from floopcli.iot.image import active_build_plan, active_builder, \
+        core_platform, core_resources, deliver_image, image_key, image_tag, \
+        GroupBuildPlan
+from floopcli.iot.machine import store
+from floopcli.iot.relay import active_plan, add_agent_key, archive_digest, \
+        forward_command, receive_command, ssh_command, RelayPlan
+from floopcli.iot.script import RemoteScript, StepResult
+from floopcli.iot.result import record_bytes, record_step
+from floopcli.iot.session import get_session, SSHConnectionException, \
+        SSH_ERROR
+from floopcli.iot.stage import limited, Stage, STAGES
+from floopcli.util.ignore import IgnoreMatcher
+from floopcli.util.manifest import Manifest, DELTA_DELETE_FILE, \
+        delta_archive, push_target, pushed_manifest, source_manifest
+from floopcli.util.state import clear_core_state, read_core_state, \
+        update_core_state
+from floopcli.util.syscall import syscall, quote, Budget, SystemCallException
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +39,19 @@ def verbose(): # type: () -> bool
     '''
     return 'console' in [h.name for h in logging.getLogger().handlers[:]] #type: ignore
 
+TIMEOUTS = STAGES + ['command', 'operation']
+'''
+Time budgets a core config can set under "timeouts", in seconds: the
+total time of one pass through each stage, the time of any single
+command, and the time of a whole core operation (e.g. floop run)
+'''
+
+DEFAULT_TIMEOUTS = {
+    'push': 1800,
+    'build': 7200,
+    } # type: Dict[str, Optional[float]]
+'''Budgets that apply unless a core config overrides them (null disables)'''
+
 class CannotSetImmutableAttribute(Exception):
     '''
     Tried to set immutable attribute after initialization
@@ -65,7 +96,13 @@ class CoreTestFileNotFound(Exception):
 
 class CoreCommunicationException(Exception):
     '''
-    Cannot communicate with core via docker-machine SSH
+    Cannot communicate with core via SSH
+    '''
+    pass
+
+class CoreUnreachableException(CoreCommunicationException):
+    '''
+    SSH could not reach the core or lost the connection
     '''
     pass
 
@@ -125,8 +162,9 @@ class Core(object):
             hardware_devices,
             core,
             user,
+            timeouts=None,
             **kwargs): 
-        # type: (CoreType, str, str, str, str, str, str, str, str, str, str, str, bool, str, str, str, str) -> None
+        # type: (CoreType, str, str, str, str, str, str, bool, str, str, str, str, bool, str, List[str], str, str, Optional[Dict[str, Optional[float]]], **Any) -> None
 
         self.address = address
         '''Core IP address (reachable by SSH)'''
@@ -162,6 +200,8 @@ class Core(object):
         '''
         self.user = user
         '''Core SSH user on the target'''
+        self.timeouts = timeouts
+        '''Seconds per budget (see :py:data:`TIMEOUTS`) on top of :py:data:`DEFAULT_TIMEOUTS`'''
 
     @property
     def address(self): # type: (CoreType) -> str
@@ -320,6 +360,29 @@ class Core(object):
             raise CannotSetImmutableAttribute('test_file')
         self.__test_file = value 
 
+    @property
+    def timeouts(self): # type: (CoreType) -> Dict[str, Optional[float]]
+        return self.__timeouts
+
+    @timeouts.setter
+    def timeouts(self, value): # type: (CoreType, Optional[Dict[str, Optional[float]]]) -> None
+        '''
+        Time budgets setter
+
+        Args:
+            value (dict):
+                budget name to seconds; None disables a default budget;
+                None instead of a dict keeps all defaults
+        Raises:
+            :py:class:`floopcli.core.iot.CannotSetImmutableAttribute`:
+                attempting to modify the timeouts attribute after initialization will fail
+        '''
+        if hasattr(self, 'timeouts'):
+            raise CannotSetImmutableAttribute('timeouts')
+        timeouts = dict(DEFAULT_TIMEOUTS)
+        timeouts.update(value or {})
+        self.__timeouts = timeouts
+
     @property
     def core(self): # type: (CoreType) -> str
         return self.__core
@@ -357,7 +420,10 @@ class Core(object):
             check=True,
             verbose=False): # type: (CoreType, str, bool, bool) -> str
         '''
-        Run docker-machine SSH command on target core
+        Run SSH command on target core
+
+        Commands reuse one persistent SSH connection per core, see
+        :py:class:`floopcli.iot.session.SSHSession`
 
         Args:
             command (str):
@@ -371,10 +437,37 @@ class Core(object):
             :py:class:`floopcli.util.syscall.SystemCallException`:
                 SSH command exit code was non-zero
         '''
-        sys_string = '{} ssh {} {}'.format(
-            self.host_docker_machine_bin, self.core, command)
-        out, _ = syscall(sys_string, check=check, verbose=verbose)
-        return out
+        return get_session(self).run(command, check=check, verbose=verbose)
+
+    def run_ssh_script(self,
+            steps,
+            verbose=False): # type: (CoreType, List[str], bool) -> List[StepResult]
+        '''
+        Run a sequence of commands on target core in one SSH round trip
+
+        Stops at the first command that returns non-zero exit code
+
+        Args:
+            steps ([str]):
+                commands to run on target core, in order
+            verbose (bool):
+                if True, stream command output to stdout
+        Returns:
+            [:py:class:`floopcli.iot.script.StepResult`]:
+                exit code, output, and duration of every step; steps that
+                never ran have returncode None
+        Raises:
+            :py:class:`floopcli.iot.core.CoreUnreachableException`:
+                the script never started, e.g. SSH could not reach the core
+        '''
+        script = RemoteScript(steps, verbose=verbose)
+        get_session(self).run(script.render(), check=False,
+                sink=script, capture=False)
+        results = script.finish()
+        if results and results[0].returncode is None:
+            raise CoreUnreachableException(
+                    'Remote script did not start on {}'.format(self.core))
+        return results
 
 def __log(core, level, message): # type: (Core, str, str) -> None
     '''
@@ -400,8 +493,8 @@ def __log(core, level, message): # type: (Core, str, str) -> None
             getattr(logger, level)(line)
 
 ###  parallelizable methods that act on Core objects
-# these functions are pickle-able, but class methods are NOT
-# so these functions can be passed to multiprocessing.Pool
+# these functions are mapped over cores by the CLI fan-out, which runs
+# them in threads of a single process, so avoid signals and process state
 def create(core, check=True, timeout=240): # type: (Core, bool, int) -> None
     '''
     Parallelizable; create new docker-machine on target core
@@ -413,15 +506,14 @@ def create(core, check=True, timeout=240): # type: (Core, bool, int) -> None
             if True, check core creation succeeded by running
             'pwd' via docker-machine SSH on newly created core
         timeout (int):
-            time in seconds to wait for success before throwing error
-            (docker-machine create timeout is too long)
+            time in seconds for docker-machine create and the checks
+            together before throwing error (docker-machine create
+            timeout is too long)
     Raises:
         :py:class:`floopcli.core.iot.CoreCreateException`:
             core creation failed during docker-machine create or
             'pwd' check failed
     '''
-    def timeout_handler(signum, frame): #type: ignore
-        raise CoreCreateException('Create core timed out')
     create_command = '{} create --driver generic --generic-ip-address {} --generic-ssh-port {} --generic-ssh-user {} --generic-ssh-key {} --engine-storage-driver overlay {}'.format(
         core.host_docker_machine_bin,
         core.address, 
@@ -430,25 +522,146 @@ def create(core, check=True, timeout=240): # type: (Core, bool, int) -> None
         core.host_key, 
         core.core)
     __log(core, 'info', create_command)
-    signal.signal(signal.SIGALRM, timeout_handler)
-    signal.alarm(timeout)
+    # a new machine has none of what was pushed or built before
+    clear_core_state(core.core)
     try:
-        out, err = syscall(create_command, check=False, verbose=verbose())
-        __log(core, 'info', out)
-        if check:
-            check_command = 'pwd'
-            __log(core, 'info', 'Checking with {}'.format(check_command))
-            outd = core.run_ssh_command('pwd', check=check)
-            __log(core, 'info', outd)
+        with Budget('create', timeout):
+            out, err = syscall(create_command, check=False, verbose=verbose())
+            __log(core, 'info', out)
+            if check:
+                check_command = 'pwd'
+                __log(core, 'info', 'Checking with {}'.format(check_command))
+                outd = core.run_ssh_command('pwd', check=check)
+                __log(core, 'info', outd)
+                # group builds pick the strongest core without asking again
+                cpus, memory = core_resources(core, refresh=True)
+                __log(core, 'info', 'Resources: {} CPUs, {} bytes memory'.format(
+                    cpus, memory))
     except SystemCallException as e:
         __log(core, 'error', 'Create timed out')
         raise CoreCreateException(repr(e))
 
+def _rsync_base(core): # type: (Core) -> Tuple[str, str]
+    '''
+    Split host source into the directory rsync paths are relative to and
+    the prefix rsync puts in front of them on the target
+
+    rsync copies the contents of a source ending in / but the directory
+    itself otherwise, so explicit file lists must follow the same rule
+
+    Args:
+        core (:py:class:`floopcli.iot.core.Core`):
+            initialized target core object
+    Returns:
+        (str, str):
+            base directory and path prefix
+    '''
+    if core.host_source.endswith('/'):
+        return core.host_source, ''
+    source = abspath(core.host_source)
+    return dirname(source), basename(source) + '/'
+
+def _relay(core, plan, manifest, previous): # type: (Core, RelayPlan, Manifest, Optional[Manifest]) -> bool
+    '''
+    Push the change set to core through a relay tree
+
+    Seeds receive the archive from the host; every other core receives
+    it from its parent core. Each receiver verifies the archive hash
+    before applying it and keeps a copy to forward to its own children.
+
+    Args:
+        core (:py:class:`floopcli.iot.core.Core`):
+            initialized target core object
+        plan (:py:class:`floopcli.iot.relay.RelayPlan`):
+            active relay plan that covers core
+        manifest (:py:class:`floopcli.util.manifest.Manifest`):
+            current manifest of host_source
+        previous (:py:class:`floopcli.util.manifest.Manifest`):
+            manifest last pushed to core, or None; without one, the whole
+            manifest is sent and nothing is deleted on the target
+    Returns:
+        bool:
+            if True, core received and applied a verified archive
+    '''
+    if previous is None:
+        previous = Manifest({})
+    base, prefix = _rsync_base(core)
+    archive = delta_archive(base, prefix, manifest, previous)
+    digest = archive_digest(archive)
+    receive = receive_command(digest, core.target_source, DELTA_DELETE_FILE)
+    parent = plan.parent(core)
+    # also removes what a failed transfer left behind
+    plan.hold(core, digest)
+    try:
+        session = get_session(core)
+        if parent is None:
+            __log(core, 'info', 'Relay seed, sending {} from host'.format(archive))
+            with Stage('push', core), open(archive, 'rb') as f:
+                out = session.run(receive, check=True, stdin=f)
+            record_bytes(os.path.getsize(archive))
+        else:
+            if not plan.wait(parent):
+                __log(core, 'error', 'Relay parent {} failed'.format(parent.core))
+                return False
+            agent = add_agent_key(session.key)
+            forward = forward_command(session, digest, receive)
+            __log(core, 'info', 'Relay from {}: {}'.format(parent.core, forward))
+            out = get_session(parent).run(forward, check=True, agent=agent)
+        __log(core, 'info', out)
+        return True
+    except SystemCallException as e:
+        __log(core, 'error', 'Relay failed, pushing from host: {}'.format(repr(e)))
+        return False
+
+def _record_push(core, manifest): # type: (Core, Manifest) -> None
+    '''
+    Finish a successful push: generate .dockerignore and record the manifest
+
+    If host_source has no .dockerignore of its own, the .floopignore
+    rules are written to .dockerignore on the target so ignored files
+    are not sent to the docker daemon as build context either
+
+    Args:
+        core (:py:class:`floopcli.iot.core.Core`):
+            initialized target core object
+        manifest (:py:class:`floopcli.util.manifest.Manifest`):
+            manifest that was pushed
+    Raises:
+        :py:class:`floopcli.util.syscall.SystemCallException`:
+            .dockerignore could not be written on target
+    '''
+    if not isfile('{}/.dockerignore'.format(core.host_source)):
+        content = IgnoreMatcher.load(core.host_source).dockerignore()
+        ignore_command = 'printf %s {} > {}/.dockerignore'.format(
+                quote(content), quote(core.target_source))
+        __log(core, 'info', ignore_command)
+        get_session(core).run(ignore_command, check=True)
+    manifest.save()
+    update_core_state(core.core, manifest=manifest.digest,
+            target=push_target(core))
+
 def push(core, check=True): # type: (Core, bool) -> None
     '''
     Parallelizable; push files from host to target core 
 
-    Ignores floop.log and floop.json
+    Ignores floop.log, floop.json, the .floop state directory, and
+    everything matched by a .floopignore file in host_source (same syntax
+    as .gitignore). Unless host_source has its own .dockerignore, the
+    .floopignore rules are also applied to the build context on target.
+
+    Skips the core entirely if the content manifest of host_source matches
+    the manifest of the last successful push to this core at its current
+    address and target source. If the last manifest is known, streams a
+    delta archive of changed files that is built once and shared by all
+    cores with the same last manifest.
+    Cores without a record, or where the delta fails, get a full rsync.
+    Remove .floop/cores/<core>.json on the host to force a full sync.
+
+    If a relay plan is active (floop push --relay), cores receive the
+    archive from other cores instead, see :py:func:`_relay`.
+
+    Transfers from the host hold a slot of the push stage, see
+    :py:class:`floopcli.iot.stage.Stage`; relays between cores do not.
 
     Args:
         core (:py:class:`floopcli.core.iot.Core`):
@@ -467,20 +680,331 @@ def push(core, check=True): # type: (Core, bool) -> None
     if not isdir(core.host_source):
         __log(core, 'error', 'Source not found: {}'.format(core.host_source))
         raise CoreSourceNotFound(core.host_source)
+    manifest = source_manifest(core.host_source)
+    last = pushed_manifest(core)
+    if last == manifest.digest:
+        __log(core, 'info', 'Target source is up to date: {}'.format(last))
+        return
+    previous = None
+    if last is not None:
+        previous = Manifest.load(last)
+    plan = active_plan()
+    relayed = False
+    if plan is not None and plan.covers(core):
+        try:
+            relayed = _relay(core, plan, manifest, previous)
+        finally:
+            plan.done(core, relayed)
     try:
-        mkdir_string = 'mkdir -p {}'.format(core.target_source)
-        __log(core, 'info', mkdir_string)
-        out = core.run_ssh_command(mkdir_string, check=True)
-        __log(core, 'info', out)
-        sync_string = "rsync -avhz -e '{} ssh' {} {}:'{}' --exclude=floop.log --exclude=floop.json --delete".format(core.host_docker_machine_bin, core.host_source,
-            core.core, core.target_source)
-        __log(core, 'info', sync_string)
-        out, err = syscall(sync_string, check=check)
+        if relayed:
+            _record_push(core, manifest)
+            return
+        session = get_session(core)
+        if previous is not None:
+            # every core that last got the same manifest gets the same bytes
+            base, prefix = _rsync_base(core)
+            archive = delta_archive(base, prefix, manifest, previous)
+            delta_command = ('mkdir -p {0} && tar -xzf - -C {0} && cd {0} && '
+                '{{ xargs -0 rm -rf -- < {1} && rm -f {1}; }}').format(
+                        quote(core.target_source), DELTA_DELETE_FILE)
+            __log(core, 'info', 'Sending {} ({} bytes): {}'.format(
+                archive, os.path.getsize(archive), delta_command))
+            try:
+                with Stage('push', core), open(archive, 'rb') as f:
+                    out = session.run(delta_command, check=True, stdin=f)
+                record_bytes(os.path.getsize(archive))
+                __log(core, 'info', out)
+                _record_push(core, manifest)
+                return
+            except SystemCallException as e:
+                __log(core, 'error', 'Delta push failed, using rsync: {}'.format(
+                    repr(e)))
+        _, prefix = _rsync_base(core)
+        # create target_source in the same round trip as the sync
+        sync_command = [core.host_rsync_bin, '-avhz',
+                '-e', session.rsync_shell(),
+                '--rsync-path', 'mkdir -p {} && rsync'.format(
+                    quote(core.target_source)),
+                core.host_source,
+                '{}:{}'.format(session.destination(), core.target_source),
+                # keep a generated .dockerignore from being deleted
+                '--filter=P /{}.dockerignore'.format(prefix)] + \
+                IgnoreMatcher.load(core.host_source).rsync_filters(prefix) + \
+                ['--delete']
+        __log(core, 'info', ' '.join(sync_command))
+        with Stage('push', core):
+            out, err = syscall(sync_command, check=check)
         __log(core, 'info', out)
+        # without check there is no way to tell if the sync succeeded
+        if check:
+            _record_push(core, manifest)
     except SystemCallException as e:
         __log(core, 'error', repr(e))
+        # rsync exits with the code of ssh if ssh fails
+        if e.returncode == SSH_ERROR:
+            raise CoreUnreachableException(repr(e))
         raise CoreCommunicationException(repr(e))
 
+def _build_command(core, build_file=None, tag='floop'): # type: (Core, Optional[str], str) -> str
+    '''
+    Check that the build file exists and make the target build command
+
+    If the core already built an image from the same build file, source
+    manifest, and platform, and the image still exists, the command only
+    tags that image. With the host builder active (floop build --build-on
+    host), the image is cross-built on the host and delivered to the core
+    here, and the command only tags the delivered image.
+
+    Args:
+        core (:py:class:`floopcli.iot.core.Core`):
+            initialized target core object
+        build_file (str):
+            Dockerfile name relative to source; defaults to core.build_file
+        tag (str):
+            image tag on target core
+    Raises:
+        :py:class:`floopcli.iot.core.CoreBuildFileNotFound`:
+            no Dockerfile in source code directory on host
+        :py:class:`floopcli.iot.core.CoreBuildException`:
+            core platform could not be detected, or host build or image
+            transfer failed
+    Returns:
+        str:
+            docker build (or tag) command to run on target core; prints
+            the image ID last
+    '''
+    if build_file is None:
+        build_file = core.build_file
+    host_build_file = '{}/{}'.format(core.host_source, build_file)
+    if not isfile(host_build_file) or build_file is None:
+        __log(core, 'error', 'Core build file not found: {}'.format(host_build_file))
+        raise CoreBuildFileNotFound(host_build_file)
+    try:
+        builder = active_builder()
+        if builder == 'host':
+            with Stage('build', core):
+                image, sent, saved = deliver_image(core, build_file)
+            record_bytes(sent)
+            __log(core, 'info', 'Image {}: sent {} bytes, {} layer bytes already on core'.format(
+                image, sent, saved))
+            command = 'docker tag {} {}'.format(image, tag)
+        else:
+            plan = active_build_plan()
+            if builder == 'group' and plan is not None and plan.covers(core):
+                _group_build(core, plan, build_file)
+            command = _core_build_command(core, build_file, tag)
+    except SSHConnectionException as e:
+        __log(core, 'error', repr(e))
+        raise CoreUnreachableException(repr(e))
+    except SystemCallException as e:
+        __log(core, 'error', 'Build preparation failed: {}'.format(repr(e)))
+        raise CoreBuildException(repr(e))
+    return _with_image_id(command, tag)
+
+_BUILD_MARK = 'FLOOP_BUILD'
+'''Environment variable that marks the docker builds floop starts on a core'''
+
+def _marked(command): # type: (str) -> str
+    '''
+    Run command in a subshell that exports a floop marker, so every
+    process it starts (e.g. the docker client) can be told apart from
+    builds floop did not start, see :py:func:`cancel`
+    '''
+    return '( export {}=__FLOOP_{}__; {} )'.format(_BUILD_MARK, uuid4().hex,
+            command)
+
+def _core_build_command(core, build_file, tag): # type: (Core, str, str) -> str
+    '''
+    Make the command that builds an image on the core itself
+
+    With a shared build cache active, the core builds with BuildKit and
+    first receives the cache other cores of its platform left on the host
+
+    Args:
+        core (:py:class:`floopcli.iot.core.Core`):
+            initialized target core object
+        build_file (str):
+            Dockerfile name relative to source
+        tag (str):
+            image tag on target core
+    Returns:
+        str:
+            docker build command, or a docker tag command with a docker
+            build fallback if the core built the same key before
+    Raises:
+        :py:class:`floopcli.util.syscall.SystemCallException`:
+            core platform could not be detected
+    '''
+    target_build_file = '{}/{}'.format(core.target_source, build_file)
+    platform = core_platform(core)
+    cache = active_build_cache()
+    if cache is None:
+        command = 'docker build -f {} -t {} {}/'.format(
+                target_build_file, tag, core.target_source)
+    else:
+        command = cache_build_command(target_build_file, tag, core.target_source)
+    command = _marked(command)
+    key = image_key(platform, core.host_source, build_file)
+    built = read_core_state(core.core).get('builds', {}).get(build_file)
+    if built is not None and built[0] == key:
+        # tagging fails if the image was removed, then build as usual
+        return 'docker tag {} {} 2>/dev/null || {}'.format(
+                built[1], tag, command)
+    if cache is not None:
+        try:
+            sent = import_cache(core, cache, platform)
+            record_bytes(sent)
+            __log(core, 'info', 'Build cache: sent {} bytes'.format(sent))
+        except SystemCallException as e:
+            __log(core, 'error', 'Build cache import failed: {}'.format(repr(e)))
+    return command
+
+def _with_image_id(command, tag): # type: (str, str) -> str
+    '''
+    Returns:
+        str:
+            command followed by printing the image ID of tag, so the next
+            build with the same key can be skipped
+    '''
+    return "{{ {}; }} && docker image inspect --format '{{{{.Id}}}}' {}".format(
+            command, tag)
+
+def _group_build(core, plan, build_file): # type: (Core, GroupBuildPlan, str) -> None
+    '''
+    Build the image once per group and relay it core-to-core
+
+    The builder core of the group builds the image; every other core
+    waits for its parent in the plan, which pipes docker save straight
+    into docker load on this core. Afterwards the core holds the image
+    under the build key, so the normal build command only tags it. If
+    the parent failed, the core builds on its own.
+
+    Args:
+        core (:py:class:`floopcli.iot.core.Core`):
+            initialized target core object
+        plan (:py:class:`floopcli.iot.image.GroupBuildPlan`):
+            active group build plan that covers core
+        build_file (str):
+            Dockerfile name relative to source
+    Raises:
+        :py:class:`floopcli.util.syscall.SystemCallException`:
+            core platform could not be detected
+    '''
+    key = image_key(core_platform(core), core.host_source, build_file)
+    key_tag = image_tag(key)
+    parent = plan.parent(core)
+    ok = False
+    try:
+        if parent is None:
+            __log(core, 'info', 'Group builder for {}'.format(build_file))
+            command = _with_image_id(
+                    _core_build_command(core, build_file, key_tag), key_tag)
+            with Stage('build', core):
+                out = core.run_ssh_command(command, check=True, verbose=verbose())
+            __log(core, 'info', out)
+            _record_build(core, build_file, out)
+            ok = True
+        elif not plan.wait(parent):
+            __log(core, 'error', 'Group builder {} failed, building here'.format(
+                parent.core))
+        else:
+            session = get_session(core)
+            built = read_core_state(core.core).get('builds', {}).get(build_file)
+            try:
+                if built is None or built[0] != key:
+                    raise SystemCallException('Image not on core')
+                # also checks that the image still exists
+                session.run('docker tag {} {}'.format(built[1], key_tag), check=True)
+                __log(core, 'info', 'Image {} already on core'.format(key_tag))
+            except SystemCallException:
+                agent = add_agent_key(session.key)
+                forward = 'docker save {} | {}'.format(key_tag,
+                        ssh_command(session, 'docker load'))
+                __log(core, 'info', 'Image from {}: {}'.format(parent.core, forward))
+                out = get_session(parent).run(forward, check=True, agent=agent)
+                __log(core, 'info', out)
+                _record_build(core, build_file, session.run(
+                    "docker image inspect --format '{{.Id}}' " + key_tag, check=True))
+            ok = True
+    except SystemCallException as e:
+        __log(core, 'error', 'Group build failed: {}'.format(repr(e)))
+    finally:
+        plan.done(core, ok)
+
+def _record_build(core, build_file, output): # type: (Core, str, str) -> None
+    '''
+    Record the image ID reported by a successful build command
+
+    With a shared build cache active, also collects the new BuildKit
+    cache of the core on the host
+
+    Args:
+        core (:py:class:`floopcli.iot.core.Core`):
+            initialized target core object
+        build_file (str):
+            Dockerfile name relative to source
+        output (str):
+            output of the command from :py:func:`_build_command`
+    '''
+    lines = output.strip().splitlines()
+    if not lines or not lines[-1].startswith('sha256:'):
+        return
+    platform = core_platform(core)
+    key = image_key(platform, core.host_source, build_file)
+    builds = read_core_state(core.core).get('builds', {})
+    builds[build_file] = [key, lines[-1].strip()]
+    update_core_state(core.core, builds=builds)
+    cache = active_build_cache()
+    if cache is not None and active_builder() != 'host':
+        try:
+            received = export_cache(core, cache, platform)
+            record_bytes(received)
+            __log(core, 'info', 'Build cache: received {} bytes'.format(received))
+        except SystemCallException as e:
+            __log(core, 'error', 'Build cache export failed: {}'.format(repr(e)))
+
+def _run_stages(core, stages): # type: (Core, List[Tuple[str, List[str]]]) -> List[StepResult]
+    '''
+    Run the remote steps of a core operation, holding a slot per stage
+
+    Without stage limits all steps go to the core as one remote script.
+    Otherwise every stage is its own round trip, so the core gives up its
+    build slot before its container starts.
+
+    Args:
+        core (:py:class:`floopcli.iot.core.Core`):
+            initialized target core object
+        stages ([(str, [str])]):
+            stage name and commands, in order
+    Returns:
+        [:py:class:`floopcli.iot.script.StepResult`]:
+            results of the steps that were sent to the core, see
+            :py:meth:`Core.run_ssh_script`
+    '''
+    if not limited(*[name for name, _ in stages]):
+        # one round trip gets the budgets of all its stages, if all have one
+        budgets = [core.timeouts.get(name) for name, _ in stages]
+        seconds = None
+        if None not in budgets:
+            seconds = sum(budgets) # type: ignore
+        with Budget('+'.join(name for name, _ in stages), seconds):
+            script = core.run_ssh_script(
+                    [command for _, commands in stages for command in commands],
+                    verbose=verbose())
+        idx = 0
+        for name, commands in stages:
+            record_step(name, sum(step.duration
+                for step in script[idx:idx + len(commands)]))
+            idx += len(commands)
+        return script
+    steps = [] # type: List[StepResult]
+    for name, commands in stages:
+        with Stage(name, core):
+            steps += core.run_ssh_script(commands, verbose=verbose())
+        if not all(step.ok for step in steps):
+            break
+    return steps
+
 def build(core, check=True): # type: (Core, bool) -> None
     '''
     Parallelizable; push then build files from host on target core 
@@ -498,61 +1022,102 @@ def build(core, check=True): # type: (Core, bool) -> None
         :py:class:`floopcli.iot.core.CoreBuildException`:
             build commands returned non-zero exit code
     '''
-
-    host_build_file = '{}/{}'.format(core.host_source, core.build_file)
-    if not isfile(host_build_file) or core.build_file is None:
-        __log(core, 'error', 'Core build file not found: {}'.format(host_build_file))
-        raise CoreBuildFileNotFound(host_build_file)
-    target_build_file = '{}/{}'.format(core.target_source, core.build_file)
     push(core)
-    meta_build_command = 'docker build -f {} -t floop {}/'.format(
-            target_build_file, core.target_source)
+    meta_build_command = _build_command(core)
     __log(core, 'info', meta_build_command)
     try:
-        out = core.run_ssh_command(meta_build_command, check=check, verbose=verbose())
+        with Stage('build', core):
+            out = core.run_ssh_command(meta_build_command, check=check,
+                    verbose=verbose())
         __log(core, 'info', out)
+        _record_build(core, core.build_file, out)
+    except SSHConnectionException as e:
+        __log(core, 'error', repr(e))
+        raise CoreUnreachableException(repr(e))
     except (SystemCallException, CoreBuildException) as e:
         __log(core, 'error', repr(e))
         raise CoreBuildException(repr(e))
 
-def run(core, check=True): # type: (Core, bool) -> None
+def run(core, check=True, detach=False): # type: (Core, bool, bool) -> None
     '''
     Parallelizable; push, build, then run files from host on target core 
 
+    Build, container removal, and run go to the core as one remote script
+
     Args:
         core (:py:class:`floopcli.iot.core.Core`):
             initialized target core object
         check (bool):
             if True, check core creation succeeded by running
             'pwd' via docker-machine SSH on newly created core
+        detach (bool):
+            if True, start the container in the background instead of
+            waiting for it to exit
     Raises:
-        :py:class:`floopcli.iot.core.CoreCommunicationException`:
-            could not communicate from host to core to remove runtime container
+        :py:class:`floopcli.iot.core.CoreBuildException`:
+            build commands returned non-zero exit code
         :py:class:`floopcli.iot.core.CoreRunException`:
             run commands returned non-zero exit code
     '''
-
-    build(core)
+    push(core)
+    meta_build_command = _build_command(core)
     rm_command = 'docker rm -f floop || true'
-    __log(core, 'info', rm_command)
+    run_command = 'docker run --name floop -v {}:/floop/'.format(
+            core.target_source)
+    if detach:
+        run_command = '{} -d'.format(run_command)
+    if core.privileged:
+        run_command = '{} --privileged'.format(run_command)
+        if core.docker_socket != '':
+            run_command = '{} -v {}:/var/run/docker.sock'.format(
+                    run_command, core.docker_socket)
+        if core.host_network:
+            run_command = '{} --network host'.format(run_command)
+    for device in core.hardware_devices:
+        run_command = '{} --device {}'.format(run_command, device)
+    run_command = '{} floop'.format(run_command)
+    steps = _run_stages(core,
+            [('build', [meta_build_command]), ('run', [rm_command, run_command])])
+    if steps[0].ok:
+        _record_build(core, core.build_file, steps[0].output)
+    for step in steps:
+        __log(core, 'info', step.command)
+        __log(core, 'info', step.output)
+        if not step.ok:
+            __log(core, 'error', 'Exit code {}'.format(step.returncode))
+            if not check:
+                break
+            if step.command == meta_build_command:
+                raise CoreBuildException(step.output)
+            raise CoreRunException(step.output)
+
+def restart(core, check=True): # type: (Core, bool) -> None
+    '''
+    Parallelizable; push files from host then restart the running container
+
+    For changes that do not affect the image: target_source is mounted
+    into the container, so a restart picks up the pushed files without
+    a build
+
+    Args:
+        core (:py:class:`floopcli.iot.core.Core`):
+            initialized target core object
+        check (bool):
+            if True, raise if the restart fails
+    Raises:
+        :py:class:`floopcli.iot.core.CoreRunException`:
+            restart command returned non-zero exit code
+    '''
+    push(core)
+    restart_command = 'docker restart floop'
+    __log(core, 'info', restart_command)
     try:
-        out = core.run_ssh_command(command=rm_command, check=check, verbose=verbose())
-        __log(core, 'info', out)
-        run_command = 'docker run --name floop -v {}:/floop/'.format(
-                core.target_source)
-        if core.privileged:
-            run_command = '{} --privileged'.format(run_command)
-            if core.docker_socket != '':
-                run_command = '{} -v {}:/var/run/docker.sock'.format(
-                        run_command, core.docker_socket)
-            if core.host_network:
-                run_command = '{} --network host'.format(run_command)
-        for device in core.hardware_devices:
-            run_command = '{} --device {}'.format(run_command, device)
-        run_command = '{} floop'.format(run_command)
-        __log(core, 'info', run_command)
-        out = core.run_ssh_command(command=run_command, check=check, verbose=verbose())
+        with Stage('run', core):
+            out = core.run_ssh_command(restart_command, check=check)
         __log(core, 'info', out)
+    except SSHConnectionException as e:
+        __log(core, 'error', repr(e))
+        raise CoreUnreachableException(repr(e))
     except SystemCallException as e:
         __log(core, 'error', repr(e))
         raise CoreRunException(repr(e))
@@ -577,6 +1142,9 @@ def ps(core, check=True): # type: (Core, bool) -> None
     try:
         out = core.run_ssh_command(ps_command, check=check)
         __log(core, 'info', out)
+    except SSHConnectionException as e:
+        __log(core, 'error', repr(e))
+        raise CoreUnreachableException(repr(e))
     # TODO: find a case where core initializes but ps fails
     except SystemCallException as e:
         __log(core, 'error', repr(e))
@@ -603,27 +1171,59 @@ def _test(core, check=True): # type: (Core, bool) -> None
     if not isfile(host_test_file) or core.test_file is None:
         __log(core, 'error', 'Test file not found: {}'.format(core.test_file))
         raise CoreTestFileNotFound(core.test_file)
-    target_test_file = '{}/{}'.format(core.target_source, core.test_file)
     push(core)
+    rm_command = 'docker rm -f flooptest || true'
     try:
-        rm_command = 'docker rm -f flooptest || true'
-        __log(core, 'info', rm_command)
-        out = core.run_ssh_command(rm_command, check=check, verbose=verbose())
-        __log(core, 'info', out)
-        test_build_command = 'docker build -f {} -t flooptest {}/'.format(
-                target_test_file,
-                core.target_source)
-        __log(core, 'info', test_build_command)
-        out = core.run_ssh_command(test_build_command, check=check, verbose=verbose())
-        __log(core, 'info', out)
-        test_run_command = 'docker run --name flooptest -v {}:/floop/ flooptest'.format(
-                core.target_source)
-        __log(core, 'info', test_run_command)
-        out = core.run_ssh_command(test_run_command, check=check, verbose=verbose())
+        test_build_command = _build_command(core, core.test_file, 'flooptest')
+    except CoreBuildException as e:
+        raise CoreTestException(repr(e))
+    test_run_command = 'docker run --name flooptest -v {}:/floop/ flooptest'.format(
+            core.target_source)
+    steps = _run_stages(core, [('build', [rm_command, test_build_command]),
+        ('run', [test_run_command])])
+    if steps[1].ok:
+        _record_build(core, core.test_file, steps[1].output)
+    for step in steps:
+        __log(core, 'info', step.command)
+        __log(core, 'info', step.output)
+        if not step.ok:
+            __log(core, 'error', 'Exit code {}'.format(step.returncode))
+            if check:
+                raise CoreTestException(step.output)
+            break
+
+# the brackets keep the patterns from matching the shell that runs them;
+# docker clients do not carry the marker in their command line, but in
+# their environment
+_CANCEL_COMMAND = ("pkill -f '[_]_FLOOP_' ; "
+    "grep -las '{}=[_]_FLOOP_' /proc/[0-9]*/environ | cut -d/ -f3 | "
+    "xargs -r kill ; true").format(_BUILD_MARK)
+'''Command that stops remote scripts and docker builds floop left running'''
+
+_CANCEL_TIMEOUT = 10
+'''Seconds to wait for remote cleanup of one core'''
+
+def cancel(core): # type: (Core) -> None
+    '''
+    Parallelizable; stop remote work of a cancelled core operation
+
+    Killing ssh on the host does not stop the command on the core, so
+    after a fail-fast cancellation this kills the floop scripts and the
+    docker builds floop started that are still running there (see
+    :py:func:`_marked`). Other builds and containers are left alone.
+    Errors are logged, not raised.
+
+    Args:
+        core (:py:class:`floopcli.iot.core.Core`):
+            initialized target core object
+    '''
+    __log(core, 'info', _CANCEL_COMMAND)
+    try:
+        out = get_session(core).run(_CANCEL_COMMAND, check=False,
+                timeout=_CANCEL_TIMEOUT)
         __log(core, 'info', out)
     except SystemCallException as e:
-        __log(core, 'error', repr(e))
-        raise CoreTestException(repr(e))
+        __log(core, 'error', 'Cleanup failed: {}'.format(repr(e)))
 
 def destroy(core, check=True): # type: (Core, bool) -> None
     '''
@@ -652,6 +1252,8 @@ def destroy(core, check=True): # type: (Core, bool) -> None
             if kind =='sys':
                 out, err = syscall(command=command, check=check)
                 __log(core, 'info', str((out, err)))
+        store.forget(core.core)
+        clear_core_state(core.core)
     # TODO: find a case where init succeeds but destroy fails, enforce idempotency
     except SystemCallException as e:
         __log(core, 'error', repr(e))
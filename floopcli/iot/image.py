@@ -0,0 +1,306 @@
+import hashlib
+import shutil
+import tempfile
+import threading
+
+from multiprocessing.pool import ThreadPool
+from os.path import abspath
+from typing import Any, Dict, List, Optional, Tuple, TypeVar
+
+from floopcli.iot.layers import send_image
+from floopcli.iot.relay import TreePlan
+from floopcli.iot.session import get_session
+from floopcli.util.manifest import source_manifest
+from floopcli.util.state import read_core_state, update_core_state
+from floopcli.util.syscall import syscall, quote, SystemCallCancelled, \
+        SystemCallException
+
+BUILDERS = ['core', 'host', 'group']
+'''
+Where images are built: on every core, once per platform on the host, or
+once per group and platform on the strongest core of the group
+'''
+
+_GROUP_FANOUT = 2
+'''Number of cores each core forwards a group-built image to'''
+
+_RESOURCES_COMMAND = "nproc && awk '/^MemTotal:/ {print $2}' /proc/meminfo && uname -m"
+'''Command that prints CPU count, memory in kB, and architecture of a core'''
+
+_PLATFORMS = {
+    'x86_64': 'linux/amd64',
+    'amd64': 'linux/amd64',
+    'aarch64': 'linux/arm64',
+    'arm64': 'linux/arm64',
+    'armv7l': 'linux/arm/v7',
+    'armv6l': 'linux/arm/v6',
+    'i386': 'linux/386',
+    'i686': 'linux/386',
+    'ppc64le': 'linux/ppc64le',
+    's390x': 'linux/s390x',
+    }
+'''uname -m output to Docker platform'''
+
+_builder = [] # type: List[Any]
+
+def use_builder(builder, plan=None): # type: (Optional[str], Optional[GroupBuildPlan]) -> None
+    '''
+    Choose where images are built for core operations in this process
+
+    Args:
+        builder (str):
+            one of :py:data:`BUILDERS`; None restores the default (core)
+        plan (:py:class:`floopcli.iot.image.GroupBuildPlan`):
+            builder cores and image relay trees, for the group builder
+    '''
+    del _builder[:]
+    if builder is not None:
+        _builder.extend([builder, plan])
+
+def active_builder(): # type: () -> str
+    '''
+    Returns:
+        str:
+            where images are built, one of :py:data:`BUILDERS`
+    '''
+    if _builder:
+        return _builder[0]
+    return 'core'
+
+def active_build_plan(): # type: () -> Optional[GroupBuildPlan]
+    '''
+    Returns:
+        :py:class:`floopcli.iot.image.GroupBuildPlan`:
+            active group build plan, or None
+    '''
+    if _builder:
+        return _builder[1]
+    return None
+
+def core_resources(core, refresh=False): # type: (Any, bool) -> Tuple[int, int]
+    '''
+    CPU count and memory of a core, detected once and recorded in core state
+
+    :py:func:`floopcli.iot.core.create` records them for new cores
+
+    Args:
+        core (:py:class:`floopcli.iot.core.Core`):
+            initialized target core object
+        refresh (bool):
+            if True, detect again even if resources were recorded
+    Returns:
+        (int, int):
+            number of CPUs and bytes of memory
+    Raises:
+        :py:class:`floopcli.util.syscall.SystemCallException`:
+            resources could not be read from core
+    '''
+    state = read_core_state(core.core)
+    if refresh or 'cpus' not in state or 'memory' not in state:
+        out = get_session(core).run(_RESOURCES_COMMAND, check=True).split()
+        try:
+            state = update_core_state(core.core, cpus=int(out[0]),
+                    memory=int(out[1]) * 1024, arch=out[2])
+        except (IndexError, ValueError):
+            raise SystemCallException(
+                    'Unexpected resources output: {}'.format(' '.join(out)))
+    return state['cpus'], state['memory']
+
+def core_platform(core): # type: (Any) -> str
+    '''
+    Docker platform of a core, detected once and recorded in core state
+
+    Args:
+        core (:py:class:`floopcli.iot.core.Core`):
+            initialized target core object
+    Returns:
+        str:
+            Docker platform, e.g. linux/arm/v7
+    Raises:
+        :py:class:`floopcli.util.syscall.SystemCallException`:
+            architecture could not be read from core
+    '''
+    arch = read_core_state(core.core).get('arch')
+    if arch is None:
+        arch = get_session(core).run('uname -m', check=True).strip()
+        update_core_state(core.core, arch=arch)
+    return _PLATFORMS.get(arch, 'linux/{}'.format(arch))
+
+def image_key(platform, source, build_file): # type: (str, str, str) -> str
+    '''
+    Identity of an image built from a source directory
+
+    Args:
+        platform (str):
+            Docker platform
+        source (str):
+            host source directory (the build context)
+        build_file (str):
+            Dockerfile name relative to source
+    Returns:
+        str:
+            sha1 of platform, build file name, and source manifest digest
+    '''
+    digest = source_manifest(source).digest
+    return hashlib.sha1('{}\0{}\0{}'.format(
+        platform, build_file, digest).encode('utf-8')).hexdigest()
+
+def image_tag(key): # type: (str) -> str
+    '''
+    Returns:
+        str:
+            tag of the image with key on host and cores
+    '''
+    return 'floop-image:{}'.format(key[:16])
+
+_images = {} # type: Dict[str, str]
+_image_errors = {} # type: Dict[str, SystemCallException]
+_image_locks = {} # type: Dict[str, threading.Lock]
+_images_lock = threading.Lock()
+_image_dir = [] # type: List[str]
+
+def host_image(platform, source, build_file): # type: (str, str, str) -> str
+    '''
+    Cross-build an image on the host once and share the archive
+
+    Uses docker buildx, so the host needs buildx and, for foreign
+    platforms, QEMU binfmt handlers (docker run --privileged
+    tonistiigi/binfmt --install all). Cores of the same platform that
+    build the same source and build file wait for one build, and get its
+    error if it failed.
+
+    Args:
+        platform (str):
+            Docker platform to build for
+        source (str):
+            host source directory (the build context)
+        build_file (str):
+            Dockerfile name relative to source
+    Returns:
+        str:
+            path to image archive (docker save format) on host
+    Raises:
+        :py:class:`floopcli.util.syscall.SystemCallException`:
+            build failed
+    '''
+    key = image_key(platform, source, build_file)
+    with _images_lock:
+        lock = _image_locks.setdefault(key, threading.Lock())
+        if not _image_dir:
+            _image_dir.append(tempfile.mkdtemp(prefix='floop-image-'))
+        image_dir = _image_dir[0]
+    with lock:
+        if key in _images:
+            return _images[key]
+        if key in _image_errors:
+            raise _image_errors[key]
+        path = '{}/{}.tar'.format(image_dir, key)
+        try:
+            syscall(['docker', 'buildx', 'build', '--platform', platform,
+                '-f', '{}/{}'.format(abspath(source), build_file),
+                '-t', image_tag(key),
+                '--output', 'type=docker,dest={}'.format(path),
+                abspath(source)], check=True)
+        except SystemCallCancelled:
+            raise
+        except SystemCallException as e:
+            # the same build would fail again for every waiting core
+            _image_errors[key] = e
+            raise
+        _images[key] = path
+        return path
+
+def remove_images(): # type: () -> None
+    '''
+    Remove all image archives built by this process
+    '''
+    with _images_lock:
+        _images.clear()
+        _image_errors.clear()
+        while _image_dir:
+            shutil.rmtree(_image_dir.pop(), ignore_errors=True)
+
+def deliver_image(core, build_file): # type: (Any, str) -> Tuple[str, int, int]
+    '''
+    Make sure a core has the host-built image for its source and build file
+
+    Skips the transfer if the core already holds an image with the same
+    key; otherwise builds it on the host (once per key) and streams the
+    layers the core is missing into docker load on the core, see
+    :py:func:`floopcli.iot.layers.send_image`
+
+    Args:
+        core (:py:class:`floopcli.iot.core.Core`):
+            initialized target core object
+        build_file (str):
+            Dockerfile name relative to host_source
+    Returns:
+        (str, int, int):
+            tag of the image on the core, bytes sent, and layer bytes
+            not sent because the core already had them
+    Raises:
+        :py:class:`floopcli.util.syscall.SystemCallException`:
+            build or transfer failed
+    '''
+    platform = core_platform(core)
+    key = image_key(platform, core.host_source, build_file)
+    tag = image_tag(key)
+    session = get_session(core)
+    if read_core_state(core.core).get('images', {}).get(build_file) == key:
+        try:
+            session.run('docker image inspect --format . {}'.format(quote(tag)),
+                    check=True)
+            return tag, 0, 0
+        except SystemCallException: # removed on core since
+            pass
+    path = host_image(platform, core.host_source, build_file)
+    sent, saved = send_image(core, path)
+    images = read_core_state(core.core).get('images', {})
+    images[build_file] = key
+    update_core_state(core.core, images=images)
+    return tag, sent, saved
+
+def _build_facts(core): # type: (Any) -> Optional[Tuple[str, Tuple[int, int]]]
+    try:
+        return core_platform(core), core_resources(core)
+    except SystemCallException:
+        return None
+
+GroupBuildPlanType = TypeVar('GroupBuildPlanType', bound='GroupBuildPlan')
+'''Generic GroupBuildPlan type'''
+
+class GroupBuildPlan(TreePlan):
+    '''
+    One builder core per (group, platform, source) and a relay tree for its image
+
+    The builder is the core with the most CPUs, then the most memory. The
+    other cores load the finished image from a core earlier in the tree
+    instead of building it. Cores whose platform cannot be detected build
+    on their own.
+
+    Args:
+        cores ([:py:class:`floopcli.iot.core.Core`]):
+            cores to build on
+        fanout (int):
+            number of cores each core forwards the image to
+    '''
+    def __init__(self, cores, fanout=_GROUP_FANOUT): # type: (GroupBuildPlanType, List[Any], int) -> None
+        super(GroupBuildPlan, self).__init__(fanout)
+        pool = ThreadPool(max(1, len(cores)))
+        try:
+            facts = pool.map(_build_facts, cores)
+        finally:
+            pool.close()
+            pool.join()
+        groups = {} # type: Dict[tuple, List[Any]]
+        for core, fact in zip(cores, facts):
+            if fact is None:
+                self._add_tree([core], 1)
+                continue
+            platform, (cpus, memory) = fact
+            key = (core.group, platform, abspath(core.host_source))
+            groups.setdefault(key, []).append((-cpus, -memory, core.core, core))
+        for key in sorted(groups, key=str):
+            # strongest cores first: the builder, then the busiest forwarders
+            self._add_tree([member[-1] for member in sorted(groups[key],
+                key=lambda member: member[:3])], 1)
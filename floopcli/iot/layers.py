@@ -0,0 +1,183 @@
+import hashlib
+import json
+import shutil
+import tarfile
+import tempfile
+import threading
+
+from os.path import getsize
+from typing import Any, Dict, List, Set, Tuple
+
+from floopcli.iot.session import get_session
+from floopcli.util.syscall import SystemCallException
+
+def chain_ids(diff_ids): # type: (List[str]) -> List[str]
+    '''
+    Chain IDs of the layers of an image
+
+    Docker identifies a layer together with all layers below it: the
+    chain ID of the first layer is its diff ID, every other chain ID is
+    sha256 of the previous chain ID, a space, and the layer diff ID
+
+    Args:
+        diff_ids ([str]):
+            layer diff IDs (rootfs.diff_ids of the image config), bottom first
+    Returns:
+        [str]:
+            chain IDs, bottom first
+    '''
+    chains = [] # type: List[str]
+    for diff_id in diff_ids:
+        if not chains:
+            chains.append(diff_id)
+        else:
+            chains.append('sha256:' + hashlib.sha256('{} {}'.format(
+                chains[-1], diff_id).encode('utf-8')).hexdigest())
+    return chains
+
+_archives = {} # type: Dict[str, List[Tuple[str, str, int]]]
+_archives_lock = threading.Lock()
+
+def archive_layers(path): # type: (str) -> List[Tuple[str, str, int]]
+    '''
+    Layers of a docker save archive, read once per archive
+
+    Args:
+        path (str):
+            path to image archive on host
+    Returns:
+        [(str, str, int)]:
+            archive member name, chain ID, and size of each layer
+    '''
+    with _archives_lock:
+        if path in _archives:
+            return _archives[path]
+        layers = [] # type: List[Tuple[str, str, int]]
+        with tarfile.open(path) as archive:
+            manifest = json.loads(archive.extractfile( # type: ignore
+                'manifest.json').read().decode('utf-8'))
+            for image in manifest:
+                config = json.loads(archive.extractfile( # type: ignore
+                    image['Config']).read().decode('utf-8'))
+                chains = chain_ids(config['rootfs']['diff_ids'])
+                for member, chain in zip(image['Layers'], chains):
+                    layers.append((member, chain, archive.getmember(member).size))
+        _archives[path] = layers
+        return layers
+
+# one line per image: its layer diff IDs as a JSON list
+_LAYERS_COMMAND = "docker image inspect --format '{{json .RootFS.Layers}}' " \
+        "$(docker image ls -aq) 2>/dev/null || true"
+'''Command that lists the layers of all images on a core'''
+
+def core_layers(core): # type: (Any) -> Set[str]
+    '''
+    Chain IDs of all layers a core already has
+
+    Args:
+        core (:py:class:`floopcli.iot.core.Core`):
+            initialized target core object
+    Returns:
+        {str}:
+            chain IDs
+    Raises:
+        :py:class:`floopcli.util.syscall.SystemCallException`:
+            core could not be reached
+    '''
+    out = get_session(core).run(_LAYERS_COMMAND, check=True)
+    present = set() # type: Set[str]
+    for line in out.splitlines():
+        line = line.strip()
+        if line.startswith('['):
+            present.update(chain_ids(json.loads(line)))
+    return present
+
+_diffs = {} # type: Dict[str, str]
+_diff_locks = {} # type: Dict[str, threading.Lock]
+_diffs_lock = threading.Lock()
+_diff_dir = [] # type: List[str]
+
+def layer_diff_archive(path, present): # type: (str, Set[str]) -> Tuple[str, int]
+    '''
+    Copy of an image archive without the layers a core already has
+
+    docker load looks up every layer by chain ID before it opens the
+    layer file, so layers that exist on the core can be left out of
+    the archive. Cores that miss the same layers share one copy.
+
+    Args:
+        path (str):
+            path to image archive on host
+        present ({str}):
+            chain IDs of layers on the core
+    Returns:
+        (str, int):
+            path to archive to send, and number of layer bytes left out
+    '''
+    layers = archive_layers(path)
+    skipped = set(member for member, chain, _ in layers if chain in present)
+    saved = sum(size for member, _, size in layers if member in skipped)
+    if not skipped:
+        return path, 0
+    key = hashlib.sha1('{}\0{}'.format(path, '\0'.join(sorted(skipped))).encode(
+        'utf-8')).hexdigest()
+    with _diffs_lock:
+        lock = _diff_locks.setdefault(key, threading.Lock())
+        if not _diff_dir:
+            _diff_dir.append(tempfile.mkdtemp(prefix='floop-layers-'))
+        diff_dir = _diff_dir[0]
+    with lock:
+        if key not in _diffs:
+            diff_path = '{}/{}.tar'.format(diff_dir, key)
+            with tarfile.open(path) as source, \
+                    tarfile.open(diff_path, 'w') as target:
+                for member in source:
+                    if member.name in skipped:
+                        continue
+                    target.addfile(member, source.extractfile(member)
+                            if member.isfile() else None)
+            _diffs[key] = diff_path
+        return _diffs[key], saved
+
+def remove_layer_diffs(): # type: () -> None
+    '''
+    Remove all layer diff archives built by this process
+    '''
+    with _diffs_lock:
+        _diffs.clear()
+        while _diff_dir:
+            shutil.rmtree(_diff_dir.pop(), ignore_errors=True)
+    with _archives_lock:
+        _archives.clear()
+
+def send_image(core, path): # type: (Any, str) -> Tuple[int, int]
+    '''
+    Load an image archive on a core, sending only missing layers
+
+    Falls back to the full archive if docker load rejects the reduced one
+
+    Args:
+        core (:py:class:`floopcli.iot.core.Core`):
+            initialized target core object
+        path (str):
+            path to image archive (docker save format) on host
+    Returns:
+        (int, int):
+            bytes sent and layer bytes saved
+    Raises:
+        :py:class:`floopcli.util.syscall.SystemCallException`:
+            transfer or docker load failed
+    '''
+    session = get_session(core)
+    send, saved = layer_diff_archive(path, core_layers(core))
+    if send != path:
+        try:
+            with open(send, 'rb') as f:
+                session.run('docker load', check=True, stdin=f)
+            return getsize(send), saved
+        except SystemCallException:
+            # e.g. the containerd image store needs every blob
+            pass
+    with open(path, 'rb') as f:
+        session.run('docker load', check=True, stdin=f)
+    return getsize(path), 0
@@ -0,0 +1,106 @@
+import json
+import threading
+
+from os import environ
+from os.path import expanduser, join
+from typing import Any, Dict, NamedTuple, Optional, TypeVar
+
+class MachineNotFound(Exception):
+    '''
+    Docker machine store has no readable config for a core
+    '''
+    pass
+
+Connection = NamedTuple('Connection', [('host', str), ('port', str),
+    ('user', str), ('key', str)])
+'''SSH connection details of a machine: host, port, user, and key path'''
+
+def connection(machine): # type: (Dict[str, Any]) -> Connection
+    '''
+    Extract SSH connection details from a docker-machine host config
+
+    Works on the config.json in the machine store and on the output
+    of docker-machine inspect, which have the same layout
+
+    Args:
+        machine (dict):
+            parsed docker-machine host config
+    Returns:
+        :py:data:`Connection`:
+            host, port, user, and key for the machine
+    Raises:
+        KeyError:
+            config is missing driver SSH fields
+    '''
+    driver = machine['Driver']
+    host = driver['IPAddress']
+    # docker-machine reaches local VirtualBox machines through a
+    # forwarded port on the loopback interface
+    if machine.get('DriverName') == 'virtualbox':
+        host = '127.0.0.1'
+    return Connection(host=host, port=str(driver['SSHPort']),
+            user=driver['SSHUser'], key=driver['SSHKeyPath'])
+
+MachineStoreType = TypeVar('MachineStoreType', bound='MachineStore')
+'''Generic MachineStore type'''
+
+class MachineStore(object):
+    '''
+    Cached reader for the docker-machine store
+
+    The docker-machine binary loads every machine in the store on each
+    invocation. This reader opens only the config of the requested
+    machine, once, so lookups cost the same for 1 or 2,000 machines.
+
+    Args:
+        path (str):
+            docker-machine storage path; defaults to MACHINE_STORAGE_PATH
+            or ~/.docker/machine
+    '''
+    def __init__(self, path=None): # type: (MachineStoreType, Optional[str]) -> None
+        if path is None:
+            path = environ.get('MACHINE_STORAGE_PATH', '~/.docker/machine')
+        self.path = expanduser(path)
+        self._cache = {} # type: Dict[str, Connection]
+        self._lock = threading.Lock()
+
+    def resolve(self, name): # type: (MachineStoreType, str) -> Connection
+        '''
+        Get SSH connection details for a machine
+
+        Args:
+            name (str):
+                docker machine name
+        Returns:
+            :py:data:`Connection`:
+                host, port, user, and key for the machine
+        Raises:
+            :py:class:`floopcli.iot.machine.MachineNotFound`:
+                machine has no readable config in the store
+        '''
+        with self._lock:
+            if name in self._cache:
+                return self._cache[name]
+        config_file = join(self.path, 'machines', name, 'config.json')
+        try:
+            with open(config_file) as c:
+                details = connection(json.load(c))
+        except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+            raise MachineNotFound('{}: {}'.format(name, repr(e)))
+        with self._lock:
+            self._cache[name] = details
+        return details
+
+    def forget(self, name): # type: (MachineStoreType, str) -> None
+        '''
+        Drop cached details for a machine, e.g. after it is removed
+
+        Args:
+            name (str):
+                docker machine name
+        '''
+        with self._lock:
+            self._cache.pop(name, None)
+
+store = MachineStore()
+'''Default machine store shared by all cores'''
@@ -0,0 +1,377 @@
+import atexit
+import hashlib
+import os
+import re
+import shutil
+import signal
+import tempfile
+import threading
+
+from os.path import join
+from typing import Any, Dict, List, Optional, Set, Tuple, TypeVar
+
+from floopcli.iot.session import get_session
+from floopcli.util.manifest import pushed_manifest, source_manifest
+from floopcli.util.syscall import syscall, quote, SystemCallException
+
+_RELAY_DIR = '/tmp'
+'''Directory on cores where relayed archives are kept for forwarding'''
+
+_RELAY_SSH_OPTIONS = [
+    'BatchMode=yes',
+    'ConnectTimeout=10',
+    'LogLevel=quiet',
+    'StrictHostKeyChecking=no',
+    'UserKnownHostsFile=/dev/null',
+    ]
+'''OpenSSH options for core-to-core connections'''
+
+TreePlanType = TypeVar('TreePlanType', bound='TreePlan')
+'''Generic TreePlan type'''
+
+class TreePlan(object):
+    '''
+    Cores arranged in fan-out trees, where every core waits for its parent
+
+    Each tree starts with a number of roots that have no parent core;
+    every other core gets its data from a core earlier in the tree, and
+    every core serves at most fanout children
+
+    Args:
+        fanout (int):
+            number of children per core
+    '''
+    def __init__(self, fanout): # type: (TreePlanType, int) -> None
+        self.fanout = max(1, fanout)
+        self._parents = {} # type: Dict[str, Any]
+        self._events = {} # type: Dict[str, threading.Event]
+        self._ok = {} # type: Dict[str, bool]
+        self._order = [] # type: List[Any]
+
+    def _add_tree(self, members, roots): # type: (TreePlanType, List[Any], int) -> None
+        '''
+        Add a tree of cores in breadth-first order
+
+        Args:
+            members ([:py:class:`floopcli.iot.core.Core`]):
+                cores of the tree, roots first
+            roots (int):
+                number of cores without a parent core
+        '''
+        for idx, core in enumerate(members):
+            parent = None
+            if idx >= roots:
+                parent = members[(idx - roots) // self.fanout]
+            self._parents[core.core] = parent
+            self._events[core.core] = threading.Event()
+        # members are in breadth-first order: parents before children
+        self._order += members
+
+    def order(self): # type: (TreePlanType) -> List[Any]
+        '''
+        Returns:
+            [:py:class:`floopcli.iot.core.Core`]:
+                all cores, every parent before its children
+        '''
+        return self._order
+
+    def covers(self, core): # type: (TreePlanType, Any) -> bool
+        '''
+        Returns:
+            bool:
+                if True, core is part of a tree
+        '''
+        return core.core in self._events
+
+    def parent(self, core): # type: (TreePlanType, Any) -> Optional[Any]
+        '''
+        Returns:
+            :py:class:`floopcli.iot.core.Core`:
+                core that core gets its data from, or None for roots
+        '''
+        return self._parents.get(core.core)
+
+    def wait(self, core): # type: (TreePlanType, Any) -> bool
+        '''
+        Block until core has received its data (or failed to)
+
+        Returns:
+            bool:
+                if True, core holds a verified copy it can forward
+        '''
+        self._events[core.core].wait()
+        return self._ok[core.core]
+
+    def done(self, core, ok): # type: (TreePlanType, Any, bool) -> None
+        '''
+        Record whether core received a verified copy of its data
+
+        Only the first call for a core counts, so this can also be used
+        to release waiting children when an operation fails early
+        '''
+        event = self._events.get(core.core)
+        if event is not None and not event.is_set():
+            self._ok[core.core] = ok
+            event.set()
+
+    def run(self, func, core): # type: (TreePlanType, Any, Any) -> Any
+        '''
+        Call func on core and release the children of core afterwards
+
+        Args:
+            func (function):
+                core operation, e.g. :py:func:`floopcli.iot.core.push`
+            core (:py:class:`floopcli.iot.core.Core`):
+                initialized target core object
+        '''
+        try:
+            return func(core)
+        finally:
+            self.done(core, False)
+
+RelayPlanType = TypeVar('RelayPlanType', bound='RelayPlan')
+'''Generic RelayPlan type'''
+
+class RelayPlan(TreePlan):
+    '''
+    Fan-out tree for pushing the same archive to many cores
+
+    Cores in the same group that need the same change set (same host
+    source, same last pushed manifest) form one tree. The host sends the
+    archive to the first fanout cores of each tree (the seeds), and every
+    core forwards its verified copy to the next fanout cores in line.
+    A core deletes its copy once it and all its children are done.
+
+    Args:
+        cores ([:py:class:`floopcli.iot.core.Core`]):
+            cores to push to
+        fanout (int):
+            number of seeds per tree and children per core
+    '''
+    def __init__(self, cores, fanout): # type: (RelayPlanType, List[Any], int) -> None
+        super(RelayPlan, self).__init__(fanout)
+        trees = {} # type: Dict[tuple, List[Any]]
+        rest = []
+        for core in sorted(cores, key=lambda c: (c.group, c.core)):
+            manifest = source_manifest(core.host_source)
+            last = pushed_manifest(core)
+            if last == manifest.digest:
+                rest.append(core)
+                continue
+            key = (core.group, core.host_source, last, manifest.digest)
+            trees.setdefault(key, []).append(core)
+        for key in sorted(trees, key=str):
+            self._add_tree(trees[key], self.fanout)
+        self._order += rest
+        self._held = {} # type: Dict[str, str]
+        self._pending = {} # type: Dict[str, int]
+        '''Cores not done with the copy of a core: the core and its children'''
+        for name, parent in self._parents.items():
+            self._pending[name] = self._pending.get(name, 0) + 1
+            if parent is not None:
+                self._pending[parent.core] = self._pending.get(parent.core, 0) + 1
+        self._lock = threading.Lock()
+
+    def hold(self, core, digest): # type: (RelayPlanType, Any, str) -> None
+        '''
+        Record that core keeps a copy of the archive with digest to forward
+        '''
+        with self._lock:
+            self._held[core.core] = digest
+
+    def run(self, func, core): # type: (RelayPlanType, Any, Any) -> Any
+        '''
+        Call func on core, release the children of core afterwards, and
+        delete the copies that are no longer needed
+
+        Args:
+            func (function):
+                core operation, e.g. :py:func:`floopcli.iot.core.push`
+            core (:py:class:`floopcli.iot.core.Core`):
+                initialized target core object
+        '''
+        try:
+            return super(RelayPlan, self).run(func, core)
+        finally:
+            self._served(core)
+            parent = self.parent(core)
+            if parent is not None:
+                self._served(parent)
+
+    def _served(self, core): # type: (RelayPlanType, Any) -> None
+        with self._lock:
+            if core.core not in self._pending:
+                return
+            self._pending[core.core] -= 1
+            if self._pending[core.core] > 0:
+                return
+            del self._pending[core.core]
+            digest = self._held.pop(core.core, None)
+        if digest is None:
+            return
+        try:
+            get_session(core).run('rm -f {}'.format(relay_path(digest)),
+                    check=False)
+        except SystemCallException: # left for the OS to clean up /tmp
+            pass
+
+_plan = [] # type: List[RelayPlan]
+
+def activate(plan): # type: (Optional[RelayPlan]) -> None
+    '''
+    Make plan the relay plan for pushes in this process; None disables relay
+    '''
+    del _plan[:]
+    if plan is not None:
+        _plan.append(plan)
+
+def active_plan(): # type: () -> Optional[RelayPlan]
+    '''
+    Returns:
+        :py:class:`floopcli.iot.relay.RelayPlan`:
+            active relay plan, or None if relay is disabled
+    '''
+    if _plan:
+        return _plan[0]
+    return None
+
+_digests = {} # type: Dict[str, str]
+_digests_lock = threading.Lock()
+
+def archive_digest(path): # type: (str) -> str
+    '''
+    Returns:
+        str:
+            sha1 of archive file, computed once per archive
+    '''
+    with _digests_lock:
+        if path not in _digests:
+            sha = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1048576), b''):
+                    sha.update(chunk)
+            _digests[path] = sha.hexdigest()
+        return _digests[path]
+
+def relay_path(digest): # type: (str) -> str
+    '''
+    Returns:
+        str:
+            path on a core where the archive with digest is kept
+    '''
+    return '{}/floop-relay-{}.tar.gz'.format(_RELAY_DIR, digest)
+
+def receive_command(digest, target_source, delete_file): # type: (str, str, str) -> str
+    '''
+    Command that stores an archive from stdin, verifies it, and applies it
+
+    Args:
+        digest (str):
+            expected sha1 of the archive
+        target_source (str):
+            directory on the core to extract into
+        delete_file (str):
+            name of the removed-paths list inside the archive
+    Returns:
+        str:
+            shell command to run on the receiving core
+    '''
+    path = relay_path(digest)
+    return ('cat > {path} && echo "{digest}  {path}" | sha1sum -c - >/dev/null && '
+        'mkdir -p {target} && tar -xzf {path} -C {target} && cd {target} && '
+        '{{ xargs -0 rm -rf -- < {delete} && rm -f {delete}; }}').format(
+            path=path, digest=digest, target=quote(target_source),
+            delete=delete_file)
+
+def ssh_command(session, remote): # type: (Any, str) -> str
+    '''
+    Command for a relay core that runs a command on another core
+
+    Args:
+        session (:py:class:`floopcli.iot.session.SSHSession`):
+            session of the other core
+        remote (str):
+            shell command to run on the other core
+    Returns:
+        str:
+            shell command to run on the relay core; needs agent forwarding
+    '''
+    options = ' '.join('-o {}'.format(option) for option in _RELAY_SSH_OPTIONS)
+    return 'ssh {} -p {} {} {}'.format(options, quote(session.port),
+            quote(session.destination()), quote(remote))
+
+def forward_command(session, digest, receive): # type: (Any, str, str) -> str
+    '''
+    Command for a relay core that sends its copy of an archive to another core
+
+    Args:
+        session (:py:class:`floopcli.iot.session.SSHSession`):
+            session of the receiving core
+        digest (str):
+            sha1 of the archive
+        receive (str):
+            receive command to run on the receiving core
+    Returns:
+        str:
+            shell command to run on the relay core
+    '''
+    return '{} < {}'.format(ssh_command(session, receive), relay_path(digest))
+
+_agent = [] # type: List[Tuple[str, str, int]]
+_agent_keys = set() # type: Set[str]
+_agent_lock = threading.Lock()
+
+def add_agent_key(key): # type: (str) -> str
+    '''
+    Add an SSH key to the relay ssh-agent so relay cores can use it
+
+    The relay agent is started by floop on first use and holds only
+    core keys, never the keys of the user's own agent, see
+    :py:func:`stop_agent`
+
+    Args:
+        key (str):
+            path on host to SSH private key of a core
+    Returns:
+        str:
+            socket of the relay agent, to forward to relay cores
+    Raises:
+        :py:class:`floopcli.util.syscall.SystemCallException`:
+            the agent could not be started or the key could not be added
+    '''
+    with _agent_lock:
+        if not _agent:
+            directory = tempfile.mkdtemp(prefix='floop-agent-')
+            sock = join(directory, 'agent')
+            try:
+                out, _ = syscall(['ssh-agent', '-s', '-a', sock], check=True)
+                pid = re.search(r'SSH_AGENT_PID=(\d+)', out)
+                if pid is None:
+                    raise SystemCallException('ssh-agent did not report its pid')
+            except SystemCallException:
+                shutil.rmtree(directory, ignore_errors=True)
+                raise
+            _agent.append((directory, sock, int(pid.group(1))))
+        _, sock, _ = _agent[0]
+        if key not in _agent_keys:
+            syscall(['env', 'SSH_AUTH_SOCK={}'.format(sock), 'ssh-add', '-q', key],
+                    check=True)
+            _agent_keys.add(key)
+        return sock
+
+def stop_agent(): # type: () -> None
+    '''
+    Stop the relay ssh-agent, if it was started, and forget its keys
+    '''
+    with _agent_lock:
+        while _agent:
+            directory, _, pid = _agent.pop()
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError: # agent already gone
+                pass
+            shutil.rmtree(directory, ignore_errors=True)
+        _agent_keys.clear()
+
+# keys must not outlive floop, even if it exits without cleaning up
+atexit.register(stop_agent)
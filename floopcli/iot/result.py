@@ -0,0 +1,256 @@
+import threading
+import time
+
+from typing import Any, Callable, Dict, List, Optional, TypeVar
+
+from floopcli.util.syscall import clear_expired_budget, expired_budget, \
+        syscalls_cancelled, Budget, SystemCallCancelled, SystemCallTimeout
+
+_current = threading.local()
+
+CoreResultType = TypeVar('CoreResultType', bound='CoreResult')
+'''Generic CoreResult type'''
+
+class CoreResult(object):
+    '''
+    Outcome of one core operation on one core
+
+    Core operations run in their own pool thread, so while one runs,
+    stages and transfers record into the result of the current thread,
+    see :py:func:`record_step` and :py:func:`record_bytes`
+
+    Args:
+        core (str):
+            core name
+    '''
+    def __init__(self, core): # type: (CoreResultType, str) -> None
+        self.core = core
+        '''Core name'''
+        self.status = 'pending'
+        '''pending, ok, failed, timeout, or cancelled'''
+        self.duration = 0.0
+        '''Seconds the whole operation took'''
+        self.steps = [] # type: List[List[Any]]
+        '''[stage name, seconds] in the order stages were first entered'''
+        self.bytes = 0
+        '''Bytes sent between host and core (archives, images, build caches)'''
+        self.error = None # type: Optional[str]
+        '''Exception class name if the operation failed'''
+        self.message = ''
+        '''Exception message if the operation failed'''
+        self.exception = None # type: Optional[Exception]
+        '''Exception raised by the operation, to re-raise on the main thread'''
+        self.timeout = None # type: Optional[str]
+        '''Name of the budget that ran out if the operation timed out'''
+
+    @property
+    def ok(self): # type: (CoreResultType) -> bool
+        return self.status == 'ok'
+
+    def add_step(self, name, seconds): # type: (CoreResultType, str, float) -> None
+        '''
+        Add time spent in a stage; repeated stages add up
+        '''
+        for step in self.steps:
+            if step[0] == name:
+                step[1] += seconds
+                return
+        self.steps.append([name, seconds])
+
+    def step(self, name): # type: (CoreResultType, str) -> Optional[float]
+        '''
+        Returns:
+            float:
+                seconds spent in stage name, or None if the core never entered it
+        '''
+        for step_name, seconds in self.steps:
+            if step_name == name:
+                return seconds
+        return None
+
+    def as_dict(self): # type: (CoreResultType) -> Dict[str, Any]
+        '''
+        Returns:
+            dict:
+                JSON-serializable result, without the exception object
+        '''
+        return {
+            'core': self.core,
+            'status': self.status,
+            'duration': self.duration,
+            'steps': [list(step) for step in self.steps],
+            'bytes': self.bytes,
+            'error': self.error,
+            'message': self.message,
+            'timeout': self.timeout,
+            }
+
+def current_result(): # type: () -> Optional[CoreResult]
+    '''
+    Returns:
+        :py:class:`CoreResult`:
+            result of the core operation running in this thread, or None
+    '''
+    return getattr(_current, 'result', None)
+
+def record_step(name, seconds): # type: (str, float) -> None
+    '''
+    Add time spent in a stage to the result of the current core operation
+    '''
+    result = current_result()
+    if result is not None:
+        result.add_step(name, seconds)
+
+def record_bytes(count): # type: (int) -> None
+    '''
+    Add bytes sent between host and core to the result of the current
+    core operation
+    '''
+    result = current_result()
+    if result is not None:
+        result.bytes += count
+
+def _timed_out(e): # type: (BaseException) -> Optional[str]
+    '''
+    Returns:
+        str:
+            name of the budget that ran out, if e was raised because a
+            system call ran out of time (directly, or while handling the
+            timeout), or None
+    '''
+    if not hasattr(e, '__context__'):
+        # python 2 does not chain exceptions
+        return expired_budget()
+    cause = e # type: Optional[BaseException]
+    while cause is not None:
+        if isinstance(cause, SystemCallTimeout):
+            return cause.budget
+        cause = cause.__cause__ or cause.__context__
+    return None
+
+def collect(func, core): # type: (Callable[[Any], Any], Any) -> CoreResult
+    '''
+    Call a core operation and turn its outcome into a result
+
+    Exceptions are kept in the result instead of raised, so one failing
+    core does not stop the pool from finishing the others. Anything that
+    is not an :py:class:`Exception` (e.g. KeyboardInterrupt) still raises.
+    Operations that fail after :py:func:`floopcli.util.syscall.cancel_syscalls`
+    count as cancelled, and operations that fail because a system call
+    ran out of time count as timeout, not failed. A timeout that the
+    operation recovered from, e.g. by a retry, does not count.
+
+    The operation and command budgets of the core (see
+    :py:data:`floopcli.iot.core.TIMEOUTS`) apply to all of its system calls.
+
+    Args:
+        func (function):
+            core operation, e.g. :py:func:`floopcli.iot.core.run`
+        core (:py:class:`floopcli.iot.core.Core`):
+            initialized target core object
+    Returns:
+        :py:class:`CoreResult`:
+            outcome of func on core
+    '''
+    result = CoreResult(core.core)
+    _current.result = result
+    clear_expired_budget()
+    timeouts = getattr(core, 'timeouts', {})
+    start = time.time()
+    try:
+        with Budget('operation', timeouts.get('operation')), \
+                Budget('command', timeouts.get('command'), each=True):
+            func(core)
+        result.status = 'ok'
+    except Exception as e:
+        result.status = 'failed'
+        if isinstance(e, SystemCallCancelled) or syscalls_cancelled():
+            result.status = 'cancelled'
+        elif _timed_out(e) is not None:
+            result.status = 'timeout'
+            result.timeout = _timed_out(e)
+        result.error = type(e).__name__
+        result.message = str(e)
+        result.exception = e
+    finally:
+        result.duration = time.time() - start
+        _current.result = None
+    return result
+
+def unless_cancelled(func, core): # type: (Callable[[Any], Any], Any) -> Any
+    '''
+    Call a core operation unless system calls were cancelled
+
+    Wrap operations with this before a :py:class:`floopcli.iot.relay.TreePlan`
+    so cores still queued when the fleet is cancelled release their
+    children in the plan without doing any work
+
+    Raises:
+        :py:class:`floopcli.util.syscall.SystemCallCancelled`:
+            system calls were cancelled before core started
+    '''
+    if syscalls_cancelled():
+        raise SystemCallCancelled('Cancelled before start: {}'.format(core.core))
+    return func(core)
+
+_ORDER = {'failed': 0, 'timeout': 0, 'cancelled': 1}
+'''Summary table order of statuses; everything else goes last'''
+
+def _size(count): # type: (int) -> str
+    size = float(count)
+    for unit in ['B', 'K', 'M', 'G']:
+        if size < 1024 or unit == 'G':
+            break
+        size /= 1024
+    if unit == 'B':
+        return '{}B'.format(count)
+    return '{:.1f}{}'.format(size, unit)
+
+def format_result(result): # type: (CoreResult) -> str
+    '''
+    Returns:
+        str:
+            one line about a finished core operation
+    '''
+    line = '{} {} in {:.2f}s'.format(result.core, result.status, result.duration)
+    if result.timeout is not None:
+        line = '{} ({} budget)'.format(line, result.timeout)
+    if result.error is not None:
+        line = '{}: {}'.format(line, result.error)
+    return line
+
+def summary(results): # type: (List[CoreResult]) -> str
+    '''
+    Table of core operation results, failed cores first
+
+    Args:
+        results ([:py:class:`CoreResult`]):
+            finished results
+    Returns:
+        str:
+            table with one row per core and a total line
+    '''
+    stages = [] # type: List[str]
+    for result in results:
+        stages += [name for name, _ in result.steps if name not in stages]
+    header = ['core', 'status', 'time'] + stages + ['bytes', 'error']
+    rows = [header]
+    for result in sorted(results, key=lambda r: (_ORDER.get(r.status, 2), r.core)):
+        row = [result.core, result.status, '{:.2f}s'.format(result.duration)]
+        for name in stages:
+            seconds = result.step(name)
+            row.append('-' if seconds is None else '{:.2f}s'.format(seconds))
+        row += [_size(result.bytes), result.error or '']
+        rows.append(row)
+    widths = [max(len(row[idx]) for row in rows) for idx in range(len(header))]
+    lines = ['  '.join(cell.ljust(width) for cell, width in
+        zip(row, widths)).rstrip() for row in rows]
+    counts = dict((status, len([r for r in results if r.status == status]))
+            for status in ['ok', 'failed', 'timeout', 'cancelled'])
+    total = '{} core(s): {} ok, {} failed'.format(
+            len(results), counts['ok'], counts['failed'])
+    for status in ['timeout', 'cancelled']:
+        if counts[status]:
+            total = '{}, {} {}'.format(total, counts[status], status)
+    lines.append(total)
+    return '\n'.join(lines)
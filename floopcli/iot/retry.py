@@ -0,0 +1,217 @@
+import logging
+import random
+import time
+
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type, TypeVar
+
+from floopcli.iot.core import CoreUnreachableException
+from floopcli.util.state import read_core_state, update_core_state
+from floopcli.util.syscall import clear_expired_budget, syscalls_cancelled
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE = (CoreUnreachableException,) # type: Tuple[Type[Exception], ...]
+'''
+Exceptions worth retrying: SSH could not reach the core or the
+connection dropped. Other failures, e.g. a target directory without
+write permission or a failed build, would fail again and are not retried.
+'''
+
+_SLEEP_STEP = 0.1
+'''Seconds between cancellation checks while backing off'''
+
+RetryPolicyType = TypeVar('RetryPolicyType', bound='RetryPolicy')
+'''Generic RetryPolicy type'''
+
+class RetryPolicy(object):
+    '''
+    How often and how patiently to retry one type of core operation
+
+    Waits before attempt n+1 are drawn uniformly between 0 and
+    min(cap, base * 2**n) ("full jitter"), so cores that failed together
+    do not retry together
+
+    Retrying a whole operation is cheap where its steps were already
+    done: push skips cores whose recorded manifest matches, and build
+    only re-tags an image whose build key was recorded.
+
+    Args:
+        attempts (int):
+            total number of attempts, including the first
+        base (float):
+            seconds of the first backoff ceiling
+        cap (float):
+            largest backoff ceiling in seconds
+        guarded (bool):
+            if True, the operation is skipped on cores whose
+            :py:class:`CircuitBreaker` is open
+    '''
+    def __init__(self, attempts=3, base=1.0, cap=30.0, guarded=True): # type: (RetryPolicyType, int, float, float, bool) -> None
+        self.attempts = max(1, attempts)
+        self.base = base
+        self.cap = cap
+        self.guarded = guarded
+
+    def delay(self, attempt): # type: (RetryPolicyType, int) -> float
+        '''
+        Args:
+            attempt (int):
+                number of attempts that failed so far, starting at 1
+        Returns:
+            float:
+                seconds to wait before the next attempt
+        '''
+        return random.uniform(0, min(self.cap, self.base * 2 ** (attempt - 1)))
+
+RETRY_POLICIES = {
+    'create': RetryPolicy(1, guarded=False),
+    'push': RetryPolicy(3),
+    'build': RetryPolicy(3),
+    'run': RetryPolicy(3),
+    'test': RetryPolicy(3),
+    'restart': RetryPolicy(3),
+    'ps': RetryPolicy(3),
+    'destroy': RetryPolicy(2, guarded=False),
+    } # type: Dict[str, RetryPolicy]
+'''
+Retry policy per core operation; creating machines is not retried
+because docker-machine create is not idempotent, and neither creating
+nor destroying is held back by a circuit breaker
+'''
+
+DEFAULT_POLICY = RetryPolicy(3)
+'''Retry policy of operations without an entry in :py:data:`RETRY_POLICIES`'''
+
+def operation_name(func): # type: (Callable[..., Any]) -> str
+    '''
+    Returns:
+        str:
+            name of a core operation, looking through partials, e.g. test for
+            partial(:py:func:`floopcli.iot.core._test`)
+    '''
+    while hasattr(func, 'func'):
+        func = func.func # type: ignore
+    return getattr(func, '__name__', '').strip('_')
+
+def retry_policy(func, attempts=None): # type: (Callable[..., Any], Optional[int]) -> RetryPolicy
+    '''
+    Args:
+        func (function):
+            core operation
+        attempts (int):
+            if set, overrides the number of attempts of the policy
+    Returns:
+        :py:class:`RetryPolicy`:
+            policy for the type of func
+    '''
+    policy = RETRY_POLICIES.get(operation_name(func), DEFAULT_POLICY)
+    if attempts is not None:
+        policy = RetryPolicy(attempts, policy.base, policy.cap, policy.guarded)
+    return policy
+
+class CircuitOpenException(Exception):
+    '''
+    Core failed too often recently and was not tried, see :py:class:`CircuitBreaker`
+    '''
+    pass
+
+CircuitBreakerType = TypeVar('CircuitBreakerType', bound='CircuitBreaker')
+'''Generic CircuitBreaker type'''
+
+class CircuitBreaker(object):
+    '''
+    Stop trying cores that keep failing
+
+    Attempts that failed to reach the core (see :py:data:`RETRYABLE`)
+    are recorded with their time in the core state, so
+    the breaker also remembers failures of earlier floop commands. Once
+    a core has threshold failures within window seconds, it is skipped
+    until its oldest failure leaves the window; then it gets one more
+    try. A successful attempt clears the record.
+
+    Args:
+        threshold (int):
+            failures within window that open the circuit
+        window (float):
+            seconds a failure counts
+    '''
+    def __init__(self, threshold=5, window=600.0): # type: (CircuitBreakerType, int, float) -> None
+        self.threshold = threshold
+        self.window = window
+
+    def _failures(self, core): # type: (CircuitBreakerType, str) -> List[float]
+        now = time.time()
+        return [t for t in read_core_state(core).get('failures', [])
+                if now - t < self.window]
+
+    def allow(self, core): # type: (CircuitBreakerType, str) -> bool
+        '''
+        Returns:
+            bool:
+                if True, core may be tried
+        '''
+        return len(self._failures(core)) < self.threshold
+
+    def record(self, core, ok): # type: (CircuitBreakerType, str, bool) -> None
+        '''
+        Record the outcome of an attempt on core
+        '''
+        if ok:
+            if read_core_state(core).get('failures'):
+                update_core_state(core, failures=[])
+            return
+        update_core_state(core, failures=self._failures(core) + [time.time()])
+
+def _sleep(seconds): # type: (float) -> None
+    '''
+    Sleep, but wake up early if system calls were cancelled
+    '''
+    deadline = time.time() + seconds
+    while not syscalls_cancelled():
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+        time.sleep(min(_SLEEP_STEP, remaining))
+
+def with_retries(func, policy, breaker, core): # type: (Callable[[Any], Any], RetryPolicy, Optional[CircuitBreaker], Any) -> Any
+    '''
+    Call a core operation, retrying transient failures
+
+    Args:
+        func (function):
+            core operation, e.g. :py:func:`floopcli.iot.core.push`
+        policy (:py:class:`RetryPolicy`):
+            number of attempts and backoff
+        breaker (:py:class:`CircuitBreaker`):
+            skips cores that keep failing; None tries every core
+        core (:py:class:`floopcli.iot.core.Core`):
+            initialized target core object
+    Raises:
+        :py:class:`CircuitOpenException`:
+            core failed too often recently
+    '''
+    if not policy.guarded:
+        breaker = None
+    attempt = 0
+    while True:
+        if breaker is not None and not breaker.allow(core.core):
+            raise CircuitOpenException('{}: {} failures in {} seconds'.format(
+                core.core, breaker.threshold, breaker.window))
+        attempt += 1
+        # a timeout of an earlier attempt is not the outcome of this one
+        clear_expired_budget()
+        try:
+            result = func(core)
+        except RETRYABLE as e:
+            if breaker is not None:
+                breaker.record(core.core, False)
+            if attempt >= policy.attempts or syscalls_cancelled():
+                raise
+            delay = policy.delay(attempt)
+            logger.info('{} - retry {} of {} in {:.1f}s after {}'.format(
+                core.core, attempt, policy.attempts - 1, delay, repr(e)))
+            _sleep(delay)
+            continue
+        if breaker is not None:
+            breaker.record(core.core, True)
+        return result
@@ -0,0 +1,121 @@
+import time
+
+from sys import stdout
+from uuid import uuid4
+from typing import List, Optional, TypeVar
+
+from floopcli.util.syscall import RingBufferSink
+
+StepResultType = TypeVar('StepResultType', bound='StepResult')
+'''Generic StepResult type'''
+
+class StepResult(object):
+    '''
+    Outcome of one step of a remote script
+
+    Args:
+        command (str):
+            shell command run on the core
+    '''
+    def __init__(self, command): # type: (StepResultType, str) -> None
+        self.command = command
+        '''Shell command run on the core'''
+        self.returncode = None # type: Optional[int]
+        '''Exit code of the command, or None if it never ran'''
+        self.output = ''
+        '''stdout output of the command, or its tail if it was long'''
+        self.duration = 0.0
+        '''Seconds between the end of the previous step and this one'''
+
+    @property
+    def ok(self): # type: (StepResultType) -> bool
+        return self.returncode == 0
+
+RemoteScriptType = TypeVar('RemoteScriptType', bound='RemoteScript')
+'''Generic RemoteScript type'''
+
+class RemoteScript(object):
+    '''
+    Sequence of shell commands run on a core in a single SSH session
+
+    Every step writes a marker line with its exit code when it finishes,
+    so one round trip reports per-step exit codes and output. The script
+    stops at the first step that fails. Only the tail of each step's
+    output is kept, so a chatty build does not grow memory.
+
+    Args:
+        steps ([str]):
+            shell commands to run in order
+        verbose (bool):
+            if True, stream step output (without markers) to stdout
+        maxsize (int):
+            maximum number of characters of output kept per step
+    '''
+    def __init__(self, steps, verbose=False, maxsize=65536):
+        # type: (RemoteScriptType, List[str], bool, int) -> None
+        self.steps = [StepResult(command) for command in steps]
+        self.verbose = verbose
+        self.maxsize = maxsize
+        self._marker = '__FLOOP_{}__ '.format(uuid4().hex)
+        self._lines = RingBufferSink(maxsize)
+        self._last = time.time()
+
+    def render(self): # type: (RemoteScriptType) -> str
+        '''
+        Returns:
+            str:
+                shell script that runs all steps
+        '''
+        lines = []
+        for idx, step in enumerate(self.steps):
+            lines += [
+                step.command,
+                '__floop_rc=$?',
+                "printf '{}%d %d\\n' {} $__floop_rc".format(self._marker, idx),
+                '[ $__floop_rc -eq 0 ] || exit $__floop_rc']
+        return '\n'.join(lines)
+
+    def __call__(self, line): # type: (RemoteScriptType, str) -> None
+        '''
+        Sink for script output; splits output into steps at markers
+
+        Args:
+            line (str):
+                line of script stdout
+        '''
+        pos = line.find(self._marker)
+        if pos < 0:
+            self._lines(line)
+            if self.verbose:
+                stdout.write(line)
+            return
+        if pos > 0:
+            self._lines(line[:pos])
+            if self.verbose:
+                stdout.write(line[:pos])
+        idx, returncode = line[pos + len(self._marker):].split()
+        now = time.time()
+        step = self.steps[int(idx)]
+        step.returncode = int(returncode)
+        step.output = self._lines.getvalue()
+        step.duration = now - self._last
+        self._last = now
+        self._lines = RingBufferSink(self.maxsize)
+
+    def finish(self): # type: (RemoteScriptType) -> List[StepResult]
+        '''
+        Close out the script after its output ends
+
+        Output after the last marker belongs to the step that did not
+        report an exit code, e.g. because the SSH connection dropped
+
+        Returns:
+            [:py:class:`floopcli.iot.script.StepResult`]:
+                results for all steps
+        '''
+        for step in self.steps:
+            if step.returncode is None:
+                step.output = self._lines.getvalue()
+                break
+        self._lines = RingBufferSink(self.maxsize)
+        return self.steps
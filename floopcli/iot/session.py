@@ -0,0 +1,256 @@
+import json
+import shutil
+import tempfile
+import threading
+
+from os.path import join
+from typing import Any, Dict, List, Optional, TypeVar
+
+from floopcli.iot.machine import connection, store, Connection, MachineNotFound
+from floopcli.util.syscall import syscall, quote, SystemCallException
+
+_SSH_IDLE_TIMEOUT = 60
+'''Seconds an unused master connection stays open before it exits'''
+
+_SSH_OPTIONS = [
+    'ConnectionAttempts=3',
+    'ConnectTimeout=10',
+    'LogLevel=quiet',
+    'PasswordAuthentication=no',
+    'ServerAliveInterval=60',
+    'StrictHostKeyChecking=no',
+    'UserKnownHostsFile=/dev/null',
+    ]
+'''OpenSSH options matching the ones docker-machine ssh uses'''
+
+class SessionResolveException(SystemCallException):
+    '''
+    Could not look up SSH connection details for a core
+    '''
+    pass
+
+class SSHConnectionException(SystemCallException):
+    '''
+    SSH could not reach the core or lost the connection (exit code 255)
+    '''
+    pass
+
+SSH_ERROR = 255
+'''Exit code of ssh itself failing, as opposed to the remote command'''
+
+SSHSessionType = TypeVar('SSHSessionType', bound='SSHSession')
+'''Generic SSHSession type'''
+
+class SSHSession(object):
+    '''
+    Persistent, multiplexed SSH connection to one core
+
+    The first command opens an OpenSSH ControlMaster connection and every
+    following command reuses it, so each remote step costs one channel
+    instead of a process start, machine lookup, and full handshake.
+
+    Args:
+        name (str):
+            core name
+        host (str):
+            SSH host address
+        port (str):
+            SSH port
+        user (str):
+            SSH user
+        key (str):
+            path on host to SSH private key
+        control_dir (str):
+            directory on host for the control socket
+        idle_timeout (int):
+            seconds an unused master connection stays open; None keeps
+            it open until :py:meth:`close`
+    '''
+    def __init__(self, name, host, port, user, key, control_dir,
+            idle_timeout=_SSH_IDLE_TIMEOUT):
+        # type: (SSHSessionType, str, str, str, str, str, str, Optional[int]) -> None
+        self.name = name
+        self.host = host
+        self.port = str(port)
+        self.user = user
+        self.key = key
+        self.control_path = join(control_dir, name)
+        self.idle_timeout = idle_timeout
+
+    def options(self): # type: (SSHSessionType) -> List[str]
+        '''
+        Returns:
+            [str]:
+                ssh options that attach to (or start) the master connection
+        '''
+        options = ['-F', '/dev/null']
+        for option in _SSH_OPTIONS + [
+                'ControlMaster=auto',
+                'ControlPath={}'.format(self.control_path),
+                'ControlPersist={}'.format('yes' if self.idle_timeout is None
+                    else self.idle_timeout)]:
+            options += ['-o', option]
+        return options + ['-i', self.key, '-p', self.port]
+
+    def destination(self): # type: (SSHSessionType) -> str
+        '''
+        Returns:
+            str:
+                user@host for this core
+        '''
+        return '{}@{}'.format(self.user, self.host)
+
+    def command(self, remote, agent=None): # type: (SSHSessionType, str, Optional[str]) -> List[str]
+        '''
+        Build the host command that runs a command on the core
+
+        Args:
+            remote (str):
+                shell command to run on the core
+            agent (str):
+                socket of an ssh-agent to forward to the command; the
+                command then gets its own connection, because a shared
+                one would forward the agent of the master process
+        Returns:
+            [str]:
+                ssh argument list
+        '''
+        if agent is None:
+            return ['ssh'] + self.options() + [self.destination(), remote]
+        # ssh uses the first value of every option
+        return ['env', 'SSH_AUTH_SOCK={}'.format(agent), 'ssh', '-A',
+                '-o', 'ControlPath=none'] + self.options() + \
+                        [self.destination(), remote]
+
+    def rsync_shell(self): # type: (SSHSessionType) -> str
+        '''
+        Returns:
+            str:
+                remote shell for rsync -e that rides on the master connection
+        '''
+        return ' '.join(quote(arg) for arg in ['ssh'] + self.options())
+
+    def run(self, command, check=True, verbose=False, agent=None, **kwargs):
+        # type: (SSHSessionType, str, bool, bool, Optional[str], **Any) -> str
+        '''
+        Run command on the core over the shared connection
+
+        Args:
+            command (str):
+                shell command to run on the core
+            check (bool):
+                if True, check whether command exit code is non-zero
+            verbose (bool):
+                if True, stream command output to stdout
+            agent (str):
+                socket of an ssh-agent to forward to the command
+        Returns:
+            str:
+                stdout output of the command
+        Raises:
+            :py:class:`floopcli.util.syscall.SystemCallException`:
+                command exit code was non-zero
+            :py:class:`floopcli.iot.session.SSHConnectionException`:
+                check=True and the core could not be reached
+        '''
+        try:
+            out, _ = syscall(self.command(command, agent=agent),
+                    check=check, verbose=verbose, **kwargs)
+        except SystemCallException as e:
+            if e.returncode == SSH_ERROR:
+                error = SSHConnectionException(*e.args)
+                error.returncode = e.returncode
+                raise error
+            raise
+        return out
+
+    def close(self): # type: (SSHSessionType) -> None
+        '''
+        Ask the master connection to exit, if it is running
+        '''
+        syscall(['ssh'] + self.options() + ['-O', 'exit', self.destination()],
+                check=False)
+
+def _resolve(core): # type: (Any) -> Connection
+    '''
+    Look up SSH connection details for a core
+
+    Reads the docker-machine store directly and only falls back to
+    docker-machine inspect when the store has no config for the core
+
+    Args:
+        core (:py:class:`floopcli.iot.core.Core`):
+            initialized target core object
+    Returns:
+        :py:data:`floopcli.iot.machine.Connection`:
+            host, port, user, and key for the core
+    Raises:
+        :py:class:`floopcli.iot.session.SessionResolveException`:
+            docker-machine does not know the core or returned bad output
+    '''
+    try:
+        return store.resolve(core.core)
+    except MachineNotFound:
+        pass
+    try:
+        out, _ = syscall([core.host_docker_machine_bin, 'inspect', core.core],
+                check=True)
+        return connection(json.loads(out))
+    except (SystemCallException, ValueError, KeyError, TypeError) as e:
+        raise SessionResolveException('{}: {}'.format(core.core, repr(e)))
+
+_sessions = {} # type: Dict[str, SSHSession]
+_sessions_lock = threading.Lock()
+_control_dir = [] # type: List[str]
+_idle_timeout = [_SSH_IDLE_TIMEOUT] # type: List[Optional[int]]
+
+def use_idle_timeout(seconds=_SSH_IDLE_TIMEOUT): # type: (Optional[int]) -> None
+    '''
+    Set how long unused master connections of new sessions stay open
+
+    Args:
+        seconds (int):
+            idle seconds; None keeps them open until
+            :py:func:`close_sessions`, e.g. while watching for changes
+    '''
+    _idle_timeout[:] = [seconds]
+
+def get_session(core): # type: (Any) -> SSHSession
+    '''
+    Get the shared SSH session for a core, creating it on first use
+
+    Safe to call from the threads of the CLI fan-out
+
+    Args:
+        core (:py:class:`floopcli.iot.core.Core`):
+            initialized target core object
+    Returns:
+        :py:class:`floopcli.iot.session.SSHSession`:
+            session for the core
+    '''
+    with _sessions_lock:
+        session = _sessions.get(core.core)
+        if session is not None:
+            return session
+        if not _control_dir:
+            # keep the path short; unix sockets have a ~100 byte limit
+            _control_dir.append(tempfile.mkdtemp(prefix='floop-'))
+        control_dir = _control_dir[0]
+    # resolve outside of the lock so cores do not wait on each other
+    details = _resolve(core)
+    session = SSHSession(name=core.core, host=details.host, port=details.port,
+            user=details.user, key=details.key, control_dir=control_dir,
+            idle_timeout=_idle_timeout[0])
+    with _sessions_lock:
+        return _sessions.setdefault(core.core, session)
+
+def close_sessions(): # type: () -> None
+    '''
+    Close every open session and remove the control socket directory
+    '''
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+        while _control_dir:
+            shutil.rmtree(_control_dir.pop(), ignore_errors=True)
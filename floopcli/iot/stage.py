@@ -0,0 +1,106 @@
+import threading
+import time
+
+from typing import Any, Dict, Optional, Tuple, TypeVar
+
+from floopcli.iot.result import record_step
+from floopcli.util.syscall import Budget
+
+STAGES = ['push', 'build', 'run']
+'''
+Stages of core operations; every core goes through them in this order,
+independently of the other cores
+'''
+
+_limits = {} # type: Dict[str, Tuple[int, Any]]
+
+def use_stage_limits(limits): # type: (Optional[Dict[str, int]]) -> None
+    '''
+    Limit how many cores can be in each stage at the same time
+
+    Args:
+        limits (dict):
+            stage name to maximum number of cores; stages that are
+            missing or None are not limited, and None removes all limits
+    Raises:
+        :py:class:`ValueError`:
+            unknown stage name or limit smaller than 1
+    '''
+    _limits.clear()
+    for name, limit in (limits or {}).items():
+        if name not in STAGES:
+            raise ValueError('Unknown stage: {}'.format(name))
+        if limit is None:
+            continue
+        if limit < 1:
+            raise ValueError('Stage limit must be at least 1: {}'.format(limit))
+        _limits[name] = (limit, threading.BoundedSemaphore(limit))
+
+def stage_limit(name): # type: (str) -> Optional[int]
+    '''
+    Returns:
+        int:
+            maximum number of cores in stage at the same time, or None
+    '''
+    if name in _limits:
+        return _limits[name][0]
+    return None
+
+def limited(*names): # type: (*str) -> bool
+    '''
+    Returns:
+        bool:
+            if True, at least one of the named stages has a limit
+    '''
+    return any(name in _limits for name in names)
+
+StageType = TypeVar('StageType', bound='Stage')
+'''Generic Stage type'''
+
+class Stage(object):
+    '''
+    Context manager that holds a slot of a stage for one core
+
+    Blocks on entry while the stage is full. Stages without a limit
+    never block, so core operations can always use it. The time spent
+    inside, not counting the wait for a slot, goes to the result of the
+    current core operation, see :py:func:`floopcli.iot.result.record_step`.
+    System calls inside get the stage budget of the core, if it has one,
+    see :py:class:`floopcli.util.syscall.Budget`.
+
+    Only work that loads the resource a stage stands for should hold a
+    slot: transfers from the host for push, builds for build, and
+    containers for run. Waiting for another core (relay and group build
+    parents) must happen outside, or a full stage could wait on a core
+    that cannot enter it.
+
+    Args:
+        name (str):
+            one of :py:data:`STAGES`
+        core (:py:class:`floopcli.iot.core.Core`):
+            core in the stage, for its time budgets
+    '''
+    def __init__(self, name, core=None): # type: (StageType, str, Any) -> None
+        self.name = name
+        seconds = None
+        if core is not None:
+            seconds = getattr(core, 'timeouts', {}).get(name)
+        self._budget = Budget(name, seconds)
+        self._semaphore = None # type: Any
+        self._start = 0.0
+
+    def __enter__(self): # type: (StageType) -> StageType
+        limit = _limits.get(self.name)
+        if limit is not None:
+            self._semaphore = limit[1]
+            self._semaphore.acquire()
+        self._start = time.time()
+        self._budget.__enter__()
+        return self
+
+    def __exit__(self, *exc): # type: (StageType, *Any) -> None
+        self._budget.__exit__(*exc)
+        record_step(self.name, time.time() - self._start)
+        if self._semaphore is not None:
+            self._semaphore.release()
+            self._semaphore = None
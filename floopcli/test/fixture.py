@@ -2,13 +2,16 @@ import pytest
 
 import json
 
+import floopcli.util.state as state
+
+from collections import namedtuple
 from copy import copy
 from os import remove, environ, mkdir
 from os.path import abspath, dirname, isfile, isdir
 
 from shutil import rmtree
 from distutils.spawn import find_executable as which
-from typing import Dict
+from typing import Any, Dict
 
 from floopcli.config import _FLOOP_CONFIG_DEFAULT_CONFIGURATION
 from floopcli.util.syscall import syscall
@@ -29,6 +32,19 @@ _DEVICE_TEST_SRC_DIRECTORY = '{}/src/'.format(dirname(
     abspath(__file__))
     )
 
+# stand-in for a Core in unit tests that do not talk to docker-machine
+FakeCore = namedtuple('FakeCore', ['core', 'host_source', 'group', 'user',
+    'address', 'port', 'target_source', 'timeouts'])
+FakeCore.__new__.__defaults__ = (None, None, 'floop', '192.168.1.100', '22', # type: ignore
+        '/home/floop/floop', {})
+
+@pytest.fixture(scope='function')
+def fixture_state_dir(tmpdir, monkeypatch): # type: (Any, Any) -> str
+    # keep core state, manifests, and caches out of the real state directory
+    path = str(tmpdir.join('.floop'))
+    monkeypatch.setattr(state, '_FLOOP_STATE_DIR', path)
+    return path
+
 @pytest.fixture(scope='module')
 def fixture_docker_machine_bin(): # type: () -> str
     return which('docker-machine') 
@@ -153,6 +153,7 @@ class TestPS():
         for base in fixture_cli_base:
             syscall('{} ps'.format(base), check=True)
             syscall('{} ps -v'.format(base), check=True)
+            syscall('{} ps -j 1'.format(base), check=True)
 
     def test_cli_ps_nonexistent_config_file_fails(self):
         with pytest.raises(SystemCallException):
@@ -3,7 +3,7 @@ import pytest
 from os import remove
 from os.path import abspath, dirname, isfile
 
-from floopcli.config import Config, ConfigFileDoesNotExist, CannotSetImmutableAttributeException, MalformedConfigException, RedundantCoreConfigException
+from floopcli.config import _flatten, Config, ConfigFileDoesNotExist, CannotSetImmutableAttributeException, MalformedConfigException, RedundantCoreConfigException
 from floopcli.test.fixture import *
 
 def test_floop_config_init(fixture_valid_config_file):
@@ -39,3 +39,14 @@ def test_floop_config_redundant_config_fails(fixture_redundant_config_file):
 def test_floop_config_missing_property_config_fails(fixture_missing_property_config_file):
     with pytest.raises(MalformedConfigException):
         Config(fixture_missing_property_config_file).read().parse()
+
+def test_floop_config_merges_timeouts():
+    config = {'groups': {
+        'default': {'timeouts': {'push': 60}},
+        'group0': {'cores': {
+            'default': {'timeouts': {'build': 600}},
+            'core0': {'address': '1.2.3.4', 'timeouts': {'push': None}},
+        }}}}
+    flat = _flatten(config)
+    assert flat[0]['timeouts'] == {'push': None, 'build': 600}
+    assert config['groups']['default']['timeouts'] == {'push': 60}
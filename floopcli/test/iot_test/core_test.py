@@ -5,6 +5,7 @@ import json
 from shutil import rmtree
 from distutils.spawn import find_executable as which
 from copy import copy
+from floopcli.util.state import read_core_state
 from floopcli.util.syscall import syscall
 from floopcli.test.fixture import *
 from floopcli.iot.core import create, build, run, push, ps, _test, destroy, \
@@ -64,6 +65,14 @@ def test_core_push_protected_target_dir_fails(fixture_protected_target_directory
 def test_core_build(fixture_valid_core, fixture_buildfile):
     build(fixture_valid_core)
 
+def test_core_build_skips_unchanged_context(fixture_valid_core, fixture_buildfile):
+    core = fixture_valid_core
+    build(core)
+    built = read_core_state(core.core)['builds'][core.build_file]
+    assert built[1].startswith('sha256:')
+    build(core)
+    assert read_core_state(core.core)['builds'][core.build_file] == built
+
 def test_core_build_no_buildfile_fails(fixture_valid_core, 
         fixture_valid_src_directory, fixture_valid_target_directory):
     with pytest.raises(CoreBuildFileNotFound):
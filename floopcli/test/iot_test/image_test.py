@@ -0,0 +1,129 @@
+import pytest
+
+import floopcli.iot.image as image
+
+from floopcli.iot.image import active_build_plan, active_builder, \
+        core_platform, core_resources, deliver_image, host_image, image_key, \
+        remove_images, use_builder, GroupBuildPlan
+from floopcli.test.fixture import fixture_state_dir, FakeCore
+from floopcli.util.state import read_core_state, update_core_state
+from floopcli.util.syscall import SystemCallException
+
+class FakeSession(object):
+    def __init__(self, images):
+        self.commands = []
+        self.images = images
+    def run(self, command, check=False, stdin=None):
+        self.commands.append(command)
+        if command == 'uname -m':
+            return 'armv7l\n'
+        if command.startswith('nproc'):
+            return '4\n1000\naarch64\n'
+        if command.startswith('docker image inspect'):
+            if command.split()[-1] not in self.images:
+                raise SystemCallException('No such image')
+        return ''
+
+@pytest.fixture(scope='function')
+def fixture_image(tmpdir, monkeypatch, fixture_state_dir):
+    src = tmpdir.mkdir('src')
+    src.join('Dockerfile').write('FROM alpine')
+    session = FakeSession(set())
+    monkeypatch.setattr(image, 'get_session', lambda core: session)
+    builds = []
+    def fake_host_image(platform, source, build_file):
+        builds.append(platform)
+        path = tmpdir.join('image.tar')
+        path.write('image')
+        return str(path)
+    monkeypatch.setattr(image, 'host_image', fake_host_image)
+    def fake_send_image(core, path):
+        session.run('docker load')
+        return 5, 0
+    monkeypatch.setattr(image, 'send_image', fake_send_image)
+    return FakeCore('core0', str(src)), session, builds
+
+def test_builder_default():
+    assert active_builder() == 'core'
+    use_builder('host')
+    assert active_builder() == 'host'
+    assert active_build_plan() is None
+    use_builder(None)
+    assert active_builder() == 'core'
+
+def test_core_resources(fixture_image):
+    core, session, _ = fixture_image
+    assert core_resources(core) == (4, 1024000)
+    assert core_resources(core) == (4, 1024000)
+    assert len(session.commands) == 1
+    assert core_platform(core) == 'linux/arm64'
+    core_resources(core, refresh=True)
+    assert len(session.commands) == 2
+
+def test_group_build_plan(fixture_image):
+    source = fixture_image[0].host_source
+    cores = [FakeCore('core{}'.format(idx), source, 'group{}'.format(idx // 4))
+            for idx in range(6)]
+    for idx, core in enumerate(cores):
+        update_core_state(core.core, arch='aarch64' if idx != 3 else 'x86_64',
+                cpus=4 if idx != 2 else 8, memory=1000 + idx)
+    plan = GroupBuildPlan(cores)
+    parents = dict((core.core, plan.parent(core)) for core in cores)
+    # group0 aarch64: core2 has the most CPUs, then core1 the most memory
+    assert parents['core2'] is None
+    assert parents['core1'].core == 'core2'
+    assert parents['core0'].core == 'core2'
+    # only core of its platform, only builder in group1
+    assert parents['core3'] is None
+    assert parents['core5'] is None
+    assert parents['core4'].core == 'core5'
+    order = [core.core for core in plan.order()]
+    assert order.index('core2') < order.index('core1')
+
+def test_core_platform_cached(fixture_image):
+    core, session, _ = fixture_image
+    assert core_platform(core) == 'linux/arm/v7'
+    assert core_platform(core) == 'linux/arm/v7'
+    assert session.commands == ['uname -m']
+    assert read_core_state('core0')['arch'] == 'armv7l'
+
+def test_image_key(fixture_image):
+    core, _, _ = fixture_image
+    key = image_key('linux/arm/v7', core.host_source, 'Dockerfile')
+    assert key != image_key('linux/arm64', core.host_source, 'Dockerfile')
+    assert key != image_key('linux/arm/v7', core.host_source, 'Dockerfile.test')
+
+def test_deliver_image_once(fixture_image):
+    core, session, builds = fixture_image
+    tag, sent, saved = deliver_image(core, 'Dockerfile')
+    assert (sent, saved) == (5, 0)
+    assert builds == ['linux/arm/v7']
+    assert 'docker load' in session.commands
+    session.images.add(tag)
+    session.commands = []
+    assert deliver_image(core, 'Dockerfile') == (tag, 0, 0)
+    assert builds == ['linux/arm/v7']
+    assert 'docker load' not in session.commands
+    # image removed on core
+    session.images.clear()
+    deliver_image(core, 'Dockerfile')
+    assert 'docker load' in session.commands
+
+def test_host_image_failure_shared(fixture_image, monkeypatch):
+    core, _, _ = fixture_image
+    calls = []
+    def failing_build(command, check=False):
+        calls.append(command)
+        raise SystemCallException('no buildx')
+    monkeypatch.setattr(image, 'syscall', failing_build)
+    try:
+        for _ in range(3):
+            with pytest.raises(SystemCallException):
+                host_image('linux/arm/v7', core.host_source, 'Dockerfile')
+        assert len(calls) == 1
+    finally:
+        remove_images()
+    with pytest.raises(SystemCallException):
+        host_image('linux/arm/v7', core.host_source, 'Dockerfile')
+    assert len(calls) == 2
+    remove_images()
@@ -0,0 +1,66 @@
+import hashlib
+import io
+import json
+import pytest
+import tarfile
+
+import floopcli.iot.layers as layers
+
+from floopcli.iot.layers import archive_layers, chain_ids, core_layers, \
+        layer_diff_archive, remove_layer_diffs
+from floopcli.test.fixture import FakeCore
+
+def _add(archive, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    archive.addfile(info, io.BytesIO(data))
+
+@pytest.fixture(scope='function')
+def fixture_archive(tmpdir):
+    path = str(tmpdir.join('image.tar'))
+    contents = [b'base' * 100, b'deps' * 10, b'app']
+    diff_ids = ['sha256:' + hashlib.sha256(c).hexdigest() for c in contents]
+    with tarfile.open(path, 'w') as archive:
+        for idx, content in enumerate(contents):
+            _add(archive, 'layer{}/layer.tar'.format(idx), content)
+        _add(archive, 'config.json', json.dumps(
+            {'rootfs': {'type': 'layers', 'diff_ids': diff_ids}}).encode('utf-8'))
+        _add(archive, 'manifest.json', json.dumps([{'Config': 'config.json',
+            'RepoTags': ['floop-image:x'],
+            'Layers': ['layer{}/layer.tar'.format(idx) for idx in range(3)]}]
+            ).encode('utf-8'))
+    yield path, diff_ids
+    remove_layer_diffs()
+
+def test_chain_ids():
+    assert chain_ids([]) == []
+    assert chain_ids(['sha256:a']) == ['sha256:a']
+    assert chain_ids(['sha256:a', 'sha256:b'])[1] == 'sha256:' + \
+            hashlib.sha256(b'sha256:a sha256:b').hexdigest()
+
+def test_archive_layers(fixture_archive):
+    path, diff_ids = fixture_archive
+    found = archive_layers(path)
+    assert [member for member, _, _ in found] == \
+            ['layer0/layer.tar', 'layer1/layer.tar', 'layer2/layer.tar']
+    assert [chain for _, chain, _ in found] == chain_ids(diff_ids)
+    assert [size for _, _, size in found] == [400, 40, 3]
+
+def test_layer_diff_archive(fixture_archive):
+    path, diff_ids = fixture_archive
+    assert layer_diff_archive(path, set()) == (path, 0)
+    present = set(chain_ids(diff_ids)[:2])
+    diff, saved = layer_diff_archive(path, present)
+    assert saved == 440
+    with tarfile.open(diff) as archive:
+        assert sorted(archive.getnames()) == \
+                ['config.json', 'layer2/layer.tar', 'manifest.json']
+    assert layer_diff_archive(path, present) == (diff, saved)
+
+def test_core_layers(monkeypatch):
+    class FakeSession(object):
+        def run(self, command, check=False):
+            return '["sha256:a","sha256:b"]\n["sha256:c"]\n'
+    monkeypatch.setattr(layers, 'get_session', lambda core: FakeSession())
+    present = core_layers(FakeCore('core0'))
+    assert present == set(chain_ids(['sha256:a', 'sha256:b']) + ['sha256:c'])
@@ -0,0 +1,42 @@
+import pytest
+import json
+
+from os import makedirs
+from os.path import join
+
+from floopcli.iot.machine import MachineStore, MachineNotFound
+
+def _write_machine(path, name, driver='generic'):
+    machine_dir = join(path, 'machines', name)
+    makedirs(machine_dir)
+    with open(join(machine_dir, 'config.json'), 'w') as c:
+        json.dump({'DriverName' : driver, 'Driver' : {
+            'IPAddress' : '192.168.1.100',
+            'SSHPort' : 22,
+            'SSHUser' : 'floop',
+            'SSHKeyPath' : join(machine_dir, 'id_rsa')}}, c)
+
+def test_machine_store_resolve(tmpdir):
+    _write_machine(str(tmpdir), 'core0')
+    details = MachineStore(str(tmpdir)).resolve('core0')
+    assert details.host == '192.168.1.100'
+    assert details.port == '22'
+    assert details.user == 'floop'
+
+def test_machine_store_resolve_is_cached(tmpdir):
+    _write_machine(str(tmpdir), 'core0')
+    machines = MachineStore(str(tmpdir))
+    details = machines.resolve('core0')
+    tmpdir.join('machines', 'core0', 'config.json').remove()
+    assert machines.resolve('core0') is details
+    machines.forget('core0')
+    with pytest.raises(MachineNotFound):
+        machines.resolve('core0')
+
+def test_machine_store_virtualbox_uses_loopback(tmpdir):
+    _write_machine(str(tmpdir), 'core0', driver='virtualbox')
+    assert MachineStore(str(tmpdir)).resolve('core0').host == '127.0.0.1'
+
+def test_machine_store_missing_machine_fails(tmpdir):
+    with pytest.raises(MachineNotFound):
+        MachineStore(str(tmpdir)).resolve('thisshouldfail')
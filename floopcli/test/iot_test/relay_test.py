@@ -0,0 +1,74 @@
+import pytest
+
+import floopcli.iot.relay as relay
+
+from floopcli.iot.relay import relay_path, RelayPlan
+from floopcli.test.fixture import fixture_state_dir, FakeCore
+from floopcli.util.manifest import push_target, source_manifest
+from floopcli.util.state import clear_core_state, update_core_state
+
+@pytest.fixture(scope='function')
+def fixture_cores(tmpdir, fixture_state_dir):
+    src = tmpdir.mkdir('src')
+    src.join('a.txt').write('a')
+    return [FakeCore('core{}'.format(idx), str(src) + '/', group='group0',
+        address='192.168.1.{}'.format(idx), target_source='/home/floop/src')
+            for idx in range(7)]
+
+def test_relay_plan_tree(fixture_cores):
+    plan = RelayPlan(fixture_cores, 2)
+    parents = [plan.parent(core) for core in plan.order()]
+    assert parents[:2] == [None, None]
+    assert [p.core for p in parents[2:]] == \
+            ['core0', 'core0', 'core1', 'core1', 'core2']
+
+def test_relay_plan_skips_up_to_date_cores(fixture_cores):
+    digest = source_manifest(fixture_cores[0].host_source).digest
+    update_core_state('core0', manifest=digest,
+            target=push_target(fixture_cores[0]))
+    plan = RelayPlan(fixture_cores, 2)
+    assert not plan.covers(fixture_cores[0])
+    assert plan.order()[-1].core == 'core0'
+    assert plan.parent(fixture_cores[1]) is None
+
+def test_relay_plan_ignores_push_to_other_target(fixture_cores):
+    digest = source_manifest(fixture_cores[0].host_source).digest
+    moved = fixture_cores[0]._replace(target_source='/home/floop/other')
+    update_core_state('core0', manifest=digest, target=push_target(moved))
+    assert RelayPlan(fixture_cores, 2).covers(fixture_cores[0])
+    update_core_state('core0', target=push_target(fixture_cores[0]))
+    assert not RelayPlan(fixture_cores, 2).covers(fixture_cores[0])
+    clear_core_state('core0')
+    assert RelayPlan(fixture_cores, 2).covers(fixture_cores[0])
+
+def test_relay_plan_releases_children_on_failure(fixture_cores):
+    plan = RelayPlan(fixture_cores, 2)
+    def fail(core):
+        raise ValueError
+    with pytest.raises(ValueError):
+        plan.run(fail, fixture_cores[0])
+    assert plan.wait(fixture_cores[0]) is False
+    plan.done(fixture_cores[0], True)
+    assert plan.wait(fixture_cores[0]) is False
+
+def test_relay_plan_removes_copies_after_children(fixture_cores, monkeypatch):
+    removed = []
+    class FakeSession(object):
+        def __init__(self, core):
+            self.core = core
+        def run(self, command, check=True):
+            removed.append((self.core.core, command))
+    monkeypatch.setattr(relay, 'get_session', FakeSession)
+    plan = RelayPlan(fixture_cores, 2)
+    def push(core):
+        plan.hold(core, 'abc')
+        plan.done(core, True)
+    for core in plan.order()[:6]:
+        plan.run(push, core)
+    # core2 still has to serve core6
+    assert sorted(name for name, _ in removed) == \
+            ['core0', 'core1', 'core3', 'core4', 'core5']
+    plan.run(push, plan.order()[6])
+    assert sorted(name for name, _ in removed) == \
+            ['core0', 'core1', 'core2', 'core3', 'core4', 'core5', 'core6']
+    assert removed[-1][1] == 'rm -f {}'.format(relay_path('abc'))
@@ -0,0 +1,94 @@
+from functools import partial
+
+from floopcli.iot.result import collect, current_result, record_bytes, \
+        summary, unless_cancelled
+from floopcli.iot.stage import Stage
+from floopcli.test.fixture import FakeCore
+from floopcli.util.syscall import syscall, cancel_syscalls, reset_syscalls, \
+        SystemCallException
+
+def test_collect_records_stages_and_bytes():
+    def operation(core):
+        with Stage('push'):
+            record_bytes(100)
+        with Stage('build'):
+            pass
+        with Stage('push'):
+            record_bytes(20)
+    result = collect(operation, FakeCore('core0'))
+    assert result.ok
+    assert result.bytes == 120
+    assert [name for name, _ in result.steps] == ['push', 'build']
+    assert result.error is None
+    assert current_result() is None
+
+def test_collect_keeps_exception():
+    def operation(core):
+        raise ValueError('broken')
+    result = collect(operation, FakeCore('core0'))
+    assert result.status == 'failed'
+    assert result.error == 'ValueError'
+    assert result.message == 'broken'
+    assert isinstance(result.exception, ValueError)
+    assert result.as_dict()['error'] == 'ValueError'
+
+def test_summary_lists_failures_first():
+    def ok(core):
+        with Stage('push'):
+            record_bytes(2048)
+    def fail(core):
+        raise ValueError
+    results = [collect(ok, FakeCore('core0')), collect(fail, FakeCore('core1'))]
+    lines = summary(results).splitlines()
+    assert lines[0].split() == ['core', 'status', 'time', 'push', 'bytes', 'error']
+    assert lines[1].split()[:2] == ['core1', 'failed']
+    assert lines[1].split()[-1] == 'ValueError'
+    assert lines[2].split()[:2] == ['core0', 'ok']
+    assert '2.0K' in lines[2]
+    assert lines[-1] == '2 core(s): 1 ok, 1 failed'
+
+def test_collect_skips_cores_after_cancel():
+    called = []
+    cancel_syscalls()
+    try:
+        result = collect(partial(unless_cancelled, called.append),
+                FakeCore('core0'))
+    finally:
+        reset_syscalls()
+    assert called == []
+    assert result.status == 'cancelled'
+    assert result.error == 'SystemCallCancelled'
+    assert summary([result]).splitlines()[-1] == \
+            '1 core(s): 0 ok, 0 failed, 1 cancelled'
+
+def test_collect_applies_stage_budget():
+    def operation(core):
+        with Stage('build', core):
+            syscall('sleep 5', check=True)
+    result = collect(operation, FakeCore('core0', timeouts={'build': 0.2}))
+    assert result.status == 'timeout'
+    assert result.timeout == 'build'
+    assert result.error == 'SystemCallTimeout'
+    assert result.duration < 4
+
+def test_collect_ignores_handled_timeout():
+    def operation(core):
+        try:
+            syscall('sleep 5', check=True, timeout=0.2)
+        except SystemCallException:
+            pass
+        raise ValueError('unrelated')
+    result = collect(operation, FakeCore('core0'))
+    assert result.status == 'failed'
+    assert result.timeout is None
+
+def test_collect_reports_wrapped_timeout():
+    def operation(core):
+        try:
+            with Stage('build', core):
+                syscall('sleep 5', check=True)
+        except SystemCallException as e:
+            raise ValueError(repr(e))
+    result = collect(operation, FakeCore('core0', timeouts={'build': 0.2}))
+    assert result.status == 'timeout'
+    assert result.timeout == 'build'
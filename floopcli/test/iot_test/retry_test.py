@@ -0,0 +1,81 @@
+import pytest
+
+import floopcli.iot.retry as retry
+
+from functools import partial
+
+from floopcli.iot.core import CoreBuildException, CoreCommunicationException, \
+        CoreUnreachableException, create, _test
+from floopcli.iot.retry import retry_policy, with_retries, CircuitBreaker, \
+        CircuitOpenException, RetryPolicy
+from floopcli.test.fixture import fixture_state_dir, FakeCore
+from floopcli.util.state import read_core_state
+
+@pytest.fixture(scope='function')
+def fixture_sleeps(fixture_state_dir, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(retry, '_sleep', sleeps.append)
+    return sleeps
+
+def flaky(failures, exception=CoreUnreachableException):
+    calls = []
+    def operation(core):
+        calls.append(core.core)
+        if len(calls) <= failures:
+            raise exception('unreachable')
+        return 'done'
+    return operation, calls
+
+def test_retry_policy_delay_is_jittered_and_capped():
+    policy = RetryPolicy(10, base=1.0, cap=8.0)
+    for attempt in range(1, 10):
+        delays = [policy.delay(attempt) for _ in range(50)]
+        assert all(0 <= delay <= min(8.0, 2 ** (attempt - 1)) for delay in delays)
+        assert len(set(delays)) > 1
+
+def test_retry_policy_per_operation():
+    assert retry_policy(partial(create, timeout=10)).attempts == 1
+    assert retry_policy(_test).attempts == 3
+    assert retry_policy(_test, attempts=5).attempts == 5
+
+def test_with_retries_retries_communication_failures(fixture_sleeps):
+    operation, calls = flaky(2)
+    assert with_retries(operation, RetryPolicy(3), CircuitBreaker(),
+            FakeCore('core0')) == 'done'
+    assert len(calls) == 3
+    assert len(fixture_sleeps) == 2
+    assert read_core_state('core0')['failures'] == []
+
+def test_with_retries_gives_up(fixture_sleeps):
+    operation, calls = flaky(5)
+    with pytest.raises(CoreCommunicationException):
+        with_retries(operation, RetryPolicy(3), None, FakeCore('core0'))
+    assert len(calls) == 3
+
+@pytest.mark.parametrize('exception', [CoreBuildException,
+    CoreCommunicationException])
+def test_with_retries_does_not_retry_other_failures(fixture_sleeps, exception):
+    operation, calls = flaky(1, exception)
+    with pytest.raises(exception):
+        with_retries(operation, RetryPolicy(3), CircuitBreaker(),
+                FakeCore('core0'))
+    assert len(calls) == 1
+    assert fixture_sleeps == []
+    assert CircuitBreaker(threshold=1).allow('core0')
+
+def test_circuit_breaker_opens_and_persists(fixture_sleeps):
+    operation, calls = flaky(10)
+    with pytest.raises(CoreCommunicationException):
+        with_retries(operation, RetryPolicy(2), CircuitBreaker(threshold=3),
+                FakeCore('core0'))
+    with pytest.raises(CircuitOpenException):
+        with_retries(operation, RetryPolicy(2), CircuitBreaker(threshold=3),
+                FakeCore('core0'))
+    assert len(calls) == 3
+    # other cores and unguarded operations are not held back
+    assert CircuitBreaker(threshold=3).allow('core1')
+    with pytest.raises(CoreCommunicationException):
+        with_retries(operation, RetryPolicy(1, guarded=False),
+                CircuitBreaker(threshold=3), FakeCore('core0'))
+    # failures older than the window no longer count
+    assert CircuitBreaker(threshold=3, window=0).allow('core0')
@@ -0,0 +1,32 @@
+import pytest
+
+from floopcli.iot.script import RemoteScript
+from floopcli.util.syscall import syscall
+
+def _run(script):
+    syscall(['sh', '-c', script.render()], check=False,
+            sink=script, capture=False)
+    return script.finish()
+
+def test_remote_script_reports_every_step():
+    steps = _run(RemoteScript(['echo one', 'printf two', 'true']))
+    assert [step.returncode for step in steps] == [0, 0, 0]
+    assert steps[0].output == 'one\n'
+    assert steps[1].output == 'two'
+    assert steps[2].output == ''
+
+def test_remote_script_stops_at_first_failure():
+    steps = _run(RemoteScript(['echo one', 'echo two; false', 'echo three']))
+    assert [step.returncode for step in steps] == [0, 1, None]
+    assert steps[1].output == 'two\n'
+    assert not steps[1].ok
+    assert steps[2].output == ''
+
+def test_remote_script_allows_or_true():
+    steps = _run(RemoteScript(['false || true', 'echo done']))
+    assert all(step.ok for step in steps)
+
+def test_remote_script_keeps_output_tail():
+    steps = _run(RemoteScript(['seq 1000', 'echo done'], maxsize=9))
+    assert steps[0].output == '999\n1000\n'
+    assert steps[1].output == 'done\n'
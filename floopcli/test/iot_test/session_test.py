@@ -0,0 +1,48 @@
+import pytest
+
+import floopcli.iot.session as session
+
+from floopcli.iot.machine import Connection
+from floopcli.iot.session import SSHSession
+from floopcli.test.fixture import FakeCore
+
+@pytest.fixture(scope='function')
+def fixture_session():
+    return SSHSession(name='core0', host='192.168.1.100', port=22,
+            user='floop', key='/home/floop/.ssh/id_rsa',
+            control_dir='/tmp/floop-test', idle_timeout=30)
+
+def test_session_command_reuses_master(fixture_session):
+    command = fixture_session.command('docker ps')
+    assert command[0] == 'ssh'
+    assert command[-2:] == ['floop@192.168.1.100', 'docker ps']
+    assert 'ControlMaster=auto' in command
+    assert 'ControlPath=/tmp/floop-test/core0' in command
+    assert 'ControlPersist=30' in command
+
+def test_session_command_uses_key_and_port(fixture_session):
+    command = fixture_session.command('pwd')
+    assert command[command.index('-i') + 1] == '/home/floop/.ssh/id_rsa'
+    assert command[command.index('-p') + 1] == '22'
+
+def test_session_command_forwards_only_given_agent(fixture_session):
+    command = fixture_session.command('pwd', agent='/tmp/floop-agent/agent')
+    assert command[:4] == ['env', 'SSH_AUTH_SOCK=/tmp/floop-agent/agent',
+            'ssh', '-A']
+    # the first ControlPath wins, so the agent is not forwarded by a master
+    assert command.index('ControlPath=none') < \
+            command.index('ControlPath=/tmp/floop-test/core0')
+
+def test_session_idle_timeout_override(monkeypatch):
+    monkeypatch.setattr(session, '_resolve', lambda core: Connection(
+        host='192.168.1.100', port='22', user='floop', key='/tmp/key'))
+    monkeypatch.setattr(session.SSHSession, 'close', lambda self: None)
+    core = FakeCore('core0')
+    session.use_idle_timeout(None)
+    try:
+        assert 'ControlPersist=yes' in session.get_session(core).command('pwd')
+    finally:
+        session.close_sessions()
+        session.use_idle_timeout()
+    assert 'ControlPersist=60' in session.get_session(core).command('pwd')
+    session.close_sessions()
@@ -0,0 +1,57 @@
+import pytest
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+
+from floopcli.iot.stage import limited, stage_limit, use_stage_limits, Stage
+
+@pytest.fixture(scope='function')
+def fixture_limits():
+    yield
+    use_stage_limits(None)
+
+def test_stage_limits(fixture_limits):
+    use_stage_limits({'push': 2, 'build': None})
+    assert stage_limit('push') == 2
+    assert stage_limit('build') is None
+    assert limited('build', 'push')
+    assert not limited('build', 'run')
+    use_stage_limits(None)
+    assert not limited('push')
+
+def test_stage_limits_invalid(fixture_limits):
+    with pytest.raises(ValueError):
+        use_stage_limits({'deploy': 1})
+    with pytest.raises(ValueError):
+        use_stage_limits({'push': 0})
+
+def test_stage_pipelines_cores(fixture_limits):
+    use_stage_limits({'push': 1})
+    lock = threading.Lock()
+    active = {'push': 0, 'build': 0}
+    peak = {'push': 0, 'build': 0}
+    overlap = []
+    def enter(name):
+        with Stage(name):
+            with lock:
+                active[name] += 1
+                peak[name] = max(peak[name], active[name])
+                if active['push'] and active['build']:
+                    overlap.append(True)
+            time.sleep(0.02)
+            with lock:
+                active[name] -= 1
+    def operation(core):
+        enter('push')
+        enter('build')
+    pool = ThreadPool(4)
+    try:
+        pool.map(operation, range(4))
+    finally:
+        pool.close()
+        pool.join()
+    assert peak['push'] == 1
+    # cores that finished pushing build while the others still push
+    assert overlap
+    assert active == {'push': 0, 'build': 0}
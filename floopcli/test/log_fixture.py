@@ -0,0 +1,55 @@
+import logging
+
+from typing import Any, Optional
+
+from floopcli.util.log import Log
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(message)s'
+'''Format of test log lines, as written by floop'''
+
+def log_record(message, created=None, level='INFO'):
+    # type: (str, Optional[float], str) -> logging.LogRecord
+    '''
+    Make a log record as floop would emit it
+
+    Args:
+        message (str):
+            log message, e.g. 'core0 (target) - push: line'
+        created (float):
+            if set, timestamp of the record, with whole milliseconds
+        level (str):
+            logging level name
+    Returns:
+        :py:class:`logging.LogRecord`:
+            record to emit or handle
+    '''
+    record = logging.LogRecord('floop', getattr(logging, level), __file__, 1,
+            message, None, None)
+    if created is not None:
+        record.created = created
+        record.msecs = 0
+    return record
+
+def open_log(path, maxsize=0, rotate=0, fmt=LOG_FORMAT, **kwargs):
+    # type: (str, int, int, str, **Any) -> Log
+    '''
+    Open a formatted :py:class:`floopcli.util.log.Log` in append mode
+
+    Args:
+        path (str):
+            log file path
+        maxsize (int):
+            bytes after which the log rotates; 0 never rotates
+        rotate (int):
+            number of rotated files to keep
+        fmt (str):
+            format of log lines
+        kwargs:
+            passed on to :py:class:`floopcli.util.log.Log`
+    Returns:
+        :py:class:`floopcli.util.log.Log`:
+            log handler
+    '''
+    log = Log(path, 'a', maxsize, rotate, **kwargs)
+    log.setFormatter(logging.Formatter(fmt))
+    return log
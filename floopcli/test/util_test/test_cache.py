@@ -0,0 +1,74 @@
+import hashlib
+import json
+import pytest
+
+import floopcli.util.cache as cache
+
+from floopcli.test.fixture import fixture_state_dir
+from floopcli.util.cache import BuildCache
+
+def _blob(cache, data):
+    digest = 'sha256:' + hashlib.sha256(data).hexdigest()
+    path = '{}/{}'.format(cache.tmp_dir(), digest.split(':')[1])
+    with open(path, 'wb') as f:
+        f.write(data)
+    return digest, path
+
+@pytest.fixture(scope='function')
+def fixture_cache(fixture_state_dir):
+    return BuildCache(10)
+
+def test_build_cache_add_verifies_digest(fixture_cache):
+    digest, path = _blob(fixture_cache, b'layer')
+    assert fixture_cache.add(digest, path)
+    assert fixture_cache.digests() == set([digest])
+    other, path = _blob(fixture_cache, b'other')
+    assert not fixture_cache.add(digest.replace('sha256:', 'sha256:0'), path)
+    assert fixture_cache.digests() == set([digest])
+
+def test_build_cache_index_needs_blobs(fixture_cache):
+    layer, path = _blob(fixture_cache, b'ab')
+    fixture_cache.add(layer, path)
+    manifest = json.dumps({'layers': [{'digest': layer}]}).encode('utf-8')
+    digest, path = _blob(fixture_cache, manifest)
+    index = {'manifests': [{'digest': digest}]}
+    assert not fixture_cache.set_index('linux/arm/v7', index)
+    fixture_cache.max_bytes = 1024
+    fixture_cache.add(digest, path)
+    assert fixture_cache.set_index('linux/arm/v7', index)
+    assert fixture_cache.index('linux/arm/v7') == index
+    assert fixture_cache.referenced(index) == set([layer, digest])
+
+def test_build_cache_evicts_least_recently_used(fixture_cache, monkeypatch):
+    clock = iter(range(100))
+    monkeypatch.setattr(cache.time, 'time', lambda: next(clock))
+    layer, path = _blob(fixture_cache, b'12345678')
+    fixture_cache.add(layer, path)
+    manifest = json.dumps({'layers': [{'digest': layer}]}).encode('utf-8')
+    digest, path = _blob(fixture_cache, manifest)
+    fixture_cache.max_bytes = 1024
+    fixture_cache.add(digest, path)
+    fixture_cache.set_index('linux/amd64', {'manifests': [{'digest': digest}]})
+    newer, path = _blob(fixture_cache, b'1234')
+    fixture_cache.add(newer, path)
+    fixture_cache.max_bytes = len(manifest) + 4
+    assert fixture_cache.evict() == [layer]
+    assert fixture_cache.digests() == set([digest, newer])
+    assert fixture_cache.index('linux/amd64') is None
+
+def test_build_cache_keeps_pinned_blobs(fixture_cache, monkeypatch):
+    clock = iter(range(100))
+    monkeypatch.setattr(cache.time, 'time', lambda: next(clock))
+    older, path = _blob(fixture_cache, b'1234')
+    fixture_cache.add(older, path)
+    newer, path = _blob(fixture_cache, b'5678')
+    fixture_cache.add(newer, path)
+    fixture_cache.max_bytes = 4
+    with fixture_cache.pinned([older]):
+        with fixture_cache.pinned([older]):
+            pass
+        assert fixture_cache.evict() == [newer]
+    assert fixture_cache.digests() == set([older])
+    assert fixture_cache.evict() == []
+    fixture_cache.max_bytes = 0
+    assert fixture_cache.evict() == [older]
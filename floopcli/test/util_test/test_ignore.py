@@ -0,0 +1,52 @@
+from floopcli.util.ignore import IgnoreMatcher, FLOOP_IGNORE_FILE
+
+def test_ignore_defaults():
+    ignore = IgnoreMatcher([])
+    assert ignore.match('floop.log')
+    assert ignore.match('sub/floop.json')
+    assert ignore.match('.floop', True)
+    assert not ignore.match('main.py')
+
+def test_ignore_patterns():
+    ignore = IgnoreMatcher(['# comment', '', '*.pyc', 'build/', '/top.txt',
+        'docs/**/*.md', 'data/?.bin'])
+    assert ignore.match('a.pyc')
+    assert ignore.match('sub/dir/a.pyc')
+    assert ignore.match('build', True)
+    assert ignore.match('sub/build', True)
+    assert not ignore.match('build')
+    assert ignore.match('top.txt')
+    assert not ignore.match('sub/top.txt')
+    assert ignore.match('docs/a.md')
+    assert ignore.match('docs/x/y/a.md')
+    assert ignore.match('data/1.bin')
+    assert not ignore.match('data/12.bin')
+    assert not ignore.match('# comment')
+
+def test_ignore_negation_last_match_wins():
+    ignore = IgnoreMatcher(['*.log', '!keep.log'])
+    assert ignore.match('a.log')
+    assert not ignore.match('keep.log')
+    assert not ignore.match('sub/keep.log')
+    assert IgnoreMatcher(['!keep.log', '*.log']).match('keep.log')
+    # floop's own files cannot be re-included
+    assert IgnoreMatcher(['!floop.log']).match('floop.log')
+
+def test_ignore_load(tmpdir):
+    assert not IgnoreMatcher.load(str(tmpdir)).match('a.tmp')
+    tmpdir.join(FLOOP_IGNORE_FILE).write('*.tmp\n')
+    assert IgnoreMatcher.load(str(tmpdir)).match('a.tmp')
+
+def test_ignore_rsync_filters():
+    filters = IgnoreMatcher(['*.pyc', '/out/', '!keep.pyc']).rsync_filters('src/')
+    assert filters[0] == '--filter=- .floop'
+    assert filters[-3:] == ['--filter=+ keep.pyc', '--filter=- /src/out/',
+            '--filter=- *.pyc']
+
+def test_ignore_dockerignore():
+    lines = IgnoreMatcher(['*.pyc', '/out/', '!keep.pyc']).dockerignore().split('\n')
+    assert '*.pyc' in lines
+    assert '**/*.pyc' in lines
+    assert 'out' in lines
+    assert '**/out' not in lines
+    assert lines.index('!**/keep.pyc') > lines.index('**/*.pyc')
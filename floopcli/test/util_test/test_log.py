@@ -0,0 +1,55 @@
+import time
+
+from floopcli.test.log_fixture import log_record, open_log
+
+def _log(path, **kwargs):
+    return open_log(path, fmt='%(levelname)s %(message)s', **kwargs)
+
+def test_log_writes_batch_on_flush(tmpdir):
+    path = tmpdir.join('floop.log')
+    log = _log(str(path), interval=60)
+    for idx in range(100):
+        log.emit(log_record('line {}'.format(idx)))
+    log.flush()
+    lines = path.read().splitlines()
+    assert lines[0] == 'INFO line 0'
+    assert lines[-1] == 'INFO line 99'
+    log.close()
+
+def test_log_writes_batch_after_interval(tmpdir):
+    path = tmpdir.join('floop.log')
+    log = _log(str(path), interval=0.05)
+    log.emit(log_record('line'))
+    start = time.time()
+    while not path.read() and time.time() - start < 5:
+        time.sleep(0.01)
+    assert path.read() == 'INFO line\n'
+    log.close()
+
+def test_log_rolls_over_inside_batch(tmpdir):
+    path = tmpdir.join('floop.log')
+    log = _log(str(path), maxsize=100, rotate=1, interval=60)
+    for idx in range(10):
+        log.emit(log_record('line {}'.format(idx)))
+    log.close()
+    old = tmpdir.join('floop.log.1').read().splitlines()
+    new = path.read().splitlines()
+    assert old + new == ['INFO line {}'.format(idx) for idx in range(10)]
+    assert len(tmpdir.join('floop.log.1').read()) < 100
+
+def test_log_flush_returns_when_write_fails(tmpdir, capsys):
+    log = _log(str(tmpdir.join('floop.log')), interval=60)
+    def fail(pending):
+        raise IOError('disk full')
+    log._write = fail
+    log.emit(log_record('line'))
+    start = time.time()
+    log.flush(timeout=5)
+    assert time.time() - start < 1
+    # the receiver keeps going after the failed batch
+    del log._write
+    log.emit(log_record('line 2'))
+    log.flush()
+    assert tmpdir.join('floop.log').read() == 'INFO line 2\n'
+    assert 'disk full' in capsys.readouterr().err
+    log.close()
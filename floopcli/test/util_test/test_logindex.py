@@ -0,0 +1,80 @@
+import os
+import pytest
+import time
+
+from floopcli.test.log_fixture import log_record, open_log
+from floopcli.util.log import Log
+from floopcli.util.logindex import index_path, parse_time, query, LogFilter
+
+@pytest.fixture(scope='function')
+def fixture_log(tmpdir):
+    path = str(tmpdir.join('floop.log'))
+    with open(path, 'w') as f:
+        f.write('unindexed line written before the index\n')
+    log = open_log(path)
+    start = time.mktime((2018, 1, 31, 12, 0, 0, 0, 0, -1))
+    for idx in range(30):
+        core = 'core{}'.format(idx % 3)
+        function = 'push' if idx < 15 else 'build'
+        level = 'ERROR' if idx % 5 == 0 else 'INFO'
+        log.emit(log_record('{} (target) - {}: line {}'.format(
+            core, function, idx), start + idx * 60, level))
+    log.emit(log_record('no core on this line', start + 30 * 60))
+    log.close()
+    return path, start
+
+def _numbers(lines):
+    return [int(line.split()[-1]) for line in lines]
+
+def test_query_by_core_and_level(fixture_log):
+    path, _ = fixture_log
+    assert _numbers(query(path, LogFilter(core='core1'))) == \
+            list(range(1, 30, 3))
+    assert _numbers(query(path, LogFilter(core='core0', level='ERROR'))) == \
+            [0, 15]
+    assert _numbers(query(path, LogFilter(function='build', level='WARNING'))) == \
+            [15, 20, 25]
+    assert list(query(path, LogFilter(core='core9'))) == []
+
+def test_query_by_time(fixture_log):
+    path, start = fixture_log
+    lines = list(query(path, LogFilter(since=start + 10 * 60,
+        until=start + 12 * 60)))
+    assert _numbers(lines) == [10, 11, 12]
+    assert lines[0].startswith('2018-01-31 12:10:00,000 ERROR core1')
+
+def test_query_scans_unindexed_lines(fixture_log):
+    path, start = fixture_log
+    with open(path, 'a') as f:
+        f.write('2018-01-31 13:00:00,000 INFO core1 (target) - run: line 99\n')
+    assert _numbers(query(path, LogFilter(core='core1')))[-2:] == [28, 99]
+    # a process that does not write leaves the index alone
+    lines = os.path.getsize(os.path.join(index_path(path), 'lines'))
+    log = Log(path, 'a', 0, 0)
+    log.close()
+    assert os.path.getsize(os.path.join(index_path(path), 'lines')) == lines
+    assert _numbers(query(path, LogFilter(core='core1', since=start))) == \
+            list(range(1, 30, 3)) + [99]
+
+def test_index_shared_by_writers(tmpdir):
+    path = str(tmpdir.join('floop.log'))
+    logs = [open_log(path, batch=0) for _ in range(2)]
+    start = time.mktime((2018, 1, 31, 12, 0, 0, 0, 0, -1))
+    for idx in range(10):
+        log = logs[idx % 2]
+        log.emit(log_record('core{} (target) - push: line {}'.format(
+            idx % 2, idx), start + idx))
+        log.flush()
+    for log in logs:
+        log.close()
+    # every record is indexed, none is scanned
+    with open(os.path.join(index_path(path), 'start')) as f:
+        assert f.read() == '0'
+    assert os.path.getsize(os.path.join(index_path(path), 'lines')) == 10 * 20
+    assert _numbers(query(path, LogFilter(core='core1'))) == [1, 3, 5, 7, 9]
+
+def test_parse_time():
+    assert parse_time('10m', now=1000.0) == 400.0
+    assert parse_time('2018-01-31') == time.mktime((2018, 1, 31, 0, 0, 0, 0, 0, -1))
+    with pytest.raises(ValueError):
+        parse_time('yesterday')
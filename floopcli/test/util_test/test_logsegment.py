@@ -0,0 +1,93 @@
+from os.path import getsize
+
+from floopcli.test.log_fixture import log_record, open_log
+from floopcli.util.logindex import LogFilter
+from floopcli.util.logsegment import LogSegments, segments
+from floopcli.util.logshard import read
+
+def _log(path, **kwargs):
+    return open_log(path, 300, batch=0, segments=True, **kwargs)
+
+def test_rotate_compress_and_read(tmpdir):
+    path = str(tmpdir.join('floop.log'))
+    log = _log(path)
+    start = 1517400000.0
+    for step in range(20):
+        log.emit(log_record('core{} (target) - build: step {}'.format(
+            step % 2, step), start + step))
+    log.close()
+    closed = segments(path)
+    assert len(closed) > 1
+    assert all(segment.endswith('.gz') for _, segment in closed)
+    lines = list(read(path))
+    assert [line.split()[-1] for line in lines] == [str(step) for step in range(20)]
+    core1 = list(read(path, LogFilter(core='core1')))
+    assert [line.split()[-1] for line in core1] == \
+            [str(step) for step in range(1, 20, 2)]
+
+def test_keep_bytes(tmpdir):
+    path = str(tmpdir.join('floop.log'))
+    log = _log(path, keep_bytes=250, compress=False)
+    for step in range(40):
+        log.emit(log_record('core0 (target) - build: step {}'.format(step),
+            1517400000.0 + step))
+    log.close()
+    closed = segments(path)
+    assert closed
+    assert sum(getsize(segment) for _, segment in closed) <= 250
+    lines = list(read(path))
+    assert lines[-1].split()[-1] == '39'
+    assert lines[0].split()[-1] != '0'
+
+def test_segments_prefer_compressed(tmpdir):
+    path = str(tmpdir.join('floop.log'))
+    for name in ['floop.log.20180131-134500', 'floop.log.20180131-134500.gz',
+            'floop.log.20180131-134500-1', 'floop.log.20180131-134500.gz.tmp',
+            'floop.log.index']:
+        tmpdir.join(name).write('')
+    assert [segment for _, segment in segments(path)] == \
+            [path + '.20180131-134500.gz', path + '.20180131-134500-1']
+
+def test_leftover_segments_compressed_on_rotation(tmpdir):
+    path = str(tmpdir.join('floop.log'))
+    tmpdir.join('floop.log.20180131-134500').write(
+            '2018-01-31 13:44:00,000 INFO core0 (target) - push: left\n')
+    # readers leave segments alone
+    LogSegments(path).close()
+    assert [segment for _, segment in segments(path)] == \
+            [path + '.20180131-134500']
+    log = _log(path)
+    for step in range(10):
+        log.emit(log_record('core0 (target) - build: step {}'.format(step),
+            1517400000.0 + step))
+    log.close()
+    closed = [segment for _, segment in segments(path)]
+    assert closed[0] == path + '.20180131-134500.gz'
+    assert all(segment.endswith('.gz') for segment in closed)
+    assert list(read(path))[0] == \
+            '2018-01-31 13:44:00,000 INFO core0 (target) - push: left\n'
+
+def test_compress_same_segment_twice(tmpdir):
+    path = str(tmpdir.join('floop.log'))
+    segment = tmpdir.join('floop.log.20180131-134500')
+    segment.write('2018-01-31 13:44:00,000 INFO core0 (target) - push: left\n' * 1000)
+    first, second = LogSegments(path), LogSegments(path)
+    first._compress(str(segment))
+    # the second process lost the race; nothing to do, nothing left behind
+    second._compress(str(segment))
+    assert sorted(f.basename for f in tmpdir.listdir()) == \
+            ['floop.log.20180131-134500.gz']
+
+def test_rotation_by_other_writer(tmpdir):
+    path = str(tmpdir.join('floop.log'))
+    first, second = _log(path), _log(path)
+    start = 1517400000.0
+    for step in range(20):
+        log = first if step % 3 else second
+        log.emit(log_record('core0 (target) - build: step {}'.format(step),
+            start + step))
+        log.flush()
+    first.close()
+    second.close()
+    lines = list(read(path))
+    assert [line.split()[-1] for line in lines] == [str(step) for step in range(20)]
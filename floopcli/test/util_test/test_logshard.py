@@ -0,0 +1,44 @@
+import threading
+
+from floopcli.test.log_fixture import log_record, open_log
+from floopcli.util.logindex import LogFilter
+from floopcli.util.logshard import read, shard_path, shards
+
+def test_shards_merge_by_time(tmpdir):
+    path = str(tmpdir.join('floop.log'))
+    with open(path, 'w') as f:
+        f.write('2000-01-01 00:00:00,000 INFO core0 (target) - push: before\n')
+    log = open_log(path, shards=True)
+    start = 1517400000.0
+    def work(idx):
+        for step in range(20):
+            log.handle(log_record('core{} (target) - build: step {}'.format(
+                idx, step), start + step * 4 + idx))
+    threads = [threading.Thread(target=work, args=(idx,)) for idx in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    log.handle(log_record('not about a core', start))
+    log.close()
+    assert shards(path) == ['_floop', 'core0', 'core1', 'core2', 'core3']
+    merged = list(read(path))
+    assert len(merged) == 82
+    assert merged[0].endswith('before\n')
+    assert [record[:23] for record in merged] == \
+            sorted(record[:23] for record in merged)
+    core2 = list(read(path, LogFilter(core='core2')))
+    assert [record.split()[-1] for record in core2] == \
+            [str(step) for step in range(20)]
+
+def test_shards_read_only_the_core_shard(tmpdir):
+    path = str(tmpdir.join('floop.log'))
+    log = open_log(path, shards=True)
+    log.handle(log_record('core0 (target) - push: a', 1517400000.0))
+    log.handle(log_record('core1 (target) - push: b', 1517400001.0))
+    log.close()
+    # a shard that is not needed can not get in the way
+    tmpdir.join('floop.log.shards', 'core1.log').remove()
+    tmpdir.join('floop.log.shards').mkdir('core1.log')
+    assert [record.split()[-1] for record in
+            read(path, LogFilter(core='core0'))] == ['a']
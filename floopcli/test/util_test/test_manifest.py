@@ -0,0 +1,92 @@
+import pytest
+import tarfile
+
+import floopcli.util.manifest as manifest
+
+from floopcli.test.fixture import fixture_state_dir
+from floopcli.util.manifest import Manifest, DELTA_DELETE_FILE, \
+        delta_archive, remove_deltas, scan
+
+@pytest.fixture(scope='function')
+def fixture_source(tmpdir, fixture_state_dir):
+    src = tmpdir.mkdir('src')
+    src.join('a.txt').write('a')
+    src.mkdir('sub').join('b.txt').write('b')
+    src.join('floop.log').write('ignored')
+    return src
+
+def test_manifest_scan(fixture_source):
+    m = scan(str(fixture_source))
+    assert sorted(m.entries) == ['a.txt', 'sub', 'sub/b.txt']
+
+def test_manifest_scan_floopignore(fixture_source):
+    fixture_source.join('a.pyc').write('x')
+    fixture_source.mkdir('build').join('out.txt').write('x')
+    fixture_source.join('.floopignore').write('*.pyc\nbuild/\n')
+    m = scan(str(fixture_source))
+    assert sorted(m.entries) == ['.floopignore', 'a.txt', 'sub', 'sub/b.txt']
+
+def test_manifest_digest_tracks_content(fixture_source):
+    first = scan(str(fixture_source))
+    assert scan(str(fixture_source)).digest == first.digest
+    fixture_source.join('a.txt').write('changed')
+    assert scan(str(fixture_source)).digest != first.digest
+
+def test_manifest_digest_tracks_modes_links_and_dirs(fixture_source):
+    digests = [scan(str(fixture_source)).digest]
+    fixture_source.join('a.txt').chmod(0o755)
+    digests.append(scan(str(fixture_source)).digest)
+    fixture_source.join('link').mksymlinkto('a.txt')
+    digests.append(scan(str(fixture_source)).digest)
+    fixture_source.join('link').remove()
+    fixture_source.join('link').mksymlinkto('sub/b.txt')
+    digests.append(scan(str(fixture_source)).digest)
+    fixture_source.mkdir('empty')
+    digests.append(scan(str(fixture_source)).digest)
+    assert len(set(digests)) == len(digests)
+    changed, removed = scan(str(fixture_source)).changes(Manifest({}))
+    assert 'empty' in changed and 'link' in changed
+
+def test_manifest_scan_reuses_cached_hashes(fixture_source, monkeypatch):
+    scan(str(fixture_source))
+    hashed = []
+    original = manifest._hash_file
+    def counting_hash(path):
+        hashed.append(path)
+        return original(path)
+    monkeypatch.setattr(manifest, '_hash_file', counting_hash)
+    scan(str(fixture_source))
+    assert hashed == []
+    fixture_source.join('c.txt').write('c')
+    scan(str(fixture_source))
+    assert len(hashed) == 1
+
+def test_manifest_changes(fixture_source):
+    old = scan(str(fixture_source))
+    fixture_source.join('a.txt').write('changed')
+    fixture_source.join('sub', 'b.txt').remove()
+    fixture_source.join('c.txt').write('c')
+    changed, removed = scan(str(fixture_source)).changes(old)
+    assert changed == ['a.txt', 'c.txt']
+    assert removed == ['sub/b.txt']
+
+def test_manifest_save_and_load(fixture_source):
+    m = scan(str(fixture_source))
+    m.save()
+    assert Manifest.load(m.digest).digest == m.digest
+    assert Manifest.load('notarealdigest') is None
+
+def test_manifest_delta_archive(fixture_source):
+    old = scan(str(fixture_source))
+    fixture_source.join('a.txt').write('changed')
+    fixture_source.join('sub', 'b.txt').remove()
+    new = scan(str(fixture_source))
+    try:
+        path = delta_archive(str(fixture_source), '', new, old)
+        assert delta_archive(str(fixture_source), '', new, old) == path
+        with tarfile.open(path) as archive:
+            assert sorted(archive.getnames()) == [DELTA_DELETE_FILE, 'a.txt']
+            listing = archive.extractfile(DELTA_DELETE_FILE).read()
+            assert listing == b'sub/b.txt'
+    finally:
+        remove_deltas()
@@ -1,6 +1,10 @@
 import pytest
+import threading
+import time
 
-from floopcli.util.syscall import syscall, SystemCallException
+from floopcli.util.syscall import syscall, cancel_syscalls, reset_syscalls, \
+        expired_budget, Budget, SystemCallCancelled, SystemCallException, \
+        SystemCallTimeout, RingBufferSink
 
 def test_syscall_pwd():
     syscall('pwd', check=True, verbose=True)
@@ -8,3 +12,85 @@ def test_syscall_pwd():
 def test_syscall_check_nonzero_exit_fails():
     with pytest.raises(SystemCallException):
         syscall('cp', check=True, verbose=True)
+
+def test_syscall_sink_receives_lines():
+    lines = []
+    out, _ = syscall('printf "a\\nb\\nc"', check=True, sink=lines.append)
+    assert lines == ['a\n', 'b\n', 'c']
+    assert out == 'a\nb\nc'
+
+def test_syscall_sink_receives_lines_longer_than_chunks():
+    lines = []
+    syscall(['sh', '-c', "head -c 200000 /dev/zero | tr '\\0' x; printf '\\nb\\nc'"],
+            check=True, sink=lines.append, capture=False)
+    assert lines == ['x' * 200000 + '\n', 'b\n', 'c']
+
+def test_syscall_no_capture_returns_empty_output():
+    lines = []
+    out, _ = syscall('printf "a\\nb\\n"', check=True,
+            sink=lines.append, capture=False)
+    assert out == ''
+    assert lines == ['a\n', 'b\n']
+
+def test_syscall_ring_buffer_sink_keeps_tail():
+    sink = RingBufferSink(maxsize=4)
+    syscall('printf "aa\\nbb\\ncc\\n"', check=True, sink=sink, capture=False)
+    assert sink.getvalue() == 'cc\n'
+
+def test_syscall_timeout_kills_command():
+    with pytest.raises(SystemCallException):
+        syscall('sleep 5', check=True, timeout=0.1)
+
+def test_syscall_output_file(tmpdir):
+    target = tmpdir.join('out.bin')
+    with open(str(target), 'wb') as f:
+        out, _ = syscall(['printf', 'a\\000b'], check=True, output=f)
+    assert out == ''
+    assert target.read_binary() == b'a\x00b'
+
+def test_syscall_cancel_kills_running_commands():
+    errors = []
+    def sleep():
+        try:
+            syscall('sleep 30', check=True)
+        except SystemCallException as e:
+            errors.append(e)
+    thread = threading.Thread(target=sleep)
+    thread.start()
+    start = time.time()
+    try:
+        # give the command time to start, so it is killed and not refused
+        time.sleep(0.5)
+        cancel_syscalls()
+        thread.join()
+        assert time.time() - start < 5
+        assert isinstance(errors[0], SystemCallCancelled)
+        with pytest.raises(SystemCallCancelled):
+            syscall('pwd', check=True)
+    finally:
+        reset_syscalls()
+    syscall('pwd', check=True)
+
+def test_syscall_budget_shared_by_calls():
+    with Budget('operation', 0.5):
+        syscall('sleep 0.3', check=True)
+        with pytest.raises(SystemCallTimeout):
+            syscall('sleep 5', check=True)
+    assert expired_budget() == 'operation'
+    with pytest.raises(SystemCallTimeout):
+        with Budget('operation', 0):
+            syscall('pwd', check=True)
+
+def test_syscall_budget_each_call():
+    with Budget('command', 0.5, each=True):
+        syscall('sleep 0.3', check=True)
+        syscall('sleep 0.3', check=True)
+        with Budget('build', None):
+            with pytest.raises(SystemCallTimeout):
+                syscall('sleep 5', check=True)
+    assert expired_budget() == 'command'
+
+def test_syscall_exception_keeps_returncode():
+    with pytest.raises(SystemCallException) as e:
+        syscall('sh -c "exit 255"', check=True)
+    assert e.value.returncode == 255
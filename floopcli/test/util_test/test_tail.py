@@ -0,0 +1,80 @@
+import os
+import pytest
+import threading
+import time
+
+from floopcli.util.tail import tail
+
+def test_tail_reads_whole_file(tmpdir):
+    log = tmpdir.join('floop.log')
+    log.write_binary(b'a\nb\nc')
+    assert list(tail(str(log))) == ['a\n', 'b\n', 'c']
+
+def test_tail_missing_file_fails(tmpdir):
+    with pytest.raises(IOError):
+        list(tail(str(tmpdir.join('floop.log'))))
+
+def wait_for(lines, count):
+    start = time.time()
+    while len(lines) < count and time.time() - start < 5:
+        time.sleep(0.01)
+
+def test_tail_follows_across_rotation(tmpdir):
+    log = str(tmpdir.join('floop.log'))
+    done = threading.Event()
+    lines = []
+    def follow():
+        for line in tail(log, follow=True, poll=0.01, stop=done.is_set):
+            lines.append(line)
+    thread = threading.Thread(target=follow)
+    thread.start()
+    try:
+        with open(log, 'w') as f:
+            f.write('a\nb')
+        with open(log, 'a') as f:
+            f.write('c\n')
+        wait_for(lines, 2)
+        assert lines == ['a\n', 'bc\n']
+        with open(log, 'a') as f:
+            f.write('d\n')
+        os.rename(log, log + '.1')
+        with open(log, 'w') as f:
+            f.write('e\n')
+        wait_for(lines, 4)
+        assert lines[2:] == ['d\n', 'e\n']
+    finally:
+        done.set()
+        thread.join()
+
+def test_tail_reads_old_file_to_end_on_rotation(tmpdir):
+    log = str(tmpdir.join('floop.log'))
+    with open(log, 'w') as f:
+        f.write('a\n')
+    calls = []
+    def rotate():
+        if not calls:
+            # the writer finishes the old file and rotates between two reads
+            with open(log, 'a') as f:
+                f.write('b\n')
+            os.rename(log, log + '.1')
+            with open(log, 'w') as f:
+                f.write('c\n')
+        calls.append(True)
+        return len(calls) > 10
+    assert list(tail(log, follow=True, poll=0.01, stop=rotate)) == \
+            ['a\n', 'b\n', 'c\n']
+
+def test_tail_follow_starts_at_last_lines(tmpdir):
+    log = tmpdir.join('floop.log')
+    log.write_binary(b''.join(b'line %d\n' % idx for idx in range(100000)))
+    calls = []
+    def append():
+        if not calls:
+            with log.open('ab') as f:
+                f.write(b'new\n')
+        calls.append(True)
+        return len(calls) > 3
+    assert list(tail(str(log), follow=True, poll=0.01, stop=append,
+        last=2)) == ['line 99998\n', 'line 99999\n', 'new\n']
+    assert list(tail(str(log), last=0)) == []
+    assert list(tail(str(log), last=200000))[0] == 'line 0\n'
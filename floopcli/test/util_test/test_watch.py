@@ -0,0 +1,54 @@
+import pytest
+
+import floopcli.util.watch as watch
+
+from floopcli.util.watch import Watcher, affects_image, image_inputs
+
+@pytest.fixture(scope='function')
+def fixture_source(tmpdir):
+    src = tmpdir.mkdir('src')
+    src.join('Dockerfile').write('''FROM alpine
+COPY requirements.txt /app/
+COPY --chown=1000 ["src", "lib/*.so", "/app/"]
+COPY --from=builder /out /app/out
+ADD https://example.com/x.tgz \\
+    vendor /app/
+''')
+    src.join('main.py').write('main')
+    return src
+
+def test_image_inputs(fixture_source):
+    inputs = image_inputs(str(fixture_source), 'Dockerfile')
+    assert sorted(inputs) == ['.dockerignore', 'Dockerfile', 'lib/*.so',
+            'requirements.txt', 'src', 'vendor']
+    assert image_inputs(str(fixture_source), 'Dockerfile.missing') == \
+            ['.dockerignore', 'Dockerfile.missing']
+
+def test_affects_image(fixture_source):
+    inputs = image_inputs(str(fixture_source), 'Dockerfile')
+    assert affects_image('Dockerfile', inputs)
+    assert affects_image('src/app/main.py', inputs)
+    assert affects_image('lib/a.so', inputs)
+    assert not affects_image('main.py', inputs)
+    assert not affects_image('srcfile', inputs)
+    assert affects_image('main.py', ['.'])
+
+@pytest.mark.parametrize('polling', [False, True])
+def test_watcher(fixture_source, monkeypatch, polling):
+    if polling:
+        monkeypatch.setattr(watch, '_inotify', lambda: None)
+        monkeypatch.setattr(watch, '_POLL_INTERVAL', 0.05)
+    fixture_source.join('.floopignore').write('*.tmp\n')
+    watcher = Watcher([str(fixture_source)], debounce=0.1)
+    try:
+        if not polling and watcher.polling:
+            pytest.skip('inotify not available')
+        assert watcher.wait(0.1) == set()
+        fixture_source.join('main.py').write('changed')
+        fixture_source.join('ignored.tmp').write('x')
+        fixture_source.mkdir('src').join('a.py').write('a')
+        changed = watcher.wait(1)
+        assert changed == set([(str(fixture_source), 'main.py'),
+            (str(fixture_source), 'src/a.py')])
+    finally:
+        watcher.close()
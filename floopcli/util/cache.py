@@ -0,0 +1,230 @@
+import hashlib
+import threading
+import time
+
+from contextlib import contextmanager
+from os import listdir, makedirs, remove, rename
+from os.path import dirname, getsize, isfile, join
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, TypeVar
+
+from floopcli.util.state import state_path, read_json, write_json
+
+_HASH_CHUNK_SIZE = 1048576
+'''Number of bytes to read from a blob at a time while verifying'''
+
+def _makedirs(path): # type: (str) -> None
+    try:
+        makedirs(path)
+    except OSError: # dir exists
+        pass
+
+BuildCacheType = TypeVar('BuildCacheType', bound='BuildCache')
+'''Generic BuildCache type'''
+
+class BuildCache(object):
+    '''
+    Content-addressed store of BuildKit cache blobs on the host
+
+    Blobs are kept once by sha256 digest, whichever core exported them,
+    next to the last cache index (OCI index.json) exported per platform.
+    When the blobs exceed max_bytes, the least recently used ones are
+    evicted, together with any index that refers to them. Blobs that a
+    transfer in this process pinned are never evicted.
+
+    Args:
+        max_bytes (int):
+            largest total size of all blobs
+        root (str):
+            cache directory; defaults to buildcache in the floop state
+            directory
+    '''
+    def __init__(self, max_bytes, root=None): # type: (BuildCacheType, int, Optional[str]) -> None
+        self.max_bytes = max_bytes
+        self.root = root or state_path('buildcache')
+        self._lock = threading.Lock()
+        self._pins = {} # type: Dict[str, int]
+
+    def tmp_dir(self): # type: (BuildCacheType) -> str
+        '''
+        Returns:
+            str:
+                directory for downloads on the same file system as the blobs
+        '''
+        path = join(self.root, 'tmp')
+        _makedirs(path)
+        return path
+
+    def blob_path(self, digest): # type: (BuildCacheType, str) -> str
+        '''
+        Returns:
+            str:
+                path of the blob with digest (sha256:<hex>)
+        '''
+        return join(self.root, 'blobs', 'sha256', digest.split(':')[-1])
+
+    def _index_path(self, platform): # type: (BuildCacheType, str) -> str
+        return join(self.root, 'indexes', '{}.json'.format(
+            platform.replace('/', '-')))
+
+    def digests(self): # type: (BuildCacheType) -> Set[str]
+        '''
+        Returns:
+            {str}:
+                digests of all blobs in the cache
+        '''
+        try:
+            return set('sha256:' + name for name in listdir(
+                join(self.root, 'blobs', 'sha256')))
+        except OSError:
+            return set()
+
+    def add(self, digest, path): # type: (BuildCacheType, str, str) -> bool
+        '''
+        Move a downloaded file into the cache if its content matches digest
+
+        Args:
+            digest (str):
+                expected digest (sha256:<hex>)
+            path (str):
+                downloaded file on the same file system as the cache
+        Returns:
+            bool:
+                if True, the blob was added
+        '''
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), b''):
+                sha.update(chunk)
+        if 'sha256:' + sha.hexdigest() != digest:
+            remove(path)
+            return False
+        target = self.blob_path(digest)
+        with self._lock:
+            if isfile(target):
+                remove(path)
+            else:
+                _makedirs(dirname(target))
+                rename(path, target)
+        self.touch([digest])
+        return True
+
+    def index(self, platform): # type: (BuildCacheType, str) -> Optional[Dict[str, Any]]
+        '''
+        Returns:
+            dict:
+                last cache index exported for platform, or None
+        '''
+        return read_json(self._index_path(platform))
+
+    def set_index(self, platform, index): # type: (BuildCacheType, str, Dict[str, Any]) -> bool
+        '''
+        Store the cache index for platform if all blobs it needs are cached
+
+        Returns:
+            bool:
+                if True, the index was stored
+        '''
+        needed = self.referenced(index)
+        if needed is None or not needed <= self.digests():
+            return False
+        write_json(self._index_path(platform), index)
+        return True
+
+    def referenced(self, index): # type: (BuildCacheType, Dict[str, Any]) -> Optional[Set[str]]
+        '''
+        Blobs a cache index needs: its manifests and everything they list
+
+        Returns:
+            {str}:
+                digests, or None if a manifest is not in the cache
+        '''
+        needed = set() # type: Set[str]
+        for entry in index.get('manifests', []):
+            digest = entry['digest']
+            needed.add(digest)
+            manifest = read_json(self.blob_path(digest))
+            if manifest is None:
+                return None
+            needed.update(blob['digest'] for blob in manifest.get('layers', []))
+            if 'config' in manifest:
+                needed.add(manifest['config']['digest'])
+        return needed
+
+    @contextmanager
+    def pinned(self, digests): # type: (BuildCacheType, Iterable[str]) -> Iterator[None]
+        '''
+        Keep blobs from being evicted, e.g. while they are sent to a core
+
+        Digests do not need to be in the cache yet, so blobs that are
+        being added can be pinned as well
+
+        Args:
+            digests ([str]):
+                digests of the blobs to keep
+        '''
+        digests = list(digests)
+        with self._lock:
+            for digest in digests:
+                self._pins[digest] = self._pins.get(digest, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                for digest in digests:
+                    self._pins[digest] -= 1
+                    if not self._pins[digest]:
+                        del self._pins[digest]
+
+    def touch(self, digests): # type: (BuildCacheType, List[str]) -> None
+        '''
+        Mark blobs as used now
+        '''
+        with self._lock:
+            used = read_json(join(self.root, 'used.json'), {})
+            now = time.time()
+            for digest in digests:
+                used[digest] = now
+            write_json(join(self.root, 'used.json'), used)
+
+    def evict(self): # type: (BuildCacheType) -> List[str]
+        '''
+        Remove least recently used blobs until the cache fits max_bytes,
+        skipping pinned blobs (see :py:meth:`pinned`)
+
+        Returns:
+            [str]:
+                digests of removed blobs
+        '''
+        with self._lock:
+            used = read_json(join(self.root, 'used.json'), {})
+            sizes = dict((digest, getsize(self.blob_path(digest)))
+                    for digest in self.digests())
+            total = sum(sizes.values())
+            removed = []
+            for digest in sorted(sizes, key=lambda d: used.get(d, 0)):
+                if total <= self.max_bytes:
+                    break
+                if digest in self._pins:
+                    continue
+                remove(self.blob_path(digest))
+                total -= sizes[digest]
+                used.pop(digest, None)
+                removed.append(digest)
+            for digest in [d for d in used if d not in sizes]:
+                del used[digest]
+            write_json(join(self.root, 'used.json'), used)
+        if removed:
+            self._drop_indexes(set(removed))
+        return removed
+
+    def _drop_indexes(self, removed): # type: (BuildCacheType, Set[str]) -> None
+        directory = join(self.root, 'indexes')
+        try:
+            names = listdir(directory)
+        except OSError:
+            return
+        for name in names:
+            index = read_json(join(directory, name))
+            needed = None if index is None else self.referenced(index)
+            if needed is None or needed & removed:
+                remove(join(directory, name))
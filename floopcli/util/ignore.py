@@ -0,0 +1,214 @@
+import re
+
+from os.path import isfile, join
+from typing import List, Optional, Pattern, Tuple, TypeVar
+
+FLOOP_IGNORE_FILE = '.floopignore'
+'''Name of the ignore file in host_source'''
+
+_FLOOP_IGNORE_DEFAULTS = ['floop.log', 'floop.log.*', 'floop.json',
+        '.floop']
+'''Patterns that are always ignored: floop's own files on the host'''
+
+def _translate(pattern): # type: (str) -> str
+    '''
+    Translate the glob part of a gitignore pattern to a regular expression
+
+    Args:
+        pattern (str):
+            gitignore glob without negation, anchoring, or trailing slash
+    Returns:
+        str:
+            regular expression body (unanchored)
+    '''
+    out = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith('**/', i):
+            out.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('/**', i) and i + 3 == n:
+            out.append('/.*')
+            i += 3
+        elif pattern.startswith('**', i):
+            out.append('.*')
+            i += 2
+        elif c == '*':
+            out.append('[^/]*')
+            i += 1
+        elif c == '?':
+            out.append('[^/]')
+            i += 1
+        elif c == '[':
+            end = pattern.find(']', i + 1)
+            if end < 0:
+                out.append(re.escape(c))
+                i += 1
+            else:
+                body = pattern[i + 1:end]
+                if body.startswith('!'):
+                    body = '^' + body[1:]
+                out.append('[{}]'.format(body.replace('\\', '\\\\')))
+                i = end + 1
+        elif c == '\\' and i + 1 < n:
+            out.append(re.escape(pattern[i + 1]))
+            i += 2
+        else:
+            out.append(re.escape(c))
+            i += 1
+    return ''.join(out)
+
+IgnoreRuleType = TypeVar('IgnoreRuleType', bound='IgnoreRule')
+'''Generic IgnoreRule type'''
+
+class IgnoreRule(object):
+    '''
+    One parsed line of an ignore file
+
+    Args:
+        line (str):
+            gitignore-style pattern
+    '''
+    def __init__(self, line): # type: (IgnoreRuleType, str) -> None
+        pattern = line
+        self.negate = pattern.startswith('!')
+        '''If True, a match re-includes the path'''
+        if self.negate:
+            pattern = pattern[1:]
+        self.dir_only = pattern.endswith('/')
+        '''If True, only matches directories'''
+        pattern = pattern.rstrip('/')
+        self.anchored = '/' in pattern
+        '''If True, matched against the path from the source root, not the name'''
+        self.pattern = pattern.lstrip('/')
+        '''Glob without negation, anchoring, or trailing slash'''
+        body = _translate(self.pattern)
+        if self.anchored:
+            self.regex = '^{}$'.format(body)
+        else:
+            self.regex = '^(?:.*/)?{}$'.format(body)
+
+IgnoreMatcherType = TypeVar('IgnoreMatcherType', bound='IgnoreMatcher')
+'''Generic IgnoreMatcher type'''
+
+class IgnoreMatcher(object):
+    '''
+    Compiled gitignore-style matcher for paths relative to host_source
+
+    The same rules drive manifest hashing, rsync filters, and the
+    .dockerignore generated on targets. The last matching rule wins and
+    ! re-includes a path, as in .gitignore.
+
+    Args:
+        lines ([str]):
+            ignore file lines; floop's own files are always ignored
+    '''
+    def __init__(self, lines): # type: (IgnoreMatcherType, List[str]) -> None
+        self.rules = [] # type: List[IgnoreRule]
+        # defaults go last so that no ! rule can re-include them
+        for line in list(lines) + _FLOOP_IGNORE_DEFAULTS:
+            line = line.rstrip('\n').rstrip()
+            if not line or line.startswith('#'):
+                continue
+            self.rules.append(IgnoreRule(line))
+        self._compiled = [(re.compile(rule.regex), rule.negate, rule.dir_only)
+                for rule in self.rules] # type: List[Tuple[Pattern, bool, bool]]
+        # without negation, any match ignores the path, so one alternation
+        # per path kind answers in a single regex call
+        self._files = None # type: Optional[Pattern]
+        self._dirs = None # type: Optional[Pattern]
+        if not any(rule.negate for rule in self.rules):
+            self._files = re.compile('|'.join(
+                rule.regex for rule in self.rules if not rule.dir_only) or '(?!)')
+            self._dirs = re.compile('|'.join(rule.regex for rule in self.rules))
+
+    @classmethod
+    def load(cls, source): # type: (str) -> IgnoreMatcher
+        '''
+        Read the ignore file of a source directory
+
+        Args:
+            source (str):
+                host source directory
+        Returns:
+            :py:class:`floopcli.util.ignore.IgnoreMatcher`:
+                matcher for the ignore file, or for floop's defaults if
+                the source has no ignore file
+        '''
+        path = join(source, FLOOP_IGNORE_FILE)
+        if not isfile(path):
+            return cls([])
+        with open(path) as f:
+            return cls(f.readlines())
+
+    def match(self, path, is_dir=False): # type: (IgnoreMatcherType, str, bool) -> bool
+        '''
+        Check whether a path is ignored
+
+        Callers that walk a tree should not descend into ignored
+        directories; a path inside one is ignored as well
+
+        Args:
+            path (str):
+                path relative to host_source, separated by /
+            is_dir (bool):
+                if True, path is a directory
+        Returns:
+            bool:
+                if True, path is ignored
+        '''
+        if self._files is not None:
+            if is_dir:
+                return self._dirs.match(path) is not None # type: ignore
+            return self._files.match(path) is not None
+        ignored = False
+        for regex, negate, dir_only in self._compiled:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(path):
+                ignored = not negate
+        return ignored
+
+    def rsync_filters(self, prefix=''): # type: (IgnoreMatcherType, str) -> List[str]
+        '''
+        Translate rules to rsync filter arguments
+
+        Args:
+            prefix (str):
+                path of host_source inside the rsync transfer root
+                ('' if host_source ends with /)
+        Returns:
+            [str]:
+                --filter arguments for rsync
+        '''
+        filters = []
+        # rsync stops at the first matching rule, git at the last one
+        for rule in reversed(self.rules):
+            pattern = rule.pattern + ('/' if rule.dir_only else '')
+            if rule.anchored:
+                pattern = '/' + prefix + pattern
+            filters.append('--filter={} {}'.format(
+                '+' if rule.negate else '-', pattern))
+        return filters
+
+    def dockerignore(self): # type: (IgnoreMatcherType) -> str
+        '''
+        Translate rules to .dockerignore content
+
+        .dockerignore patterns are always relative to the build context
+        root, so unanchored rules are written for the root and for any
+        subdirectory. Docker has no directory-only patterns, so a trailing
+        / is dropped.
+
+        Returns:
+            str:
+                content for .dockerignore
+        '''
+        lines = []
+        for rule in self.rules:
+            negate = '!' if rule.negate else ''
+            lines.append(negate + rule.pattern)
+            if not rule.anchored:
+                lines.append(negate + '**/' + rule.pattern)
+        return '\n'.join(lines) + '\n'
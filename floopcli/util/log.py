@@ -1,8 +1,25 @@
 # based on https://gist.github.com/JesseBuesking/10674086#file-logging-yaml-L10
+import atexit
 import os
-import multiprocessing, threading, logging, sys, traceback
+import multiprocessing, threading, logging, sys, time, traceback
+from contextlib import contextmanager
 from logging.handlers import RotatingFileHandler
-from typing import TypeVar
+from typing import Iterator, List, Optional, Tuple, TypeVar
+
+try:
+    import fcntl
+except ImportError: # windows
+    fcntl = None # type: ignore
+
+from floopcli.util.logindex import LogIndex
+from floopcli.util.logsegment import LogSegments
+from floopcli.util.logshard import LogShards
+
+LOCK_SUFFIX = '.lock'
+'''Suffix of the file next to a log that its writers lock while they write'''
+
+Entry = Tuple[bytes, float, str, str]
+'''Formatted log record as it travels to the receiver thread, see :py:meth:`Log.entry`'''
 
 LogType = TypeVar('LogType', bound='Log')
 '''Generic Log type'''
@@ -11,6 +28,16 @@ class Log(logging.Handler):
     '''
     Queue-based single-file logger for parallel processes
 
+    The receiver thread writes records in batches: it collects
+    formatted records and writes them with one system call once they
+    add up to batch bytes or the oldest one waited interval seconds.
+    :py:meth:`flush` and :py:meth:`close` write what is pending right
+    away.
+
+    Every floop process writes the same log: batches, their index
+    entries, and rotations are written under a file lock shared by all
+    of them, and a writer reopens the log if another one rotated it.
+
     Args:
         name (str):
             name of the logger
@@ -20,14 +47,58 @@ class Log(logging.Handler):
             maximum size in bytes of log file
         rotate (int):
             number of historical log files to retain; defaults to 0
+        index (bool):
+            if True, keep a sidecar index of the log for queries by core,
+            level, function, and time, see :py:class:`floopcli.util.logindex.LogIndex`
+        batch (int):
+            bytes of formatted records that trigger a write; 0 writes
+            every record as soon as it arrives
+        interval (float):
+            longest time in seconds a record waits for its batch to fill
+        shards (bool):
+            if True, write each record straight to the shard of its core
+            instead of the queue and the log file, see
+            :py:class:`floopcli.util.logshard.LogShards`
+        segments (bool):
+            if True, rotate the log into time-stamped segments instead of
+            numbered backups (rotate is ignored), see
+            :py:class:`floopcli.util.logsegment.LogSegments`
+        segment_age (float):
+            with segments, also rotate once the log is this many seconds old
+        keep_bytes (int):
+            with segments, largest total size of closed segments
+        keep_age (float):
+            with segments, seconds a closed segment is kept
+        compress (bool):
+            with segments, gzip closed segments in the background
     '''
-    def __init__(self, name, mode, maxsize, rotate): # type: (LogType, str, str, int, int) -> None 
+    def __init__(self, name, mode, maxsize, rotate, index=True, batch=65536, # type: ignore
+            interval=0.2, shards=False, segments=False, segment_age=None,
+            keep_bytes=None, keep_age=None, compress=True):
+        # type: (LogType, str, str, int, int, bool, int, float, bool, bool, Optional[float], Optional[int], Optional[float], bool) -> None
         logging.Handler.__init__(self)
+        self._segments = None # type: Optional[LogSegments]
+        if segments:
+            self._segments = LogSegments(name, segment_age, keep_bytes,
+                    keep_age, compress)
+        self._shards = None # type: Optional[LogShards]
+        if shards:
+            self._shards = LogShards(name)
         self._handler = RotatingFileHandler(name, mode, maxsize, rotate)
+        self._index = None # type: Optional[LogIndex]
+        if index:
+            self._index = LogIndex(name)
+        self.batch = batch
+        self.interval = interval
+        self._flushes = 0
+        self._flushed = 0
+        self._flushed_cond = threading.Condition()
         self.queue = multiprocessing.Queue(-1) #type: multiprocessing.Queue
-        t = threading.Thread(target=self.receive)
-        t.daemon = True
-        t.start()
+        self._receiver = threading.Thread(target=self.receive)
+        self._receiver.daemon = True
+        self._receiver.start()
+        # runs before multiprocessing closes the queue at exit
+        atexit.register(self.flush)
 
     def setFormatter(self, fmt): # type: (LogType, logging.Formatter) -> None
         '''
@@ -42,30 +113,172 @@ class Log(logging.Handler):
 
     def receive(self): # type: (LogType) -> None
         '''
-        Receive logging records from queue 
+        Receive formatted records from queue and write them in batches
 
         Raises:
             Exception:
                 re-raise after :py:class:`KeyboardInterrupt` or :py:class:`SystemExit`
         '''
+        pending = [] # type: List[Entry]
+        size = 0
+        timer = None # type: Optional[threading.Timer]
         while True:
             try:
-                record = self.queue.get()
-                self._handler.emit(record)
+                item = self.queue.get()
+            except Exception: # queue closed, e.g. at interpreter exit
+                break
+            try:
+                if isinstance(item, int): # flush request, see flush
+                    try:
+                        self._write(pending)
+                    finally:
+                        # a failed write must not keep flush waiting
+                        with self._flushed_cond:
+                            self._flushed = max(self._flushed, item)
+                            self._flushed_cond.notify_all()
+                    pending, size = [], 0
+                    continue
+                if not pending and self.batch > 0:
+                    # a blocking get is cheaper than polling for the deadline
+                    timer = threading.Timer(self.interval, self.queue.put, [0])
+                    timer.daemon = True
+                    timer.start()
+                pending.append(item)
+                size += len(item[0])
+                if size >= self.batch:
+                    if timer is not None:
+                        timer.cancel()
+                    self._write(pending)
+                    pending, size = [], 0
             except (KeyboardInterrupt, SystemExit):
                 raise
-            except EOFError:
-                break
             except:
+                pending, size = [], 0
                 traceback.print_exc(file=sys.stderr)
 
-    def send(self, s): # type: (LogType, LogRecord) -> None
+    @contextmanager
+    def _locked(self): # type: (LogType) -> Iterator[None]
+        '''
+        Hold the lock that all processes writing the log share
+        '''
+        if fcntl is None:
+            yield
+            return
+        with open(self._handler.baseFilename + LOCK_SUFFIX, 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _moved(self): # type: (LogType) -> bool
         '''
-        Send logging record to logging queue
+        Returns:
+            bool:
+                if True, the open log file is no longer the log, e.g.
+                because another process rotated it
+        '''
+        try:
+            st = os.stat(self._handler.baseFilename)
+        except OSError: # rotated, new log not created yet
+            return True
+        opened = os.fstat(self._handler.stream.fileno())
+        return (st.st_dev, st.st_ino) != (opened.st_dev, opened.st_ino)
+
+    def _write(self, pending): # type: (LogType, List[Entry]) -> None
+        '''
+        Write formatted records to the log file and add them to the index
+
+        Records go out in one write per batch, unless the log has to be
+        rolled over in the middle of it
 
         Args:
-            s (:py:class`logging.LogRecord`):
-                record to be logged
+            pending ([(bytes, float, str, str)]):
+                formatted records, see :py:meth:`entry`
+        '''
+        if not pending:
+            return
+        with self._locked():
+            handler = self._handler
+            if handler.stream is not None and self._moved():
+                handler.stream.close()
+                handler.stream = None
+            self._write_batch(pending)
+
+    def _write_batch(self, pending): # type: (LogType, List[Entry]) -> None
+        handler = self._handler
+        if handler.stream is None:
+            handler.stream = handler._open()
+        end = os.fstat(handler.stream.fileno()).st_size
+        chunk = [] # type: List[bytes]
+        for data, created, level, message in pending:
+            if end > 0 and self._due(end + len(data)):
+                self._write_chunk(chunk)
+                chunk = []
+                self._rollover()
+                end = os.fstat(handler.stream.fileno()).st_size
+            if self._index is not None:
+                self._index.add(end, len(data), created, level, message)
+            chunk.append(data)
+            end += len(data)
+        self._write_chunk(chunk)
+        if self._index is not None:
+            self._index.flush()
+
+    def _due(self, size): # type: (LogType, int) -> bool
+        '''
+        Returns:
+            bool:
+                if True, the log has to be rolled over before it grows to size
+        '''
+        if self._handler.maxBytes > 0 and size >= self._handler.maxBytes:
+            return True
+        return self._segments is not None and self._segments.due()
+
+    def _rollover(self): # type: (LogType) -> None
+        '''
+        Start a new log file, keeping the old one as a backup or segment
+        '''
+        if self._segments is None:
+            self._handler.doRollover()
+            return
+        self._handler.stream.close()
+        self._handler.stream = None
+        self._segments.rotate()
+        self._handler.stream = self._handler._open()
+
+    def _write_chunk(self, chunk): # type: (LogType, List[bytes]) -> None
+        data = b''.join(chunk)
+        fd = self._handler.stream.fileno()
+        while data:
+            data = data[os.write(fd, data):]
+
+    def flush(self, timeout=5.0): # type: (LogType, float) -> None
+        '''
+        Write all records queued so far and wait until they are written
+
+        Args:
+            timeout (float):
+                seconds to wait for the receiver thread
+        '''
+        if not self._receiver.is_alive():
+            return
+        with self._flushed_cond:
+            self._flushes += 1
+            token = self._flushes
+        self.queue.put(token)
+        deadline = time.time() + timeout
+        with self._flushed_cond:
+            while self._flushed < token and time.time() < deadline:
+                self._flushed_cond.wait(max(0, deadline - time.time()))
+
+    def send(self, s): # type: (LogType, Entry) -> None
+        '''
+        Send formatted record to logging queue
+
+        Args:
+            s ((bytes, float, str, str)):
+                record to be logged, see :py:meth:`entry`
         '''
         self.queue.put_nowait(s)
 
@@ -88,9 +301,47 @@ class Log(logging.Handler):
             record.exc_info = None
         return record
 
+    def entry(self, record): # type: (LogType, logging.LogRecord) -> Entry
+        '''
+        Format record for the receiver thread
+
+        Records are formatted by the thread that logs them, so the queue
+        carries plain bytes and strings instead of pickled records
+
+        Args:
+            record (:py:class:`logging.LogRecord`):
+                logging record, see :py:meth:`_format_record`
+        Returns:
+            (bytes, float, str, str):
+                log line, creation time, level name, and message of record
+        '''
+        data = (self.format(record) + '\n').encode('utf-8')
+        return (data, record.created, record.levelname, record.getMessage())
+
+    def handle(self, record): # type: (LogType, logging.LogRecord) -> bool
+        '''
+        Filter and emit record
+
+        With shards, records are emitted without the handler lock: every
+        shard has its own lock, so cores do not wait on each other
+
+        Args:
+            record (:py:class:`logging.LogRecord`):
+                logging record
+        Returns:
+            bool:
+                if True, the record passed the filters of this handler
+        '''
+        if self._shards is None:
+            return logging.Handler.handle(self, record)
+        passed = self.filter(record)
+        if passed:
+            self.emit(record)
+        return bool(passed)
+
     def emit(self, record): # type: (LogType, logging.LogRecord) -> None 
         '''
-        Format and send record to queue
+        Format and send record to queue, or write it to its shard
 
         Args:
             record (:py:class:`logging.LogRecord`):
@@ -102,7 +353,11 @@ class Log(logging.Handler):
         '''
         try:
             s = self._format_record(record)
-            self.send(s)
+            entry = self.entry(s)
+            if self._shards is not None:
+                self._shards.write(entry[0], entry[3])
+            else:
+                self.send(entry)
         except (KeyboardInterrupt, SystemExit):
             raise
         except:
@@ -110,7 +365,14 @@ class Log(logging.Handler):
 
     def close(self): # type: (LogType) -> None
         '''
-        Close logger and all associated handlers
+        Write pending records, then close logger and all associated handlers
         '''
+        self.flush()
         self._handler.close()
+        if self._index is not None:
+            self._index.close()
+        if self._shards is not None:
+            self._shards.close()
+        if self._segments is not None:
+            self._segments.close()
         logging.Handler.close(self)
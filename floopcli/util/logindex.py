@@ -0,0 +1,481 @@
+import heapq
+import io
+import mmap
+import os
+import re
+import shutil
+import struct
+import time
+
+from bisect import bisect_left, bisect_right
+from os.path import getsize, isdir, isfile, join
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple, TypeVar
+
+INDEX_SUFFIX = '.index'
+'''Suffix of the sidecar index directory next to a log file'''
+
+LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
+'''Logging level names, least severe first'''
+
+KEYS = ['core', 'level', 'function']
+'''Fields of a log record that have an index'''
+
+_LINE = struct.Struct('<QId')
+'''Index entry of one log record: byte offset, byte length, and time'''
+
+_POSTING = struct.Struct('<I')
+'''Entry of a key index: number of a record in the line index'''
+
+_MESSAGE = re.compile(r'(\S+) \((?:target|host)\) - (\w+): ')
+'''Prefix that core and CLI log messages start with'''
+
+_RECORD = re.compile(r'(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),(\d{3}) (\w+) (.*)', re.S)
+'''Log line written with the default asctime format, level, and message'''
+
+_NAME = re.compile(r'[\w.-]+$')
+'''Key values that are safe to use as file names'''
+
+def index_path(path): # type: (str) -> str
+    '''
+    Returns:
+        str:
+            sidecar index directory of the log file at path
+    '''
+    return path + INDEX_SUFFIX
+
+def parse_message(message): # type: (str) -> Tuple[Optional[str], Optional[str]]
+    '''
+    Split a log message into the core and function that logged it
+
+    Args:
+        message (str):
+            message as logged by :py:func:`floopcli.iot.core.__log` or the CLI
+    Returns:
+        (str, str):
+            core (or host) name and function name; both None if the
+            message has a different format
+    '''
+    match = _MESSAGE.match(message)
+    if match is None:
+        return None, None
+    return match.group(1), match.group(2)
+
+def parse_time(value, now=None): # type: (str, Optional[float]) -> float
+    '''
+    Parse a point in time for log queries
+
+    Args:
+        value (str):
+            local date and time (2018-01-31 13:45:00), date (2018-01-31),
+            or how long ago (30s, 10m, 2h, 1d)
+        now (float):
+            current time; defaults to :py:func:`time.time`
+    Returns:
+        float:
+            seconds since the epoch
+    Raises:
+        :py:class:`ValueError`:
+            value has none of these formats
+    '''
+    match = re.match(r'(\d+(?:\.\d+)?)([smhd])$', value)
+    if match is not None:
+        seconds = float(match.group(1)) * \
+                {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[match.group(2)]
+        return (time.time() if now is None else now) - seconds
+    for fmt in ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d']:
+        try:
+            return time.mktime(time.strptime(value, fmt))
+        except ValueError:
+            pass
+    raise ValueError('Invalid time: {}'.format(value))
+
+LogFilterType = TypeVar('LogFilterType', bound='LogFilter')
+'''Generic LogFilter type'''
+
+class LogFilter(object):
+    '''
+    Which log records a query asks for
+
+    Args:
+        core (str):
+            only records logged about this core (or host name)
+        level (str):
+            only records at this level or more severe, one of :py:data:`LEVELS`
+        function (str):
+            only records logged by this function, e.g. push
+        since (float):
+            only records logged at or after this time
+        until (float):
+            only records logged at or before this time
+    '''
+    def __init__(self, core=None, level=None, function=None, since=None,
+            until=None):
+        # type: (LogFilterType, Optional[str], Optional[str], Optional[str], Optional[float], Optional[float]) -> None
+        self.core = core
+        self.level = level
+        self.function = function
+        self.since = since
+        self.until = until
+
+    @property
+    def active(self): # type: (LogFilterType) -> bool
+        return any(value is not None for value in
+                [self.core, self.level, self.function, self.since, self.until])
+
+    def levels(self): # type: (LogFilterType) -> List[str]
+        '''
+        Returns:
+            [str]:
+                level names the filter accepts
+        '''
+        if self.level is None:
+            return LEVELS
+        return LEVELS[LEVELS.index(self.level):]
+
+    def matches(self, line): # type: (LogFilterType, str) -> bool
+        '''
+        Check a formatted log line without an index
+
+        Lines that do not start with a time and level (e.g. traceback
+        lines) only match a filter that is not active
+
+        Args:
+            line (str):
+                log line as written by :py:class:`floopcli.util.log.Log`
+        Returns:
+            bool:
+                if True, the line matches the filter
+        '''
+        if not self.active:
+            return True
+        match = _RECORD.match(line)
+        if match is None or match.group(3) not in self.levels():
+            return False
+        if self.since is not None or self.until is not None:
+            created = time.mktime(time.strptime(match.group(1),
+                '%Y-%m-%d %H:%M:%S')) + int(match.group(2)) / 1000.0
+            if self.since is not None and created < self.since:
+                return False
+            if self.until is not None and created > self.until:
+                return False
+        core, function = parse_message(match.group(4))
+        return (self.core is None or core == self.core) and \
+                (self.function is None or function == self.function)
+
+LogIndexType = TypeVar('LogIndexType', bound='LogIndex')
+'''Generic LogIndex type'''
+
+class LogIndex(object):
+    '''
+    Sidecar index of a log file, written along with the log
+
+    The index directory holds a line index with the byte offset, byte
+    length, and time of every record, and per core, level, and function
+    a key index with the numbers of its records. All are append-only
+    arrays of fixed-size entries, so a query can bisect them through
+    mmap instead of reading the log. Times in the line index never
+    decrease, so they can be bisected as well.
+
+    Records written to the log without the index (before it existed,
+    or by another writer) are not indexed; the index records where it
+    starts, and queries scan the log up to there, see :py:func:`query`.
+
+    Args:
+        path (str):
+            log file path
+    '''
+    def __init__(self, path): # type: (LogIndexType, str) -> None
+        self.path = index_path(path)
+        '''Index directory'''
+        self._files = {} # type: Dict[str, BinaryIO]
+        self._pending = {} # type: Dict[str, List[bytes]]
+        self._names = {} # type: Dict[Tuple[Any, ...], List[str]]
+        # only a writer repairs the index, see add
+        self._load()
+
+    def _load(self): # type: (LogIndexType) -> None
+        '''
+        Pick up the index as it is on disk, e.g. after another process
+        added to it; pending entries are dropped
+        '''
+        self._pending = {}
+        self.close()
+        self._count = 0
+        self._end = 0
+        self._time = 0.0
+        lines = _Table(join(self.path, 'lines'), _LINE, 2)
+        try:
+            if len(lines):
+                offset, length, self._time = lines.row(len(lines) - 1)
+                self._count = len(lines)
+                self._end = offset + length
+            else:
+                self._end = _start(self.path)
+        finally:
+            lines.close()
+        self._valid = isdir(self.path) and lines.complete
+
+    def reset(self, start=0): # type: (LogIndexType, int) -> None
+        '''
+        Drop all entries, e.g. after the log was rotated
+
+        Args:
+            start (int):
+                byte offset in the log of the first record to index
+        '''
+        self._pending = {}
+        self.close()
+        shutil.rmtree(self.path, ignore_errors=True)
+        for key in KEYS:
+            os.makedirs(join(self.path, key))
+        with open(join(self.path, 'start'), 'w') as f:
+            f.write(str(start))
+        self._count = 0
+        self._end = start
+        self._time = 0.0
+        self._valid = True
+
+    def _append(self, name, data): # type: (LogIndexType, str, bytes) -> None
+        self._pending.setdefault(name, []).append(data)
+
+    def flush(self): # type: (LogIndexType) -> None
+        '''
+        Write pending entries to the index files
+
+        Key indexes are written before the line index: a query only
+        follows key entries to records the line index already has, and
+        scans the log for the rest, so readers never see a half-written
+        batch
+        '''
+        names = sorted(self._pending, key=lambda name: name == 'lines')
+        for name in names:
+            f = self._files.get(name)
+            if f is None:
+                # unbuffered, so every flush is one write per file
+                f = open(join(self.path, name), 'ab', 0)
+                self._files[name] = f
+            f.write(b''.join(self._pending[name]))
+        self._pending = {}
+
+    def add(self, offset, length, created, level, message):
+        # type: (LogIndexType, int, int, float, str, str) -> None
+        '''
+        Index a record that was just written to the log
+
+        Entries are kept in memory until :py:meth:`flush`. If the index
+        does not end where the record starts, it is reloaded in case
+        another process indexed the records in between, and started over
+        otherwise. The caller must hold the lock of the log, see
+        :py:class:`floopcli.util.log.Log`.
+
+        Args:
+            offset (int):
+                byte offset of the record in the log
+            length (int):
+                bytes written, including the line end
+            created (float):
+                time the record was logged
+            level (str):
+                level name of the record
+            message (str):
+                record message
+        '''
+        if offset != self._end:
+            self._load()
+        if not self._valid or offset != self._end:
+            # something else wrote to or truncated the log in between
+            self.reset(offset)
+        self._time = max(self._time, created)
+        self._append('lines', _LINE.pack(offset, length, self._time))
+        core, function = parse_message(message)
+        names = self._names.get((core, level, function))
+        if names is None:
+            names = [join(key, value) for key, value in
+                    zip(KEYS, [core, level, function])
+                    if value is not None and _NAME.match(value)]
+            self._names[(core, level, function)] = names
+        posting = _POSTING.pack(self._count)
+        for name in names:
+            self._append(name, posting)
+        self._count += 1
+        self._end = offset + length
+
+    def close(self): # type: (LogIndexType) -> None
+        '''
+        Write pending entries and close all index files
+        '''
+        self.flush()
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+class _Table(object):
+    '''
+    Read-only array of fixed-size index entries, mapped into memory
+
+    Supports len() and indexing, so :py:mod:`bisect` works on it
+
+    Args:
+        path (str):
+            index file; a missing file is an empty table
+        layout (:py:class:`struct.Struct`):
+            entry layout
+        key (int):
+            field of the entry that indexing returns
+    '''
+    def __init__(self, path, layout, key=0): # type: (str, struct.Struct, int) -> None
+        self._layout = layout
+        self._key = key
+        self._map = None # type: Any
+        self._count = 0
+        self.complete = True
+        '''False if the file ends with part of an entry'''
+        if isfile(path) and getsize(path) >= layout.size:
+            with open(path, 'rb') as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._count = len(self._map) // layout.size
+            self.complete = len(self._map) % layout.size == 0
+
+    def __len__(self): # type: () -> int
+        return self._count
+
+    def __getitem__(self, idx): # type: (int) -> Any
+        return self.row(idx)[self._key]
+
+    def row(self, idx): # type: (int) -> Tuple[Any, ...]
+        '''
+        Returns:
+            tuple:
+                all fields of entry idx
+        '''
+        if not 0 <= idx < self._count:
+            raise IndexError(idx)
+        return self._layout.unpack_from(self._map, idx * self._layout.size)
+
+    def close(self): # type: () -> None
+        if self._map is not None:
+            self._map.close()
+
+def _start(path): # type: (str) -> int
+    '''
+    Returns:
+        int:
+            byte offset in the log of the first indexed record
+    '''
+    try:
+        with open(join(path, 'start')) as f:
+            return int(f.read())
+    except (IOError, OSError, ValueError):
+        return 0
+
+def _scan(log, start, end): # type: (Any, int, int) -> Iterator[bytes]
+    '''
+    Yield the lines of a mapped log between two byte offsets
+    '''
+    while start < end:
+        stop = log.find(b'\n', start, end)
+        stop = end if stop < 0 else stop + 1
+        yield log[start:stop]
+        start = stop
+
+def _contains(postings, idx, lo, hi): # type: (_Table, int, int, int) -> bool
+    pos = bisect_left(postings, idx, lo, hi)
+    return pos < hi and postings[pos] == idx
+
+def _range(postings, lo, hi): # type: (_Table, int, int) -> Iterator[int]
+    for pos in range(lo, hi):
+        yield postings[pos]
+
+def _records(path, match, lo, hi): # type: (str, LogFilter, int, int) -> Iterator[int]
+    '''
+    Yield the numbers of indexed records in [lo, hi) that match the
+    core, level, and function of a filter, in log order
+
+    The smallest key index drives; records from it are checked against
+    the other key indexes by bisection
+    '''
+    constraints = [] # type: List[List[_Table]]
+    for key, values in [('core', [match.core]), ('function', [match.function]),
+            ('level', match.levels() if match.level is not None else [None])]:
+        if values == [None]:
+            continue
+        constraints.append([_Table(join(path, key, value), _POSTING)
+            for value in values if value is not None and _NAME.match(value)])
+    if not constraints:
+        for idx in range(lo, hi):
+            yield idx
+        return
+    try:
+        bounds = [[(postings, bisect_left(postings, lo), bisect_left(postings, hi))
+            for postings in tables] for tables in constraints]
+        bounds.sort(key=lambda tables: sum(end - start for _, start, end in tables))
+        driver = heapq.merge(*[_range(postings, start, end)
+            for postings, start, end in bounds[0]])
+        for idx in driver:
+            if all(any(_contains(postings, idx, start, end)
+                for postings, start, end in tables) for tables in bounds[1:]):
+                yield idx
+    finally:
+        for tables in constraints:
+            for postings in tables:
+                postings.close()
+
+def query(path, match): # type: (str, LogFilter) -> Iterator[str]
+    '''
+    Find log records through the sidecar index
+
+    Records are read straight from the mapped log at the offsets the
+    index points to. Parts of the log the index does not cover (before
+    the index started, or written after the last index entry) are
+    scanned and checked with :py:meth:`LogFilter.matches`; without an
+    index that is the whole log.
+
+    Args:
+        path (str):
+            log file path
+        match (:py:class:`LogFilter`):
+            records to find
+    Returns:
+        generator:
+            matching records in log order, decoded, with line ends
+    Raises:
+        :py:class:`IOError`:
+            log file does not exist
+    '''
+    index = index_path(path)
+    with io.open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        log = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    lines = _Table(join(index, 'lines'), _LINE, 2)
+    try:
+        start = _start(index) if isdir(index) else size
+        end = start
+        if len(lines):
+            offset, length, _ = lines.row(len(lines) - 1)
+            end = offset + length
+        if end > size or start > size:
+            # the log was replaced without its index
+            start = end = size
+            lines.close()
+            lines = _Table('', _LINE, 2)
+        for raw in _scan(log, 0, start):
+            line = raw.decode('utf-8', 'replace')
+            if match.matches(line):
+                yield line
+        lo, hi = 0, len(lines)
+        if match.since is not None:
+            lo = bisect_left(lines, match.since)
+        if match.until is not None:
+            hi = bisect_right(lines, match.until)
+        for idx in _records(index, match, lo, hi):
+            offset, length, _ = lines.row(idx)
+            yield log[offset:offset + length].decode('utf-8', 'replace')
+        for raw in _scan(log, end, size):
+            line = raw.decode('utf-8', 'replace')
+            if match.matches(line):
+                yield line
+    finally:
+        lines.close()
+        log.close()
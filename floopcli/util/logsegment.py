@@ -0,0 +1,263 @@
+import errno
+import gzip
+import io
+import os
+import random
+import re
+import shutil
+import sys
+import threading
+import time
+import traceback
+
+from os.path import basename, dirname, getsize, isfile, join
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple, TypeVar
+
+try:
+    import queue
+except ImportError: # python 2
+    import Queue as queue # type: ignore
+
+_STAMP_FORMAT = '%Y%m%d-%H%M%S'
+'''Local time a segment was closed, as it appears in the segment name'''
+
+_RECORD_TIME = re.compile(r'(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),\d{3} ')
+'''Time at the start of a log record'''
+
+def _segment_pattern(path): # type: (str) -> Any
+    return re.compile(re.escape(basename(path)) +
+            r'\.(\d{8}-\d{6})(?:-(\d+))?(\.gz)?$')
+
+def segments(path): # type: (str) -> List[Tuple[float, str]]
+    '''
+    List closed segments of a log file, oldest first
+
+    A segment that is being compressed is listed once, by its
+    compressed name if that is complete
+
+    Args:
+        path (str):
+            log file path
+    Returns:
+        [(float, str)]:
+            time each segment was closed and its path
+    '''
+    pattern = _segment_pattern(path)
+    found = {} # type: Dict[Tuple[str, int], str]
+    directory = dirname(path) or '.'
+    for name in os.listdir(directory):
+        match = pattern.match(name)
+        if match is None:
+            continue
+        key = (match.group(1), int(match.group(2) or 0))
+        if match.group(3) or key not in found:
+            found[key] = join(dirname(path), name)
+    return [(time.mktime(time.strptime(stamp, _STAMP_FORMAT)), found[(stamp, n)])
+            for stamp, n in sorted(found)]
+
+def read_segment(path): # type: (str) -> Iterator[str]
+    '''
+    Read a closed segment line by line, decompressing as it goes
+
+    Args:
+        path (str):
+            segment path, compressed (.gz) or not
+    Returns:
+        generator:
+            decoded lines with line ends
+    '''
+    if not path.endswith('.gz') and not isfile(path):
+        # compressed since it was listed
+        path = path + '.gz'
+    if path.endswith('.gz'):
+        f = gzip.open(path, 'rb') # type: io.BufferedIOBase
+    else:
+        f = io.open(path, 'rb')
+    try:
+        for line in f:
+            yield line.decode('utf-8', 'replace')
+    finally:
+        f.close()
+
+def _first_time(path): # type: (str) -> Optional[float]
+    '''
+    Returns:
+        float:
+            time of the first record in a log file, or None
+    '''
+    try:
+        with io.open(path, 'rb') as f:
+            line = f.readline(256).decode('utf-8', 'replace')
+    except (IOError, OSError):
+        return None
+    match = _RECORD_TIME.match(line)
+    if match is None:
+        return None
+    return time.mktime(time.strptime(match.group(1), '%Y-%m-%d %H:%M:%S'))
+
+LogSegmentsType = TypeVar('LogSegmentsType', bound='LogSegments')
+'''Generic LogSegments type'''
+
+class LogSegments(object):
+    '''
+    Closed segments of a log file: rotation, compression, and retention
+
+    When the live log is rotated (see :py:meth:`rotate`), it is renamed
+    to a segment named after the time it was closed, e.g.
+    floop.log.20180131-134500, and a background thread gzips it to
+    floop.log.20180131-134500.gz. After every compression the oldest
+    segments are deleted until they fit the retention limits; the live
+    log does not count.
+
+    Several floop processes can write the same log: they write and rotate
+    while holding the lock of the log, and reopen the live log when
+    another process has rotated it, see :py:class:`floopcli.util.log.Log`.
+    Compression and retention only run in processes that rotate, so
+    commands that only read the log leave the segments alone.
+
+    Args:
+        path (str):
+            log file path
+        age (float):
+            seconds after the first record of the live log that it is
+            due for rotation; None rotates by size only
+        keep_bytes (int):
+            largest total size of closed segments; None keeps all
+        keep_age (float):
+            seconds a closed segment is kept; None keeps all
+        compress (bool):
+            if True, gzip closed segments
+    '''
+    def __init__(self, path, age=None, keep_bytes=None, keep_age=None, compress=True):
+        # type: (LogSegmentsType, str, Optional[float], Optional[int], Optional[float], bool) -> None
+        self.path = path
+        self.age = age
+        self.keep_bytes = keep_bytes
+        self.keep_age = keep_age
+        self.compress = compress
+        self._started = _first_time(path) if isfile(path) else None
+        self._queue = queue.Queue() # type: queue.Queue
+        self._queued = set() # type: Set[str]
+        self._worker = None # type: Optional[threading.Thread]
+
+    def due(self): # type: (LogSegmentsType) -> bool
+        '''
+        Returns:
+            bool:
+                if True, the live log is older than age
+        '''
+        if self.age is None:
+            return False
+        now = time.time()
+        if self._started is None:
+            self._started = now
+        return now - self._started >= self.age
+
+    def rotate(self): # type: (LogSegmentsType) -> str
+        '''
+        Close the live log as a segment; the caller must hold the lock of
+        the log, must have closed its stream, and opens a new live log
+        afterwards
+
+        Queues the new segment, and any a crashed or busy process left
+        uncompressed, for the background thread
+
+        Returns:
+            str:
+                path of the new segment
+        '''
+        stamp = time.strftime(_STAMP_FORMAT)
+        segment = '{}.{}'.format(self.path, stamp)
+        n = 0
+        while isfile(segment) or isfile(segment + '.gz'):
+            n += 1
+            segment = '{}.{}-{}'.format(self.path, stamp, n)
+        os.rename(self.path, segment)
+        self._started = None
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._work)
+            self._worker.daemon = True
+            self._worker.start()
+        for _, closed in segments(self.path):
+            if not closed.endswith('.gz') and closed not in self._queued:
+                self._queued.add(closed)
+                self._queue.put(closed)
+        self._queue.put(None)
+        return segment
+
+    def _compress(self, segment): # type: (LogSegmentsType, str) -> None
+        # another process may compress the same segment at the same time
+        tmp = '{}.gz.tmp-{}-{:08x}'.format(segment, os.getpid(),
+                random.getrandbits(32))
+        try:
+            try:
+                with io.open(segment, 'rb') as src:
+                    dst = gzip.open(tmp, 'wb')
+                    try:
+                        shutil.copyfileobj(src, dst, 1048576)
+                    finally:
+                        dst.close()
+                # readers see either the whole .gz or the plain segment
+                os.rename(tmp, segment + '.gz')
+                os.remove(segment)
+            except (IOError, OSError) as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                # the other process finished first
+        finally:
+            if isfile(tmp):
+                os.remove(tmp)
+
+    def prune(self): # type: (LogSegmentsType) -> List[str]
+        '''
+        Delete closed segments beyond the retention limits, oldest first
+
+        Returns:
+            [str]:
+                deleted segment paths
+        '''
+        closed = [] # type: List[Tuple[float, str, int]]
+        for stamp, segment in segments(self.path):
+            for name in [segment, segment + '.gz']:
+                try:
+                    closed.append((stamp, segment, getsize(name)))
+                    break
+                except OSError: # compressed or deleted meanwhile
+                    pass
+        total = sum(size for _, _, size in closed)
+        now = time.time()
+        deleted = []
+        for stamp, segment, size in closed:
+            too_big = self.keep_bytes is not None and total > self.keep_bytes
+            too_old = self.keep_age is not None and now - stamp > self.keep_age
+            if not (too_big or too_old):
+                break
+            for name in [segment, segment + '.gz']:
+                try:
+                    os.remove(name)
+                except OSError: # not there, or deleted by another process
+                    pass
+            total -= size
+            deleted.append(segment)
+        return deleted
+
+    def _work(self): # type: (LogSegmentsType) -> None
+        while True:
+            segment = self._queue.get()
+            try:
+                if segment is not None:
+                    self._queued.discard(segment)
+                    if self.compress and isfile(segment):
+                        self._compress(segment)
+                else:
+                    self.prune()
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+            finally:
+                self._queue.task_done()
+
+    def close(self): # type: (LogSegmentsType) -> None
+        '''
+        Wait until all closed segments are compressed
+        '''
+        self._queue.join()
@@ -0,0 +1,242 @@
+import heapq
+import itertools
+import os
+import re
+import threading
+
+from os.path import isdir, isfile, join
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple, TypeVar
+
+from floopcli.util.logindex import parse_message, query, LogFilter
+from floopcli.util.logsegment import read_segment, segments
+from floopcli.util.tail import tail
+
+SHARD_SUFFIX = '.shards'
+'''Suffix of the directory of per-core log shards next to a log file'''
+
+DEFAULT_SHARD = '_floop'
+'''Shard of records that are not about a core or host'''
+
+_STAMP = re.compile(r'\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3} ')
+'''Time a log record starts with; sorts like the time itself'''
+
+_NAME = re.compile(r'[\w.-]+$')
+'''Shard names that are safe to use as file names'''
+
+def shard_dir(path): # type: (str) -> str
+    '''
+    Returns:
+        str:
+            directory of the shards of the log file at path
+    '''
+    return path + SHARD_SUFFIX
+
+def shard_path(path, name): # type: (str, str) -> str
+    '''
+    Returns:
+        str:
+            file of shard name of the log file at path
+    '''
+    return join(shard_dir(path), '{}.log'.format(name))
+
+def shard_name(message): # type: (str) -> str
+    '''
+    Returns:
+        str:
+            shard of a log message: the core (or host) it is about, or
+            :py:data:`DEFAULT_SHARD`
+    '''
+    core, _ = parse_message(message)
+    if core is None or not _NAME.match(core):
+        return DEFAULT_SHARD
+    return core
+
+def shards(path): # type: (str) -> List[str]
+    '''
+    Returns:
+        [str]:
+            names of the shards of the log file at path
+    '''
+    if not isdir(shard_dir(path)):
+        return []
+    return sorted(name[:-len('.log')] for name in os.listdir(shard_dir(path))
+            if name.endswith('.log'))
+
+LogShardsType = TypeVar('LogShardsType', bound='LogShards')
+'''Generic LogShards type'''
+
+class LogShards(object):
+    '''
+    Per-core log files, written by the threads that log
+
+    Every core (and the host) gets its own shard, so threads working on
+    different cores do not wait on one queue or file; each shard has its
+    own lock, and records are written as they come with one unbuffered
+    write each. Records of one core are logged in order, so every shard
+    is sorted by time and :py:func:`read` can merge them on demand.
+
+    Args:
+        path (str):
+            log file path; shards go to :py:func:`shard_dir`
+    '''
+    def __init__(self, path): # type: (LogShardsType, str) -> None
+        self.path = shard_dir(path)
+        '''Shard directory'''
+        self._files = {} # type: Dict[str, Tuple[threading.Lock, BinaryIO]]
+        self._lock = threading.Lock()
+        try:
+            os.makedirs(self.path)
+        except OSError: # dir exists
+            pass
+
+    def _shard(self, name): # type: (LogShardsType, str) -> Tuple[threading.Lock, BinaryIO]
+        shard = self._files.get(name)
+        if shard is None:
+            with self._lock:
+                shard = self._files.get(name)
+                if shard is None:
+                    shard = (threading.Lock(),
+                            open(join(self.path, '{}.log'.format(name)), 'ab', 0))
+                    self._files[name] = shard
+        return shard
+
+    def write(self, data, message): # type: (LogShardsType, bytes, str) -> None
+        '''
+        Append a formatted record to the shard of its message
+
+        Args:
+            data (bytes):
+                formatted record, including the line end
+            message (str):
+                record message, see :py:func:`shard_name`
+        '''
+        lock, f = self._shard(shard_name(message))
+        with lock:
+            f.write(data)
+
+    def close(self): # type: (LogShardsType) -> None
+        '''
+        Close all shard files
+        '''
+        with self._lock:
+            for _, f in self._files.values():
+                f.close()
+            self._files = {}
+
+def records(lines): # type: (Iterator[str]) -> Iterator[str]
+    '''
+    Join log lines into records
+
+    A record is a line that starts with a time and the lines after it
+    that do not, e.g. a traceback
+
+    Args:
+        lines (generator):
+            log lines with line ends
+    Returns:
+        generator:
+            records with line ends
+    '''
+    record = [] # type: List[str]
+    for line in lines:
+        if record and _STAMP.match(line):
+            yield ''.join(record)
+            record = []
+        record.append(line)
+    if record:
+        yield ''.join(record)
+
+def _keyed(records, idx): # type: (Iterator[str], int) -> Iterator[Tuple[str, int, str]]
+    '''
+    Yield merge keys for records of one sorted stream
+
+    Records without a time (only possible at the start of a stream)
+    sort first; ties keep the stream order
+    '''
+    for record in records:
+        match = _STAMP.match(record)
+        yield (match.group(0) if match else '', idx, record)
+
+def merge(streams): # type: (List[Iterator[str]]) -> Iterator[str]
+    '''
+    Merge streams of records that are each sorted by time
+
+    Holds one record per stream in memory at a time
+
+    Args:
+        streams ([generator]):
+            records, see :py:func:`records`
+    Returns:
+        generator:
+            records of all streams, sorted by time
+    '''
+    if len(streams) == 1:
+        for record in streams[0]:
+            yield record
+        return
+    for _, _, record in heapq.merge(*[_keyed(stream, idx)
+        for idx, stream in enumerate(streams)]):
+        yield record
+
+def _closed(path, match): # type: (str, LogFilter) -> List[Iterator[str]]
+    '''
+    Returns:
+        [generator]:
+            matching records of the closed segments of the log file at
+            path that can hold records between match.since and match.until
+    '''
+    streams = [] # type: List[Iterator[str]]
+    opened = None # type: Optional[float]
+    for closed, segment in segments(path):
+        # close times are truncated to the second
+        if (match.since is None or closed + 1 >= match.since) and \
+                (match.until is None or opened is None or opened <= match.until):
+            stream = records(read_segment(segment))
+            if match.active:
+                stream = (record for record in stream if match.matches(record))
+            streams.append(stream)
+        opened = closed
+    return streams
+
+def read(path, match=None): # type: (str, Optional[LogFilter]) -> Iterator[str]
+    '''
+    Read the log as one stream, across the log file and its shards
+
+    The log file is read through its index (see
+    :py:func:`floopcli.util.logindex.query`), after its closed segments
+    (see :py:mod:`floopcli.util.logsegment`), which are decompressed
+    and filtered as they are read, like shards. A filter by core only
+    opens the shard of that core.
+
+    Args:
+        path (str):
+            log file path
+        match (:py:class:`floopcli.util.logindex.LogFilter`):
+            records to read; defaults to all records
+    Returns:
+        generator:
+            matching records, sorted by time, with line ends
+    Raises:
+        :py:class:`IOError`:
+            neither the log file nor any shard exists
+    '''
+    if match is None:
+        match = LogFilter()
+    names = shards(path)
+    if match.core is not None:
+        names = [name for name in names if name == match.core]
+    streams = [] # type: List[Iterator[str]]
+    closed = _closed(path, match)
+    if isfile(path) or not (names or closed):
+        if match.active:
+            closed.append(query(path, match))
+        else:
+            closed.append(records(tail(path)))
+    if closed:
+        streams.append(itertools.chain(*closed))
+    for name in names:
+        stream = records(tail(shard_path(path, name)))
+        if match.active:
+            stream = (record for record in stream if match.matches(record))
+        streams.append(stream)
+    return merge(streams)
@@ -0,0 +1,304 @@
+import hashlib
+import shutil
+import tarfile
+import tempfile
+import threading
+
+from io import BytesIO
+from os import listdir, lstat, readlink
+from os.path import abspath
+from stat import S_ISDIR, S_ISLNK, S_ISREG
+from typing import Any, Dict, List, Optional, Set, Tuple, TypeVar
+
+from floopcli.util.ignore import IgnoreMatcher
+from floopcli.util.state import state_path, read_core_state, read_json, \
+        write_json
+
+_HASH_CHUNK_SIZE = 1048576
+'''Number of bytes to read from a file at a time while hashing'''
+
+DELTA_DELETE_FILE = '.floop-delete'
+'''Name of the NUL-separated list of removed paths inside a delta archive'''
+
+ManifestType = TypeVar('ManifestType', bound='Manifest')
+'''Generic Manifest type'''
+
+class Manifest(object):
+    '''
+    Content manifest of a host source directory
+
+    Regular files, symlinks, and directories are recorded with their
+    mode, so a chmod, a new link target, or a new empty directory
+    changes the manifest too
+
+    Args:
+        entries (dict):
+            relative path to [size, mtime, content hash, mode]; the
+            content of a symlink is its target, a directory has none
+    '''
+    def __init__(self, entries): # type: (ManifestType, Dict[str, List]) -> None
+        self.entries = entries
+        '''Relative path to [size, mtime, content hash, mode]'''
+        sha = hashlib.sha1()
+        for path in sorted(entries):
+            size, _, digest, mode = entries[path]
+            sha.update('{}\0{}\0{}\0{:o}\n'.format(
+                path, size, digest, mode).encode('utf-8'))
+        self.digest = sha.hexdigest()
+        '''Hash of all paths, sizes, content hashes, and modes (mtime is ignored)'''
+
+    def changes(self, other): # type: (ManifestType, Manifest) -> Tuple[List[str], List[str]]
+        '''
+        Compare to an older manifest
+
+        Args:
+            other (:py:class:`floopcli.util.manifest.Manifest`):
+                older manifest
+        Returns:
+            ([str], [str]):
+                relative paths that are new or changed, and relative paths
+                that were removed
+        '''
+        changed = [path for path, entry in self.entries.items()
+                if path not in other.entries or
+                other.entries[path][0] != entry[0] or
+                other.entries[path][2:] != entry[2:]]
+        removed = [path for path in other.entries if path not in self.entries]
+        return sorted(changed), sorted(removed)
+
+    def save(self): # type: (ManifestType) -> None
+        '''
+        Store manifest in the floop state directory under its digest
+        '''
+        write_json(state_path('manifests', '{}.json'.format(self.digest)),
+                self.entries)
+
+    @classmethod
+    def load(cls, digest): # type: (str) -> Optional[Manifest]
+        '''
+        Load a stored manifest by digest
+
+        Args:
+            digest (str):
+                manifest digest
+        Returns:
+            :py:class:`floopcli.util.manifest.Manifest`:
+                stored manifest, or None if it was not stored
+        '''
+        entries = read_json(state_path('manifests', '{}.json'.format(digest)))
+        # manifests stored before modes were recorded cannot be compared
+        if entries is None or any(len(entry) != 4 for entry in entries.values()):
+            return None
+        return cls(entries)
+
+def _hash_file(path): # type: (str) -> str
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+_hash_cache_lock = threading.Lock()
+
+def scan(source, ignore=None): # type: (str, Optional[IgnoreMatcher]) -> Manifest
+    '''
+    Build the content manifest of a source directory
+
+    File hashes are cached in the floop state directory keyed on
+    (inode, mtime, size), so only new or modified files are read.
+    Ignored directories are not walked at all.
+
+    Args:
+        source (str):
+            host source directory
+        ignore (:py:class:`floopcli.util.ignore.IgnoreMatcher`):
+            paths to leave out; defaults to the .floopignore of source
+    Returns:
+        :py:class:`floopcli.util.manifest.Manifest`:
+            manifest of source
+    '''
+    if ignore is None:
+        ignore = IgnoreMatcher.load(source)
+    with _hash_cache_lock:
+        return _scan(source, ignore)
+
+def _scan(source, ignore): # type: (str, IgnoreMatcher) -> Manifest
+    cache_file = state_path('hashes.json')
+    cache = read_json(cache_file, {})
+    dirty = False
+    entries = {} # type: Dict[str, List]
+    seen = set() # type: Set[str]
+    # plain string paths; os.path helpers dominate the cost of a rescan
+    top = abspath(source)
+    stack = ['']
+    while stack:
+        rel_dir = stack.pop()
+        abs_dir = top + '/' + rel_dir
+        for name in listdir(abs_dir):
+            rel = rel_dir + name
+            key = abs_dir + name
+            st = lstat(key)
+            if S_ISDIR(st.st_mode):
+                if not ignore.match(rel, True):
+                    stack.append(rel + '/')
+                    entries[rel] = [0, st.st_mtime, '', st.st_mode]
+                continue
+            if ignore.match(rel):
+                continue
+            if S_ISLNK(st.st_mode):
+                entries[rel] = [st.st_size, st.st_mtime, readlink(key),
+                        st.st_mode]
+                continue
+            if not S_ISREG(st.st_mode):
+                continue
+            stamp = [st.st_ino, st.st_mtime, st.st_size]
+            cached = cache.get(key)
+            if cached is not None and cached[:3] == stamp:
+                digest = cached[3]
+            else:
+                digest = _hash_file(key)
+                cache[key] = stamp + [digest]
+                dirty = True
+            seen.add(key)
+            entries[rel] = [st.st_size, st.st_mtime, digest, st.st_mode]
+    # forget files under this source that no longer exist
+    prefix = top + '/'
+    for key in [k for k in cache if k.startswith(prefix) and k not in seen]:
+        del cache[key]
+        dirty = True
+    if dirty:
+        write_json(cache_file, cache)
+    return Manifest(entries)
+
+_manifests = {} # type: Dict[str, Manifest]
+_manifest_locks = {} # type: Dict[str, threading.Lock]
+_manifests_lock = threading.Lock()
+
+def source_manifest(source): # type: (str) -> Manifest
+    '''
+    Manifest of a source directory, scanned once per floop command
+
+    Cores that share a host source wait for one scan instead of each
+    walking the tree
+
+    Args:
+        source (str):
+            host source directory
+    Returns:
+        :py:class:`floopcli.util.manifest.Manifest`:
+            manifest of source
+    '''
+    key = abspath(source)
+    with _manifests_lock:
+        lock = _manifest_locks.setdefault(key, threading.Lock())
+    with lock:
+        if key not in _manifests:
+            _manifests[key] = scan(source)
+        return _manifests[key]
+
+def forget_manifest(source): # type: (str) -> None
+    '''
+    Drop the remembered manifest of a source directory so the next
+    :py:func:`source_manifest` call scans it again
+
+    Args:
+        source (str):
+            host source directory
+    '''
+    key = abspath(source)
+    with _manifests_lock:
+        lock = _manifest_locks.setdefault(key, threading.Lock())
+    with lock:
+        _manifests.pop(key, None)
+
+def push_target(core): # type: (Any) -> str
+    '''
+    Where a push to core lands: SSH user, address, port, and target source
+
+    Args:
+        core (:py:class:`floopcli.iot.core.Core`):
+            initialized target core object
+    Returns:
+        str:
+            push destination of core
+    '''
+    return '{}@{}:{}:{}'.format(core.user, core.address, core.port,
+            core.target_source)
+
+def pushed_manifest(core): # type: (Any) -> Optional[str]
+    '''
+    Digest of the manifest last pushed to core
+
+    A push recorded for another destination (e.g. the core was repointed
+    at a new address or target source) does not count
+
+    Args:
+        core (:py:class:`floopcli.iot.core.Core`):
+            initialized target core object
+    Returns:
+        str:
+            manifest digest, or None if nothing was pushed to the current
+            destination of core
+    '''
+    state = read_core_state(core.core)
+    if state.get('target') != push_target(core):
+        return None
+    return state.get('manifest')
+
+_deltas = {} # type: Dict[str, str]
+_delta_locks = {} # type: Dict[str, threading.Lock]
+_deltas_lock = threading.Lock()
+_delta_dir = [] # type: List[str]
+
+def delta_archive(base, prefix, manifest, previous): # type: (str, str, Manifest, Manifest) -> str
+    '''
+    Build the change set between two manifests once and share it
+
+    The archive holds every new or changed file plus a list of removed
+    paths (:py:data:`DELTA_DELETE_FILE`), so every core that last received
+    previous can be brought up to manifest with the same bytes
+
+    Args:
+        base (str):
+            host directory that manifest paths are relative to
+        prefix (str):
+            path prefix for archive members on the target
+        manifest (:py:class:`floopcli.util.manifest.Manifest`):
+            current manifest
+        previous (:py:class:`floopcli.util.manifest.Manifest`):
+            manifest the targets already have
+    Returns:
+        str:
+            path to gzipped tar archive on host
+    '''
+    key = hashlib.sha1('{}\0{}\0{}\0{}'.format(abspath(base), prefix,
+        previous.digest, manifest.digest).encode('utf-8')).hexdigest()
+    with _deltas_lock:
+        lock = _delta_locks.setdefault(key, threading.Lock())
+        if not _delta_dir:
+            _delta_dir.append(tempfile.mkdtemp(prefix='floop-delta-'))
+        delta_dir = _delta_dir[0]
+    with lock:
+        if key in _deltas:
+            return _deltas[key]
+        changed, removed = manifest.changes(previous)
+        path = '{}/{}.tar.gz'.format(delta_dir, key)
+        with tarfile.open(path, 'w:gz') as archive:
+            for rel in changed:
+                archive.add('{}/{}'.format(base, prefix + rel),
+                        arcname=prefix + rel, recursive=False)
+            listing = '\0'.join(prefix + rel for rel in removed).encode('utf-8')
+            info = tarfile.TarInfo(DELTA_DELETE_FILE)
+            info.size = len(listing)
+            archive.addfile(info, BytesIO(listing))
+        _deltas[key] = path
+        return path
+
+def remove_deltas(): # type: () -> None
+    '''
+    Remove all delta archives built by this process
+    '''
+    with _deltas_lock:
+        _deltas.clear()
+        while _delta_dir:
+            shutil.rmtree(_delta_dir.pop(), ignore_errors=True)
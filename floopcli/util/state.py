@@ -0,0 +1,109 @@
+import json
+import threading
+
+from os import makedirs, remove, rename
+from os.path import dirname, isfile, join
+from typing import Any, Dict
+
+_FLOOP_STATE_DIR = './.floop'
+'''Directory on host for floop state that persists between commands'''
+
+_state_lock = threading.Lock()
+
+def state_path(*parts): # type: (*str) -> str
+    '''
+    Path to a file or directory inside the floop state directory
+
+    Args:
+        parts (str):
+            path components relative to the state directory
+    Returns:
+        str:
+            path inside the state directory
+    '''
+    return join(_FLOOP_STATE_DIR, *parts)
+
+def read_json(path, default=None): # type: (str, Any) -> Any
+    '''
+    Read a JSON state file
+
+    Args:
+        path (str):
+            path to JSON file
+        default:
+            value to return if the file does not exist or is corrupt
+    Returns:
+        parsed JSON content or default
+    '''
+    if not isfile(path):
+        return default
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return default
+
+def write_json(path, value): # type: (str, Any) -> None
+    '''
+    Atomically write a JSON state file, creating parent directories
+
+    Args:
+        path (str):
+            path to JSON file
+        value:
+            JSON-serializable value
+    '''
+    try:
+        makedirs(dirname(path))
+    except OSError: # dir exists
+        pass
+    tmp = '{}.tmp-{}'.format(path, threading.current_thread().ident)
+    with open(tmp, 'w') as f:
+        json.dump(value, f)
+    rename(tmp, path)
+
+def read_core_state(core): # type: (str) -> Dict[str, Any]
+    '''
+    Read what floop last recorded about a core
+
+    Args:
+        core (str):
+            core name
+    Returns:
+        dict:
+            recorded state; empty if nothing was recorded
+    '''
+    return read_json(state_path('cores', '{}.json'.format(core)), {})
+
+def update_core_state(core, **values): # type: (str, **Any) -> Dict[str, Any]
+    '''
+    Merge values into the recorded state of a core
+
+    Args:
+        core (str):
+            core name
+        values:
+            keys and JSON-serializable values to record
+    Returns:
+        dict:
+            updated state
+    '''
+    with _state_lock:
+        state = read_core_state(core)
+        state.update(values)
+        write_json(state_path('cores', '{}.json'.format(core)), state)
+        return state
+
+def clear_core_state(core): # type: (str) -> None
+    '''
+    Forget everything recorded about a core, e.g. after it was created
+    or destroyed
+
+    Args:
+        core (str):
+            core name
+    '''
+    with _state_lock:
+        path = state_path('cores', '{}.json'.format(core))
+        if isfile(path):
+            remove(path)
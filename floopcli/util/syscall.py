@@ -1,59 +1,378 @@
+import codecs
+import os
 import subprocess
+import threading
+import time
+from collections import deque
 from sys import stdout
 from shlex import split
-from typing import List, Tuple 
+from typing import Any, Callable, List, Optional, Set, Tuple, TypeVar
+
+try:
+    from shlex import quote
+except ImportError: # python 2
+    from pipes import quote
+
+_READ_CHUNK_SIZE = 65536
+'''Number of bytes to read from a child process pipe at a time'''
 
 class SystemCallException(Exception):
     '''
     System call returned non-zero exit code
+
+    The exit code is kept in the returncode attribute, or None if the
+    call failed before its process exited
+    '''
+    returncode = None # type: Optional[int]
+
+class SystemCallCancelled(SystemCallException):
+    '''
+    System call was stopped by :py:func:`cancel_syscalls`
     '''
     pass
 
+class SystemCallTimeout(SystemCallException):
+    '''
+    System call ran out of time, see :py:class:`Budget`
+
+    The name of the budget that ran out is kept in the budget attribute
+    '''
+    budget = None # type: Optional[str]
+
+_processes = set() # type: Set[subprocess.Popen]
+_processes_lock = threading.Lock()
+_cancelled = threading.Event()
+
+def cancel_syscalls(): # type: () -> int
+    '''
+    Kill every running system call and refuse new ones
+
+    Safe to call from any thread. Calls that are running raise
+    :py:class:`SystemCallCancelled` as soon as their process exits; new
+    calls raise it without starting a process, until
+    :py:func:`reset_syscalls`.
+
+    Returns:
+        int:
+            number of processes killed
+    '''
+    _cancelled.set()
+    with _processes_lock:
+        processes = list(_processes)
+    for process in processes:
+        try:
+            process.kill()
+        except OSError: # already exited
+            pass
+    return len(processes)
+
+def syscalls_cancelled(): # type: () -> bool
+    '''
+    Returns:
+        bool:
+            if True, :py:func:`cancel_syscalls` was called and not reset
+    '''
+    return _cancelled.is_set()
+
+def reset_syscalls(): # type: () -> None
+    '''
+    Allow system calls again after :py:func:`cancel_syscalls`
+    '''
+    _cancelled.clear()
+
+_budgets = threading.local()
+
+def _budget_stack(): # type: () -> List[Budget]
+    if not hasattr(_budgets, 'stack'):
+        _budgets.stack = []
+    return _budgets.stack
+
+BudgetType = TypeVar('BudgetType', bound='Budget')
+'''Generic Budget type'''
+
+class Budget(object):
+    '''
+    Context manager that bounds the time of system calls in this thread
+
+    Budgets nest; every system call gets the tightest one. A budget with
+    each=False is a deadline shared by all calls inside it (e.g. a whole
+    core operation), one with each=True restarts for every call (a
+    per-command limit). Expired calls are killed from a timer thread,
+    not by a signal, so budgets work in any thread.
+
+    Args:
+        name (str):
+            what the budget is for, reported when it runs out
+        seconds (float):
+            time budget; None means unlimited
+        each (bool):
+            if True, the budget applies to every system call separately
+    '''
+    def __init__(self, name, seconds, each=False): # type: (BudgetType, str, Optional[float], bool) -> None
+        self.name = name
+        self.seconds = seconds
+        self.each = each
+        self._expires = None # type: Optional[float]
+
+    def __enter__(self): # type: (BudgetType) -> BudgetType
+        if self.seconds is not None and not self.each:
+            self._expires = time.time() + self.seconds
+        _budget_stack().append(self)
+        return self
+
+    def __exit__(self, *exc): # type: (BudgetType, *Any) -> None
+        _budget_stack().remove(self)
+
+    def remaining(self): # type: (BudgetType) -> Optional[float]
+        '''
+        Returns:
+            float:
+                seconds the next system call may take, or None if unlimited
+        '''
+        if self._expires is None:
+            return self.seconds
+        return max(0.0, self._expires - time.time())
+
+def _tightest(timeout): # type: (Optional[float]) -> Tuple[Optional[float], str]
+    '''
+    Returns:
+        (float, str):
+            seconds the next system call may take (None if unlimited) and
+            the name of the budget that sets the limit
+    '''
+    limit, name = timeout, 'timeout'
+    for budget in _budget_stack():
+        remaining = budget.remaining()
+        if remaining is not None and (limit is None or remaining < limit):
+            limit, name = remaining, budget.name
+    return limit, name
+
+def expired_budget(): # type: () -> Optional[str]
+    '''
+    Returns:
+        str:
+            name of the budget behind the last system call that timed out
+            in this thread, or None; see :py:func:`clear_expired_budget`
+    '''
+    return getattr(_budgets, 'expired', None)
+
+def clear_expired_budget(): # type: () -> None
+    '''
+    Forget the last timeout of this thread, e.g. before a new core operation
+    '''
+    _budgets.expired = None
+
+class RingBufferSink(object):
+    '''
+    Output sink that only keeps the last maxsize characters of output
+
+    Args:
+        maxsize (int):
+            maximum number of characters to retain
+    '''
+    def __init__(self, maxsize=65536): # type: (int) -> None
+        self.maxsize = maxsize
+        self._lines = deque() # type: deque
+        self._size = 0
+
+    def __call__(self, line): # type: (str) -> None
+        self._lines.append(line)
+        self._size += len(line)
+        while self._size > self.maxsize and len(self._lines) > 1:
+            self._size -= len(self._lines.popleft())
+
+    def getvalue(self): # type: () -> str
+        '''
+        Returns:
+            str:
+                retained tail of the output
+        '''
+        value = ''.join(self._lines)
+        return value[-self.maxsize:]
+
+class FileSink(object):
+    '''
+    Output sink that writes every line to an open file or file path
+
+    Args:
+        target (str or file):
+            path to open in append mode, or an already open text file
+    '''
+    def __init__(self, target): # type: (Any) -> None
+        self._owned = not hasattr(target, 'write')
+        if self._owned:
+            self._file = open(target, 'a')
+        else:
+            self._file = target
+
+    def __call__(self, line): # type: (str) -> None
+        self._file.write(line)
+
+    def close(self): # type: () -> None
+        '''
+        Close the underlying file if this sink opened it
+        '''
+        if self._owned:
+            self._file.close()
+
+def _expire(process, expired): # type: (subprocess.Popen, List[bool]) -> None
+    '''
+    Kill a process whose time budget ran out and record the expiry
+    '''
+    expired.append(True)
+    try:
+        process.kill()
+    except OSError:
+        pass
+
+def _stream(process, sinks): # type: (subprocess.Popen, List[Callable[[str], None]]) -> None
+    '''
+    Incrementally decode process stdout and hand each line to every sink
+
+    Reads fixed-size chunks so memory is bounded by the longest line,
+    not by the total output size. The pieces of a partial line are only
+    joined once its newline arrives, so a long line costs linear time.
+    '''
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    fd = process.stdout.fileno() # type: ignore
+    pending = [] # type: List[str]
+    while True:
+        chunk = os.read(fd, _READ_CHUNK_SIZE)
+        text = decoder.decode(chunk, final=not chunk)
+        if '\n' in text:
+            lines = text.split('\n')
+            pending.append(lines[0])
+            lines[0] = ''.join(pending)
+            last = lines.pop()
+            pending = [last] if last else []
+            for line in lines:
+                line += '\n'
+                for sink in sinks:
+                    sink(line)
+        elif text:
+            pending.append(text)
+        if not chunk:
+            break
+    if pending:
+        line = ''.join(pending)
+        for sink in sinks:
+            sink(line)
+
 # TODO: figure out consistent Python 2/3 typing
 def syscall(command, check=False, # type: ignore
-        verbose=False): 
+        verbose=False, sink=None, capture=True, timeout=None, stdin=None,
+        output=None):
     '''
     Call system to run system command
 
+    Output is decoded incrementally and handed line-by-line to the sink
+    (if any). The full output is only held in memory when capture is True.
+
     Args:
-        command (str):
-            system command; should not contain pipes (|)
+        command (str or [str]):
+            system command; should not contain pipes (|); a list is
+            passed to the system as-is without shell-style splitting
         check (bool):
             whether to check for non-zero exit code
         verbose (bool):
             if True, streams command output to stdout
+        sink (callable):
+            called with each line of stdout as it arrives, e.g.
+            :py:class:`floopcli.util.syscall.RingBufferSink`
+        capture (bool):
+            if True, return the full stdout; otherwise return an empty string
+        timeout (float):
+            seconds to wait before killing the command; works from any
+            thread because it does not rely on signals. A tighter
+            :py:class:`Budget` of the current thread takes precedence.
+        stdin (file):
+            open file to use as the command's standard input
+        output (file):
+            open file to write the command's standard output to as-is,
+            e.g. binary data; it then goes to neither sink nor return value
 
     Raises:
         :py:class:`floopcli.util.SystemCallException`:
-            verbose=True and command exited with non-zero code
+            verbose=True and command exited with non-zero code,
+            or the command ran longer than timeout
+        :py:class:`floopcli.util.SystemCallTimeout`:
+            command ran longer than timeout or the budget of the thread,
+            or the budget was already used up
+        :py:class:`floopcli.util.SystemCallCancelled`:
+            system calls were cancelled before or while command ran
 
     Returns:
         (str, str):
             tuple of command output to (stdout, stderr)
     '''
-    command_ = split(command)
+    if isinstance(command, (list, tuple)):
+        command_ = list(command)
+    else:
+        command_ = split(command)
+    if _cancelled.is_set():
+        raise SystemCallCancelled('Cancelled: {}'.format(command))
+    limit, budget = _tightest(timeout)
+    if limit is not None and limit <= 0:
+        _budgets.expired = budget
+        error = SystemCallTimeout('No time left ({}): {}'.format(budget, command))
+        error.budget = budget
+        raise error
     try:
-        process = subprocess.Popen(command_, stdout=subprocess.PIPE)
-        out = ''
-        # Python 2: str to bytes?
-        # Python 3: unicode to str?
-        for line in iter(process.stdout.readline, b''): # type: ignore
-            line = line.decode('utf-8')
-            out += line
-            if verbose:
-                # this sits below the logger, so removing the console handler 
-                # would not silence this print
-                stdout.write(line)
-        _, err = process.communicate()
+        process = subprocess.Popen(command_, stdin=stdin,
+                stdout=subprocess.PIPE if output is None else output)
+        with _processes_lock:
+            _processes.add(process)
+        # cancel_syscalls may have swept the registry before the add
+        if _cancelled.is_set():
+            process.kill()
+        expired = [] # type: List[bool]
+        timer = None
+        if limit is not None:
+            timer = threading.Timer(limit, _expire, [process, expired])
+            timer.daemon = True
+            timer.start()
+        out = [] # type: List[str]
+        sinks = [] # type: List[Callable[[str], None]]
+        if capture:
+            sinks.append(out.append)
+        if verbose:
+            # this sits below the logger, so removing the console handler
+            # would not silence this print
+            sinks.append(stdout.write)
+        if sink is not None:
+            sinks.append(sink)
+        try:
+            if output is None:
+                _stream(process, sinks)
+            _, err = process.communicate()
+        finally:
+            if timer is not None:
+                timer.cancel()
+            with _processes_lock:
+                _processes.discard(process)
+        if _cancelled.is_set():
+            raise SystemCallCancelled('Cancelled: {}'.format(command))
+        if expired:
+            _budgets.expired = budget
+            error = SystemCallTimeout('Timed out after {:.1f} seconds ({}): {}'.format(
+                limit, budget, command))
+            error.budget = budget
+            raise error
         if err is not None:
             err = err.decode('utf-8')
         if check:
             if process.returncode != 0:
-                raise SystemCallException(err)
-        return (out, err)
+                error = SystemCallException(err)
+                error.returncode = process.returncode
+                raise error
+        return (''.join(out), err)
     except (KeyboardInterrupt, SystemCallException) as e:
         try:
             process.kill()
         except OSError:
             pass
-        raise SystemCallException
+        if isinstance(e, (SystemCallCancelled, SystemCallTimeout)):
+            raise
+        error = SystemCallException(*e.args)
+        error.returncode = getattr(e, 'returncode', None)
+        raise error
@@ -0,0 +1,134 @@
+import io
+import os
+import time
+
+from typing import Callable, Iterator, Optional
+
+_POLL_INTERVAL = 0.5
+'''Seconds between checks for new log lines while following'''
+
+_BLOCK_SIZE = 65536
+'''Bytes read at a time while looking for the last lines of a log'''
+
+def _decode(line): # type: (bytes) -> str
+    return line.decode('utf-8', 'replace')
+
+def _rotated(path, f): # type: (str, io.BufferedReader) -> bool
+    '''
+    Returns:
+        bool:
+            if True, path no longer refers to the open file f, e.g. because
+            a rotating handler renamed it and started a new one
+    '''
+    try:
+        return os.stat(path).st_ino != os.fstat(f.fileno()).st_ino
+    except OSError: # renamed and not created again yet
+        return True
+
+def _truncated(path, f): # type: (str, io.BufferedReader) -> bool
+    try:
+        return os.stat(path).st_size < f.tell()
+    except OSError:
+        return False
+
+def _seek_last(f, count): # type: (io.BufferedReader, int) -> None
+    '''
+    Move f to the start of its last count lines, reading backwards from
+    the end of the file in blocks
+    '''
+    f.seek(0, io.SEEK_END)
+    end = pos = f.tell()
+    while count > 0 and pos > 0:
+        size = min(_BLOCK_SIZE, pos)
+        pos -= size
+        f.seek(pos)
+        block = f.read(size)
+        stop = len(block)
+        if pos + size == end and block.endswith(b'\n'):
+            # the line end of the last line does not start a new line
+            stop -= 1
+        while True:
+            stop = block.rfind(b'\n', 0, stop)
+            if stop < 0:
+                break
+            count -= 1
+            if count == 0:
+                f.seek(pos + stop + 1)
+                return
+    f.seek(pos if count > 0 else end)
+
+def tail(path, follow=False, poll=_POLL_INTERVAL, stop=None, last=None):
+    # type: (str, bool, float, Optional[Callable[[], bool]], Optional[int]) -> Iterator[str]
+    '''
+    Read a log file line by line
+
+    The file is read in buffered chunks, so memory is bounded by the
+    longest line, not by the size of the file. With follow, new lines
+    are yielded as they are written, like tail -f: the file is polled,
+    and when it is rotated (renamed or replaced) or truncated, the rest
+    of the old file is read before continuing with the new one. With
+    last, reading starts at the last lines of the file instead of its
+    start, so following a large log does not replay it first.
+
+    Args:
+        path (str):
+            log file path
+        follow (bool):
+            if True, keep waiting for new lines instead of stopping at
+            the end of the file; the file does not need to exist yet
+        poll (float):
+            seconds to wait at the end of the file before checking again
+        stop (callable):
+            called while waiting; following ends when it returns True
+        last (int):
+            if set, skip all but this many lines at the end of the file;
+            a file that only appears while following is read in full
+    Returns:
+        generator:
+            decoded lines, including their line ends; with follow, only
+            complete lines
+    Raises:
+        :py:class:`IOError`:
+            log file does not exist and follow is False
+    '''
+    f = None # type: Optional[io.BufferedReader]
+    if not follow or os.path.isfile(path):
+        f = io.open(path, 'rb') # type: ignore
+        if last is not None:
+            _seek_last(f, last)
+    pending = b''
+    try:
+        while True:
+            if f is None and os.path.isfile(path):
+                f = io.open(path, 'rb') # type: ignore
+            # check before reading, so that the old file is read to its
+            # end even if the writer appended to it just before rotating
+            rotated = follow and f is not None and _rotated(path, f)
+            if f is not None:
+                for line in iter(f.readline, b''):
+                    # the writer may be in the middle of a line
+                    pending += line
+                    if pending.endswith(b'\n'):
+                        yield _decode(pending)
+                        pending = b''
+            if not follow:
+                if pending:
+                    yield _decode(pending)
+                return
+            if rotated:
+                if pending:
+                    yield _decode(pending)
+                    pending = b''
+                f.close() # type: ignore
+                f = None
+                continue
+            if stop is not None and stop():
+                return
+            if f is not None and _truncated(path, f):
+                f.seek(0)
+                pending = b''
+                continue
+            time.sleep(poll)
+    finally:
+        if f is not None:
+            f.close()
@@ -0,0 +1,344 @@
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import struct
+import time
+
+from fnmatch import fnmatch
+from os.path import abspath, isfile, normpath
+from stat import S_ISDIR, S_ISREG
+from typing import Dict, List, Optional, Set, Tuple, TypeVar
+
+from floopcli.util.ignore import IgnoreMatcher, FLOOP_IGNORE_FILE
+
+_IN_MODIFY = 0x00000002
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+
+_WATCH_MASK = _IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | \
+        _IN_MOVED_TO | _IN_CREATE | _IN_DELETE | _IN_DELETE_SELF
+'''inotify events that mean a file or directory changed'''
+
+_EVENT_HEADER = struct.Struct('iIII')
+'''struct inotify_event without the trailing name'''
+
+_POLL_INTERVAL = 0.5
+'''Seconds between snapshots when inotify is not available'''
+
+_MAX_DEBOUNCE = 2.0
+'''Longest time to keep collecting a burst of changes'''
+
+def _inotify(): # type: () -> Optional[ctypes.CDLL]
+    '''
+    Returns:
+        :py:class:`ctypes.CDLL`:
+            libc with inotify functions, or None if inotify is not available
+    '''
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+def _walk(source, ignore, start=''): # type: (str, IgnoreMatcher, str) -> Tuple[List[str], Dict[str, Tuple[float, int]]]
+    '''
+    Walk a source directory, skipping ignored paths
+
+    Args:
+        source (str):
+            host source directory
+        ignore (:py:class:`floopcli.util.ignore.IgnoreMatcher`):
+            ignore rules of source
+        start (str):
+            relative directory to walk, ending in /; '' walks all of source
+    Returns:
+        ([str], dict):
+            relative directories (including start) and relative file
+            path to (mtime, size), all relative to source
+    '''
+    top = abspath(source)
+    dirs = [start]
+    files = {} # type: Dict[str, Tuple[float, int]]
+    stack = [start]
+    while stack:
+        rel_dir = stack.pop()
+        try:
+            names = os.listdir(top + '/' + rel_dir)
+        except OSError: # removed while walking
+            continue
+        for name in names:
+            rel = rel_dir + name
+            try:
+                st = os.lstat(top + '/' + rel)
+            except OSError:
+                continue
+            if S_ISDIR(st.st_mode):
+                if not ignore.match(rel, True):
+                    dirs.append(rel + '/')
+                    stack.append(rel + '/')
+            elif S_ISREG(st.st_mode) and not ignore.match(rel):
+                files[rel] = (st.st_mtime, st.st_size)
+    return dirs, files
+
+WatcherType = TypeVar('WatcherType', bound='Watcher')
+'''Generic Watcher type'''
+
+class Watcher(object):
+    '''
+    Watch host source directories for changed files
+
+    Uses inotify where available and falls back to comparing snapshots
+    of file mtimes and sizes. Paths ignored by .floopignore are not
+    watched.
+
+    Args:
+        sources ([str]):
+            host source directories
+        debounce (float):
+            seconds without a new change that end a burst of changes
+    '''
+    def __init__(self, sources, debounce=0.2): # type: (WatcherType, List[str], float) -> None
+        self.sources = sorted(set(sources))
+        self.debounce = debounce
+        self._ignore = dict((source, IgnoreMatcher.load(source))
+                for source in self.sources) # type: Dict[str, IgnoreMatcher]
+        self._libc = _inotify()
+        self._fd = -1
+        self._watches = {} # type: Dict[int, Tuple[str, str]]
+        self._snapshots = {} # type: Dict[str, Dict[str, Tuple[float, int]]]
+        if self._libc is not None:
+            self._fd = self._libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            self._libc = None
+            for source in self.sources:
+                self._snapshots[source] = _walk(source, self._ignore[source])[1]
+            return
+        for source in self.sources:
+            self._add(source, '')
+
+    @property
+    def polling(self): # type: (WatcherType) -> bool
+        '''
+        Returns:
+            bool:
+                if True, inotify is not available and sources are polled
+        '''
+        return self._libc is None
+
+    def _add(self, source, rel_dir): # type: (WatcherType, str, str) -> List[str]
+        '''
+        Watch a directory and everything below it
+
+        Returns:
+            [str]:
+                relative paths of files already inside the directory
+        '''
+        dirs, files = _walk(source, self._ignore[source], rel_dir)
+        for rel in dirs:
+            path = '{}/{}'.format(abspath(source), rel)
+            wd = self._libc.inotify_add_watch(self._fd, # type: ignore
+                    path.encode('utf-8'), _WATCH_MASK)
+            if wd >= 0:
+                self._watches[wd] = (source, rel)
+        return list(files)
+
+    def _read(self, timeout): # type: (WatcherType, Optional[float]) -> Optional[Set[Tuple[str, str]]]
+        '''
+        Wait up to timeout seconds for inotify events
+
+        Returns:
+            set:
+                (source, relative path) pairs that changed, or None if
+                the kernel queue overflowed and changes were lost
+        '''
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        changed = set() # type: Set[Tuple[str, str]]
+        if not ready:
+            return changed
+        try:
+            buf = os.read(self._fd, 65536)
+        except OSError: # EAGAIN
+            return changed
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(buf, offset)
+            name = buf[offset + _EVENT_HEADER.size:
+                    offset + _EVENT_HEADER.size + length].rstrip(b'\0')
+            offset += _EVENT_HEADER.size + length
+            if mask & _IN_Q_OVERFLOW:
+                return None
+            if mask & _IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            if wd not in self._watches or not name:
+                continue
+            source, rel_dir = self._watches[wd]
+            rel = rel_dir + name.decode('utf-8', 'replace')
+            is_dir = bool(mask & _IN_ISDIR)
+            if self._ignore[source].match(rel, is_dir):
+                continue
+            if is_dir and mask & (_IN_CREATE | _IN_MOVED_TO):
+                changed.update((source, path)
+                        for path in self._add(source, rel + '/'))
+                continue
+            # a removed directory stands for all files that were inside it
+            changed.add((source, rel))
+        return changed
+
+    def _poll(self, timeout): # type: (WatcherType, Optional[float]) -> Set[Tuple[str, str]]
+        '''
+        Compare snapshots until something changed or timeout passed
+
+        Returns:
+            set:
+                (source, relative path) pairs that changed
+        '''
+        start = time.time()
+        while True:
+            changed = set() # type: Set[Tuple[str, str]]
+            for source in self.sources:
+                old = self._snapshots[source]
+                new = _walk(source, self._ignore[source])[1]
+                changed.update((source, rel) for rel in new
+                        if old.get(rel) != new[rel])
+                changed.update((source, rel) for rel in old if rel not in new)
+                self._snapshots[source] = new
+            if changed:
+                return changed
+            if timeout is not None and time.time() - start >= timeout:
+                return changed
+            time.sleep(_POLL_INTERVAL if timeout is None else
+                    min(_POLL_INTERVAL, timeout))
+
+    def wait(self, timeout=None): # type: (WatcherType, Optional[float]) -> Optional[Set[Tuple[str, str]]]
+        '''
+        Block until files change, then collect the rest of the burst
+
+        A burst ends when no change arrives for debounce seconds, or
+        after two seconds at most, so an editor saving many files
+        triggers one update
+
+        Args:
+            timeout (float):
+                seconds to wait for the first change; None waits forever
+        Returns:
+            set:
+                (source, relative path) pairs that changed; empty on
+                timeout; None if changes were lost and every source must
+                be treated as changed
+        '''
+        get = self._poll if self._libc is None else self._read
+        changed = get(timeout)
+        if not changed:
+            return changed
+        deadline = time.time() + _MAX_DEBOUNCE
+        while time.time() < deadline:
+            more = get(min(self.debounce, max(0, deadline - time.time())))
+            if more is None:
+                return None
+            if not more:
+                break
+            changed.update(more)
+        for source, rel in changed:
+            if rel == FLOOP_IGNORE_FILE:
+                self._ignore[source] = IgnoreMatcher.load(source)
+        return changed
+
+    def close(self): # type: (WatcherType) -> None
+        '''
+        Stop watching
+        '''
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+def _instruction_sources(args): # type: (str) -> List[str]
+    '''
+    Source paths of one COPY or ADD instruction
+
+    Returns:
+        [str]:
+            source paths; empty for multi-stage copies (--from)
+    '''
+    args = args.strip()
+    flags = []
+    while args.startswith('--'):
+        flag, _, args = args.partition(' ')
+        flags.append(flag)
+        args = args.strip()
+    if any(flag.startswith('--from') for flag in flags):
+        return []
+    if args.startswith('['):
+        try:
+            parts = json.loads(args)
+        except ValueError:
+            parts = args.split()
+    else:
+        parts = args.split()
+    return [part for part in parts[:-1] if '://' not in part]
+
+def image_inputs(source, build_file): # type: (str, str) -> List[str]
+    '''
+    Paths in a source directory that end up in the image built from it
+
+    Args:
+        source (str):
+            host source directory (the build context)
+        build_file (str):
+            Dockerfile name relative to source
+    Returns:
+        [str]:
+            build file, .dockerignore, and COPY/ADD sources (may be globs),
+            relative to source
+    '''
+    inputs = ['.dockerignore']
+    if build_file is None:
+        return inputs
+    inputs.append(build_file)
+    path = '{}/{}'.format(source, build_file)
+    if not isfile(path):
+        return inputs
+    with open(path) as f:
+        text = f.read().replace('\\\n', ' ')
+    for line in text.splitlines():
+        words = line.strip().split(None, 1)
+        if len(words) == 2 and words[0].upper() in ('COPY', 'ADD'):
+            inputs += [normpath(part) for part in _instruction_sources(words[1])]
+    return inputs
+
+def affects_image(path, inputs): # type: (str, List[str]) -> bool
+    '''
+    Check whether a changed file requires rebuilding the image
+
+    Args:
+        path (str):
+            changed path relative to the build context
+        inputs ([str]):
+            result of :py:func:`image_inputs`
+    Returns:
+        bool:
+            if True, path is or is inside a build input
+    '''
+    for pattern in inputs:
+        if pattern in ('.', '/'):
+            return True
+        pattern = pattern.lstrip('/')
+        if path == pattern or path.startswith(pattern + '/') or \
+                fnmatch(path, pattern):
+            return True
+    return False